@@ -0,0 +1,101 @@
+"""
+Backfill observations that were missed while the node server was down.
+
+Device observations for the gap are requested a few hours at a time and
+each response is parsed as it streams in, one observation record at a
+time, so memory use doesn't depend on the size of the gap.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import codecs
+import json
+
+# Index of the values we backfill in each device type's observation
+# records. These match the hub's UDP broadcast formats.
+RECORD_FIELDS = {
+        'ST': {'pressure': 6, 'rain': 12},
+        'AR': {'pressure': 1},
+        'SK': {'rain': 3},
+        }
+
+CHUNK = 6 * 3600       # seconds of observations per request
+MAX_GAP = 3 * 86400    # don't try to fill gaps longer than this
+MIN_GAP = 120          # or shorter than this
+READ_SIZE = 8192
+
+
+def iter_records(chunks):
+    """
+    Parse the records in the obs list of a device observation response.
+
+    chunks is an iterable of byte strings (a streamed HTTP response). The
+    records are yielded as they are parsed; only the unparsed part of the
+    response is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    in_list = False
+
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+        if not in_list:
+            i = buf.find('"obs"')
+            if i < 0:
+                # keep enough to match the key if it was split
+                pos = max(0, len(buf) - 4)
+                continue
+            j = i + 5
+            while j < len(buf) and buf[j] in ' \t\r\n:':
+                j += 1
+            if j >= len(buf):
+                pos = i
+                continue
+            if buf[j] != '[':
+                return   # obs is null or empty
+            pos = j + 1
+            in_list = True
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                (record, pos) = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break   # partial record, wait for more data
+            yield record
+
+
+def fetch_device(http, device_id, start, end, api_key, timeout=None, chunk=CHUNK):
+    """
+    Yield the observation records for a device with timestamps after
+    start and up to end, requesting chunk seconds of data at a time.
+    """
+    t = int(start)
+    last = start
+    while t < end:
+        e = min(t + chunk, int(end))
+        path_str = '/swd/rest/observations/device/%s' % device_id
+        path_str += '?time_start=%d&time_end=%d' % (t, e)
+        path_str += '&api_key=%s' % api_key
+
+        c = http.request('GET', path_str, preload_content=False, timeout=timeout)
+        try:
+            if c.status != 200:
+                raise IOError('device %s observations failed: HTTP %d' % (device_id, c.status))
+            for record in iter_records(c.stream(READ_SIZE)):
+                # Chunks overlap at the ends, skip anything already seen
+                if record and record[0] is not None and last < record[0] <= end:
+                    last = record[0]
+                    yield record
+        finally:
+            c.release_conn()
+
+        t = e
@@ -0,0 +1,159 @@
+"""
+Derived weather values (dewpoint, feels like, wind chill, heat index and
+sea level pressure) for the WeatherFlow node server.
+
+The scalar functions work on single values. derive() works on whole
+series at once and uses NumPy when it is installed, falling back to the
+scalar functions when it isn't.
+
+Inputs are in metric units: temperature in C, humidity in percent, wind
+speed in m/s, pressure in mb and elevation in meters.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Heat index regression coefficients
+HI = [-42.379, 2.04901523, 10.1433127, -0.22475541, -6.83783e-3,
+        -5.481717e-2, 1.22874e-3, 8.5282e-4, -1.99e-6]
+
+# Sea level pressure constants
+GAS_CONSTANT = 287.05   # gas constant for dry air
+GRAVITY = 9.80665       # gravity
+LAPSE_RATE = 0.0065     # standard atmosphere lapse rate
+SEA_PRESSURE = 1013.35  # pressure at sealevel
+SEA_TEMP = 288.15       # sea level temperature
+
+
+def dewpoint(t, h):
+    b = (17.625 * t) / (243.04 + t)
+    rh = h / 100.0
+
+    if rh <= 0:
+        return 0
+
+    c = math.log(rh)
+    dewpt = (243.04 * (c + b)) / (17.625 - c - b)
+    return round(dewpt, 1)
+
+
+def apparent_temp(t, ws, h):
+    wv = h / 100.0 * 6.105 * math.exp(17.27 * t / (237.7 + t))
+    at = t + (0.33 * wv) - (0.70 * ws) - 4.0
+    return round(at, 1)
+
+
+def windchill(t, ws):
+    # really need temp in F and speed in MPH
+    tf = (t * 1.8) + 32
+    mph = ws / 0.44704
+
+    wc = 35.74 + (0.6215 * tf) - (35.75 * math.pow(mph, 0.16)) + (0.4275 * tf * math.pow(mph, 0.16))
+
+    if (tf <= 50.0) and (mph >= 5.0):
+        return round((wc - 32) / 1.8, 1)
+    else:
+        return t
+
+
+def heatindex(t, h):
+    tf = (t * 1.8) + 32
+
+    hi = (HI[0] + (HI[1] * tf) + (HI[2] * h) + (HI[3] * tf * h) +
+            (HI[4] * tf * tf) + (HI[5] * h * h) + (HI[6] * tf * tf * h) +
+            (HI[7] * tf * h * h) + (HI[8] * tf * tf * h * h))
+
+    if (tf < 80.0) or (h < 40.0):
+        return t
+    else:
+        return round((hi - 32) / 1.8, 1)
+
+
+# convert station pressure in millibars to sealevel pressure
+def sea_level(station, elevation):
+    l = GRAVITY / (GAS_CONSTANT * LAPSE_RATE)
+    c = GAS_CONSTANT * LAPSE_RATE / GRAVITY
+
+    u = math.pow(1 + math.pow(SEA_PRESSURE / station, c) * (LAPSE_RATE * elevation / SEA_TEMP), l)
+
+    return (round((station * u), 3))
+
+
+def derive(temperature, humidity, wind, pressure, elevation=0.0):
+    """
+    Calculate all derived values for a series of observations.
+
+    temperature, humidity, wind and pressure are equal length sequences
+    (lists or NumPy arrays). Returns a dictionary of series keyed by
+    dewpoint, feels_like, windchill, heat_index and sea_level_pressure.
+    With NumPy the series are arrays, otherwise lists.
+    """
+    if numpy is None:
+        return derive_scalar(temperature, humidity, wind, pressure, elevation)
+    return derive_numpy(temperature, humidity, wind, pressure, elevation)
+
+
+def derive_scalar(temperature, humidity, wind, pressure, elevation=0.0):
+    result = {
+            'dewpoint': [],
+            'feels_like': [],
+            'windchill': [],
+            'heat_index': [],
+            'sea_level_pressure': [],
+            }
+    for (t, h, ws, p) in zip(temperature, humidity, wind, pressure):
+        result['dewpoint'].append(dewpoint(t, h))
+        result['feels_like'].append(apparent_temp(t, ws, h))
+        result['windchill'].append(windchill(t, ws))
+        result['heat_index'].append(heatindex(t, h))
+        result['sea_level_pressure'].append(sea_level(p, elevation))
+    return result
+
+
+def derive_numpy(temperature, humidity, wind, pressure, elevation=0.0):
+    t = numpy.asarray(temperature, dtype=numpy.float64)
+    h = numpy.asarray(humidity, dtype=numpy.float64)
+    ws = numpy.asarray(wind, dtype=numpy.float64)
+    p = numpy.asarray(pressure, dtype=numpy.float64)
+
+    # dewpoint, zero when humidity is zero
+    b = (17.625 * t) / (243.04 + t)
+    rh = h / 100.0
+    valid = rh > 0
+    c = numpy.log(numpy.where(valid, rh, 1.0))
+    dewpt = numpy.where(valid, numpy.round((243.04 * (c + b)) / (17.625 - c - b), 1), 0.0)
+
+    # apparent temperature
+    wv = rh * 6.105 * numpy.exp(17.27 * t / (237.7 + t))
+    at = numpy.round(t + (0.33 * wv) - (0.70 * ws) - 4.0, 1)
+
+    # wind chill, only below 50F and above 5 mph
+    tf = (t * 1.8) + 32
+    mph = ws / 0.44704
+    m16 = numpy.power(mph, 0.16)
+    wc = 35.74 + (0.6215 * tf) - (35.75 * m16) + (0.4275 * tf * m16)
+    wc = numpy.where((tf <= 50.0) & (mph >= 5.0), numpy.round((wc - 32) / 1.8, 1), t)
+
+    # heat index, only above 80F and 40% humidity
+    hi = (HI[0] + (HI[1] * tf) + (HI[2] * h) + (HI[3] * tf * h) +
+            (HI[4] * tf * tf) + (HI[5] * h * h) + (HI[6] * tf * tf * h) +
+            (HI[7] * tf * h * h) + (HI[8] * tf * tf * h * h))
+    hi = numpy.where((tf < 80.0) | (h < 40.0), t, numpy.round((hi - 32) / 1.8, 1))
+
+    # sea level pressure
+    l = GRAVITY / (GAS_CONSTANT * LAPSE_RATE)
+    k = GAS_CONSTANT * LAPSE_RATE / GRAVITY
+    u = numpy.power(1 + numpy.power(SEA_PRESSURE / p, k) * (LAPSE_RATE * elevation / SEA_TEMP), l)
+    slp = numpy.round(p * u, 3)
+
+    return {
+            'dewpoint': dewpt,
+            'feels_like': at,
+            'windchill': wc,
+            'heat_index': hi,
+            'sea_level_pressure': slp,
+            }
@@ -0,0 +1,137 @@
+"""
+Forecast cache for the WeatherFlow node server.
+
+Forecasts come from WeatherFlow's better_forecast API. They change
+slowly, so they're fetched in the background on their own cadence and
+the nodes are updated from the cached copy.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import time
+
+INTERVAL = 3600     # seconds between forecast requests
+TTL = 3 * 3600      # seconds a forecast is used for after it was fetched
+RETRY = 300         # seconds to wait after a failed request
+HOURS = 12          # hours the hourly high, low and precipitation cover
+
+
+class Forecast(object):
+    """
+    The parts of a better_forecast response we use. Days are
+    (start, high, low, precipitation probability) and hours are (time,
+    temperature, precipitation probability), in time order. Missing
+    values are None.
+
+    The forecast is read relative to the current time, so a cached copy
+    still gives the right day and hour as it gets older.
+    """
+    def __init__(self, daily, hourly):
+        self.daily = daily
+        self.hourly = hourly
+
+    def days(self, now, count):
+        """ Today's forecast and the following days, up to count. """
+        return [d for d in self.daily if d[0] + 86400 > now][:count]
+
+    def hours(self, now, count=HOURS):
+        """ The current hour and the following hours, up to count. """
+        return [h for h in self.hourly if h[0] + 3600 > now][:count]
+
+
+def parse(data):
+    """ Build a Forecast from a decoded better_forecast response. """
+    fc = data.get('forecast') or {}
+    daily = []
+    for d in fc.get('daily', []):
+        if 'day_start_local' not in d:
+            continue
+        daily.append((d['day_start_local'], d.get('air_temp_high'),
+            d.get('air_temp_low'), d.get('precip_probability')))
+    hourly = []
+    for h in fc.get('hourly', []):
+        if 'time' not in h:
+            continue
+        hourly.append((h['time'], h.get('air_temperature'),
+            h.get('precip_probability')))
+    daily.sort(key=lambda d: d[0])
+    hourly.sort(key=lambda h: h[0])
+    return Forecast(daily, hourly)
+
+
+def summarize(hours):
+    """
+    (high, low, highest precipitation probability) of a list of hours,
+    None for values no hour has.
+    """
+    temps = [h[1] for h in hours if h[1] is not None]
+    probs = [h[2] for h in hours if h[2] is not None]
+    return (max(temps) if temps else None, min(temps) if temps else None,
+            max(probs) if probs else None)
+
+
+class ForecastCache(object):
+    """
+    The latest forecast for each station, keyed by station ID, and when
+    to ask for the next one. A forecast is used until ttl seconds after
+    it was fetched, at least two intervals. When a request fails the
+    cached forecast is kept and the request is retried sooner.
+    """
+    def __init__(self, interval=INTERVAL, ttl=TTL, retry=RETRY):
+        self.interval = interval
+        self.ttl = max(ttl, 2 * interval)
+        self.retry = min(retry, interval)
+        self.entries = {}
+        self.fetched = {}
+        self.next = {}
+
+    def due(self, key, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.next.get(key, 0)
+
+    def put(self, key, forecast, now=None):
+        if now is None:
+            now = time.time()
+        self.entries[key] = forecast
+        self.fetched[key] = now
+        self.next[key] = now + self.interval
+
+    def failed(self, key, now=None):
+        if now is None:
+            now = time.time()
+        self.next[key] = now + self.retry
+
+    def expire(self, key, now=None):
+        """ Drop the forecast if it's too old. Returns True if one was dropped. """
+        if now is None:
+            now = time.time()
+        if key in self.entries and (now - self.fetched[key]) > self.ttl:
+            del self.entries[key]
+            return True
+        return False
+
+    def get(self, key, now=None):
+        """ The cached forecast, None if there isn't one or it expired. """
+        if now is None:
+            now = time.time()
+        if key not in self.entries or (now - self.fetched[key]) > self.ttl:
+            return None
+        return self.entries[key]
+
+    def age(self, key, now=None):
+        """ Seconds since the last forecast was fetched, even if it expired. """
+        if now is None:
+            now = time.time()
+        if key not in self.fetched:
+            return None
+        return now - self.fetched[key]
+
+    def prune(self, keys):
+        """ Drop entries for stations that are no longer configured. """
+        for key in list(self.entries):
+            if key not in keys:
+                del self.entries[key]
+        for table in (self.fetched, self.next):
+            for key in list(table):
+                if key not in keys:
+                    del table[key]
@@ -0,0 +1,170 @@
+"""
+Local observation history for the WeatherFlow node server.
+
+Observations are appended to a file of fixed size binary records so
+that on startup the last values can be restored by memory mapping the
+file, without any parsing. Old records are dropped by compacting the
+file once it grows past twice the retention period.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import math
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'WFH1'
+HEADER = struct.Struct('<4sHH')   # magic, number of fields, unused
+
+
+class History(object):
+    """
+    One station's observation history. Each record is the observation
+    time followed by one double per field, NaN when the value isn't known.
+    """
+    def __init__(self, filename, fields, retention=7 * 86400, interval=60):
+        self.filename = filename
+        self.fields = fields
+        self.retention = retention
+        self.interval = interval
+        self.record = struct.Struct('<d%dd' % len(fields))
+        self.header = HEADER.pack(MAGIC, len(fields), 0)
+        self.count = 0
+        self.last = 0
+        self.f = None
+
+    def open(self):
+        """
+        Open the history file for appending. A file with a different
+        layout is started over and a partial record left by a crash is
+        dropped.
+        """
+        directory = os.path.dirname(self.filename)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        valid = False
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                valid = (f.read(HEADER.size) == self.header)
+
+        if not valid:
+            with open(self.filename, 'wb') as f:
+                f.write(self.header)
+
+        size = os.path.getsize(self.filename)
+        self.count = (size - HEADER.size) // self.record.size
+        extra = (size - HEADER.size) % self.record.size
+        if extra != 0:
+            with open(self.filename, 'r+b') as f:
+                f.truncate(size - extra)
+
+        last = self.last_record()
+        if last is not None:
+            self.last = last[0]
+
+        if self.count > self.max_records():
+            self.compact()
+
+        self.f = open(self.filename, 'ab')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def max_records(self):
+        return 2 * int(self.retention / self.interval)
+
+    def append(self, timestamp, values):
+        """
+        Add a record. Records closer together than the interval are
+        skipped so fast updates (rapid wind) don't fill the file.
+        """
+        if self.f is None or (timestamp - self.last) < self.interval:
+            return False
+
+        self.f.write(self.record.pack(timestamp, *values))
+        self.f.flush()
+        self.last = timestamp
+        self.count += 1
+
+        if self.count > self.max_records():
+            self.close()
+            self.compact()
+            self.f = open(self.filename, 'ab')
+        return True
+
+    def _map(self):
+        f = open(self.filename, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size <= HEADER.size:
+                return (f, None)
+            return (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except Exception:
+            f.close()
+            raise
+
+    def records(self, since=0):
+        """
+        Yield (timestamp, values) for the records newer than since. The
+        records are in time order so a binary search finds the first.
+        """
+        (f, m) = self._map()
+        try:
+            if m is None:
+                return
+            size = self.record.size
+            count = (len(m) - HEADER.size) // size
+
+            lo = 0
+            hi = count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if struct.unpack_from('<d', m, HEADER.size + mid * size)[0] <= since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            for i in range(lo, count):
+                r = self.record.unpack_from(m, HEADER.size + i * size)
+                yield (r[0], r[1:])
+        finally:
+            if m is not None:
+                m.close()
+            f.close()
+
+    def last_record(self):
+        (f, m) = self._map()
+        try:
+            if m is None:
+                return None
+            count = (len(m) - HEADER.size) // self.record.size
+            if count == 0:
+                return None
+            r = self.record.unpack_from(m, HEADER.size + (count - 1) * self.record.size)
+            return (r[0], r[1:])
+        finally:
+            if m is not None:
+                m.close()
+            f.close()
+
+    def compact(self, now=None):
+        """ Rewrite the file keeping only the records within retention. """
+        if now is None:
+            now = time.time()
+
+        tmp = self.filename + '.tmp'
+        count = 0
+        with open(tmp, 'wb') as out:
+            out.write(self.header)
+            for (timestamp, values) in self.records(now - self.retention):
+                out.write(self.record.pack(timestamp, *values))
+                count += 1
+        os.replace(tmp, self.filename)
+        self.count = count
+
+
+def known(value):
+    return not math.isnan(value)
@@ -0,0 +1,82 @@
+"""
+Logging helpers for the WeatherFlow node server.
+
+LogLimiter keeps messages that repeat every poll (a key the station
+never reports) from filling the log. Capture saves the raw data we
+receive so a problem can be reproduced offline.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import os
+import threading
+import time
+
+
+class LogLimiter(object):
+    """
+    Log a message at most once per interval for each key. The number of
+    times it was suppressed is added when it's logged again.
+    """
+    def __init__(self, logger, interval=3600):
+        self.logger = logger
+        self.interval = interval
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def log(self, level, key, msg, *args):
+        now = time.time()
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and (now - entry[0]) < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            self.seen[key] = [now, 0]
+
+        if suppressed > 0:
+            msg += ' (repeated %d times)'
+            args = args + (suppressed,)
+        self.logger.log(level, msg, *args)
+        return True
+
+    def forget(self, key):
+        with self.lock:
+            self.seen.pop(key, None)
+
+
+class Capture(object):
+    """
+    Append raw payloads to one file per source in directory, one payload
+    per line. UDP captures can be played back with tools/udp_replay.py.
+    Nothing is written unless a directory is set.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.directory is not None
+
+    def write(self, source, payload):
+        if self.directory is None:
+            return
+
+        # JSON only has newlines between tokens so this keeps the
+        # payload on one line without changing it.
+        line = bytes(payload).replace(b'\r', b' ').replace(b'\n', b' ') + b'\n'
+        with self.lock:
+            f = self.files.get(source)
+            if f is None:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                f = open(os.path.join(self.directory, source + '.jsonl'), 'ab')
+                self.files[source] = f
+            f.write(line)
+            f.flush()
+
+    def close(self):
+        with self.lock:
+            for source in self.files:
+                self.files[source].close()
+            self.files = {}
@@ -0,0 +1,206 @@
+"""
+Performance metrics for the WeatherFlow node server.
+
+Histograms and counters are kept in a registry and can be served in the
+Prometheus text format by MetricsServer, so a fleet of node servers can
+be scraped and alerted on.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Upper bounds, in seconds, of the default histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for (n, v) in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v))
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labels in sorted(self.values):
+                lines.append('%s%s %s' % (self.name,
+                        format_labels(self.labels, labels),
+                        format_value(self.values[labels])))
+        return lines
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values. Besides the running totals
+    that are exported, it tracks the count and sum since the last call
+    to window() so callers can report per poll averages.
+    """
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.series = {}
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                # bucket counts, sum, count
+                s = [[0] * len(self.buckets), 0.0, 0]
+                self.series[labels] = s
+            for i in range(len(self.buckets)):
+                if value <= self.buckets[i]:
+                    s[0][i] += 1
+                    break
+            s[1] += value
+            s[2] += 1
+            self.window_count += 1
+            self.window_sum += value
+
+    def time(self, labels=()):
+        return Timer(self, labels)
+
+    def window(self):
+        """ Return (count, sum) of the values observed since the last call. """
+        with self.lock:
+            w = (self.window_count, self.window_sum)
+            self.window_count = 0
+            self.window_sum = 0.0
+        return w
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for labels in sorted(self.series):
+                (counts, total, count) = self.series[labels]
+                cumulative = 0
+                for i in range(len(self.buckets)):
+                    cumulative += counts[i]
+                    le = 'le="%s"' % format_value(self.buckets[i])
+                    lines.append('%s_bucket%s %d' % (self.name,
+                            format_labels(self.labels, labels, le), cumulative))
+                lines.append('%s_sum%s %s' % (self.name,
+                        format_labels(self.labels, labels), format_value(total)))
+                lines.append('%s_count%s %d' % (self.name,
+                        format_labels(self.labels, labels), count))
+        return lines
+
+
+class Timer(object):
+    """ Context manager that observes the time spent in its block. """
+    def __init__(self, histogram, labels=()):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.observe(time.time() - self.start, self.labels)
+        return False
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        m = Counter(name, help, labels)
+        self.metrics.append(m)
+        return m
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        m = Histogram(name, help, labels, buckets)
+        self.metrics.append(m)
+        return m
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer(object):
+    """
+    Serve a registry on http://<address>:<port>/metrics from a background
+    thread.
+    """
+    def __init__(self, port, registry=REGISTRY, address=''):
+        self.port = port
+        self.registry = registry
+        self.address = address
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((self.address, self.port), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,203 @@
+"""
+Rain accumulation tracking for the WeatherFlow node server.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import datetime
+import time
+
+BUCKETS = ['hourly', 'daily', 'weekly', 'monthly', 'yearly', 'yesterday']
+
+
+def boundaries(timestamp):
+    """
+    Return the start of the next local hour, day, week, month and year
+    after timestamp.
+    """
+    now = datetime.datetime.fromtimestamp(timestamp)
+    hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    day = datetime.datetime(now.year, now.month, now.day) + datetime.timedelta(days=1)
+    week = day + datetime.timedelta(days=(7 - now.isoweekday()))
+    if now.month == 12:
+        month = datetime.datetime(now.year + 1, 1, 1)
+    else:
+        month = datetime.datetime(now.year, now.month + 1, 1)
+    year = datetime.datetime(now.year + 1, 1, 1)
+
+    return (time.mktime(hour.timetuple()), time.mktime(day.timetuple()),
+            time.mktime(week.timetuple()), time.mktime(month.timetuple()),
+            time.mktime(year.timetuple()))
+
+
+class RainAccumulator(object):
+    """
+    Hourly, daily, weekly, monthly and yearly rain totals for a station.
+
+    The start of the next hour, day, etc. is calculated when a period
+    rolls over so adding a sample is normally just a comparison and an
+    add.
+    """
+    def __init__(self):
+        self.hourly = 0.0
+        self.daily = 0.0
+        self.weekly = 0.0
+        self.monthly = 0.0
+        self.yearly = 0.0
+        self.yesterday = 0.0
+        self.timestamp = 0
+        self.next_hour = 0
+        self.next_day = 0
+        self.next_week = 0
+        self.next_month = 0
+        self.next_year = 0
+        self.dirty = False
+
+    def roll(self, timestamp):
+        """ Clear out any totals for periods that ended before timestamp. """
+        if timestamp < self.next_hour:
+            return
+
+        self.hourly = 0.0
+        if timestamp >= self.next_day:
+            # Yesterday is only valid if the day that just ended was
+            # the one the daily total is for.
+            if timestamp < self.next_day + 86400:
+                self.yesterday = self.daily
+            else:
+                self.yesterday = 0.0
+            self.daily = 0.0
+        if timestamp >= self.next_week:
+            self.weekly = 0.0
+        if timestamp >= self.next_month:
+            self.monthly = 0.0
+        if timestamp >= self.next_year:
+            self.yearly = 0.0
+
+        (self.next_hour, self.next_day, self.next_week, self.next_month,
+                self.next_year) = boundaries(timestamp)
+        self.dirty = True
+
+    def add(self, amount, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        # Ignore samples from before the last one we counted, they've
+        # already been included.
+        if timestamp < self.timestamp:
+            return
+
+        self.roll(timestamp)
+        self.timestamp = timestamp
+        if amount:
+            self.hourly += amount
+            self.daily += amount
+            self.weekly += amount
+            self.monthly += amount
+            self.yearly += amount
+            self.dirty = True
+
+    def to_dict(self):
+        d = {}
+        for bucket in BUCKETS:
+            d[bucket] = round(getattr(self, bucket), 3)
+        d['timestamp'] = int(self.timestamp)
+        return d
+
+    def from_dict(self, d, now=None):
+        """
+        Restore saved totals. Totals for periods that have since ended
+        are cleared.
+        """
+        if now is None:
+            now = time.time()
+
+        try:
+            for bucket in BUCKETS:
+                setattr(self, bucket, float(d.get(bucket, 0)))
+
+            if 'timestamp' in d:
+                self.timestamp = float(d['timestamp'])
+            else:
+                # Older versions saved the hour, day, month and year
+                saved = datetime.datetime(int(d['year']), int(d['month']),
+                        int(d['day']), int(d['hour']))
+                self.timestamp = time.mktime(saved.timetuple())
+        except (KeyError, TypeError, ValueError):
+            for bucket in BUCKETS:
+                setattr(self, bucket, 0.0)
+            self.timestamp = now
+
+        (self.next_hour, self.next_day, self.next_week, self.next_month,
+                self.next_year) = boundaries(self.timestamp)
+        self.roll(max(now, self.timestamp))
+        self.dirty = False
+
+
+class RainStore(object):
+    """
+    Holds the rain accumulators for all stations and saves them in
+    batches. Totals are only written when something changed and at most
+    once per interval, so we don't write every sample.
+    """
+    def __init__(self, interval=300):
+        self.interval = interval
+        self.accumulators = {}
+        self.last_save = time.time()
+
+    def get(self, station_id):
+        if station_id not in self.accumulators:
+            self.accumulators[station_id] = RainAccumulator()
+        return self.accumulators[station_id]
+
+    def prune(self, station_ids):
+        """ Drop the totals of stations that are no longer configured. """
+        for sid in list(self.accumulators):
+            if sid not in station_ids:
+                del self.accumulators[sid]
+
+    def dirty(self):
+        for sid in self.accumulators:
+            if self.accumulators[sid].dirty:
+                return True
+        return False
+
+    def load(self, data, multi):
+        """
+        Restore from saved custom data. A single station's totals are
+        saved at the top level, with multiple stations they are saved
+        by station ID.
+        """
+        for sid in self.accumulators:
+            if multi:
+                self.accumulators[sid].from_dict(data.get(sid, {}))
+            else:
+                self.accumulators[sid].from_dict(data)
+
+    def snapshot(self, multi):
+        if not multi:
+            for sid in self.accumulators:
+                return self.accumulators[sid].to_dict()
+            return {}
+
+        data = {}
+        for sid in self.accumulators:
+            data[sid] = self.accumulators[sid].to_dict()
+        return data
+
+    def checkpoint(self, save, multi, force=False):
+        """
+        Call save() with all stations' totals if anything changed and
+        the interval has passed (or force is set). Returns True if
+        saved.
+        """
+        now = time.time()
+        if not force and (now - self.last_save) < self.interval:
+            return False
+        if not self.dirty():
+            return False
+
+        save(self.snapshot(multi))
+        for sid in self.accumulators:
+            self.accumulators[sid].dirty = False
+        self.last_save = now
+        return True
@@ -0,0 +1,93 @@
+"""
+Observation cadence tracking for the WeatherFlow node server.
+
+Instead of polling every station on a fixed timer, each station's
+observation interval is learned from the observation timestamps and the
+next fetch is scheduled just after the next observation should show up
+on the server.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import time
+
+MIN_INTERVAL = 60        # stations report at most once a minute
+MAX_INTERVAL = 1800
+MIN_LAG = 5              # seconds between observation and availability
+MAX_LAG = 90
+RETRY = 10               # first retry when an expected observation is late
+ACTIVE_RETRY = 5         # retry while it's raining or lightning
+MAX_BACKOFF = 300        # longest wait for a quiet station
+OFFLINE = 1800           # no observation for this long means offline
+OFFLINE_INTERVAL = 300
+
+
+class Cadence(object):
+    """
+    When to next fetch one station's observation.
+
+    interval is a running average of the time between observations.
+    lag, the time from the observation to when the server has it, is
+    nudged down each time an observation is there on the first try and
+    up each time it isn't, so fetches settle just after the data arrives.
+    """
+    def __init__(self, interval=MIN_INTERVAL, lag=15):
+        self.interval = float(interval)
+        self.lag = float(lag)
+        self.last_obs = 0
+        self.next_due = 0
+        self.misses = 0
+        self.active = False
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.next_due
+
+    def observed(self, timestamp, now=None, active=False):
+        """ A new observation with this timestamp was received. """
+        if now is None:
+            now = time.time()
+
+        if self.last_obs != 0 and timestamp > self.last_obs:
+            delta = timestamp - self.last_obs
+            # A delta of several intervals is a gap, not the cadence
+            if delta <= 4 * self.interval:
+                self.interval += 0.25 * (delta - self.interval)
+                self.interval = min(MAX_INTERVAL, max(MIN_INTERVAL, self.interval))
+
+        if self.misses == 0:
+            self.lag = max(MIN_LAG, self.lag - 1)
+
+        self.last_obs = timestamp
+        self.misses = 0
+        self.active = active
+        self.next_due = self.expected(now)
+
+    def missed(self, now=None):
+        """ The fetch failed or found no new observation. """
+        if now is None:
+            now = time.time()
+
+        if self.misses == 0:
+            self.lag = min(MAX_LAG, self.lag + 2)
+        self.misses += 1
+
+        if self.offline(now):
+            self.next_due = now + OFFLINE_INTERVAL
+        elif self.active:
+            self.next_due = now + ACTIVE_RETRY
+        else:
+            self.next_due = now + min(MAX_BACKOFF, RETRY * 2 ** (self.misses - 1))
+
+    def offline(self, now):
+        return self.last_obs != 0 and (now - self.last_obs) > OFFLINE
+
+    def expected(self, now):
+        """ The time just after the next observation should be available. """
+        if self.offline(now):
+            return now + OFFLINE_INTERVAL
+        due = self.last_obs + self.interval + self.lag
+        if due <= now:
+            # We're behind, the observation may already be there
+            due = now + (ACTIVE_RETRY if self.active else RETRY)
+        return due
@@ -0,0 +1,127 @@
+"""
+Process sharding for the WeatherFlow node server.
+
+With many stations, decoding and converting the observations on one
+thread is limited by the GIL. A ShardPool runs worker processes that
+each own a fixed share of the stations. A worker fetches, decodes and
+converts its stations' observations and sends back a compact result,
+only the main process talks to Polyglot.
+
+The work is done by a handler object with setup(index) and
+poll(key, *args) methods. Each worker calls setup() once and poll() for
+every job, on a few threads so a slow request doesn't hold up the rest
+of the shard. Workers don't log, errors are sent back to the main
+process.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+
+def run_shard(handler, index, jobs, results, threads):
+    """ Worker process main loop. """
+    handler.setup(index)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    stopping = threading.Event()
+
+    def work(key, args):
+        if stopping.is_set():
+            return
+        try:
+            results.put((key, True, handler.poll(key, *args)))
+        except Exception as e:
+            results.put((key, False, '%s: %s' % (type(e).__name__, str(e))))
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        pool.submit(work, job[0], job[1])
+    # Finish the requests in progress, drop the ones not started
+    stopping.set()
+    pool.shutdown(wait=True)
+
+
+class ShardPool(object):
+    """
+    Worker processes that each own a share of the keys (station IDs). A
+    key always goes to the same worker so the worker can keep that
+    station's state, like the last observation and published values.
+    """
+    def __init__(self, handler, shards, threads=1):
+        self.handler = handler
+        self.shards = shards
+        self.threads = threads
+        self.processes = [None] * shards
+        self.jobs = [None] * shards
+        self.results = None
+        self.pending = set()
+        self.restarts = 0
+
+    def start(self):
+        self.results = multiprocessing.Queue()
+        for i in range(self.shards):
+            self.start_shard(i)
+
+    def start_shard(self, index):
+        self.jobs[index] = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_shard,
+                args=(self.handler, index, self.jobs[index], self.results, self.threads))
+        p.daemon = True
+        p.start()
+        self.processes[index] = p
+
+    def owner(self, key):
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    def busy(self, key):
+        """ True while a job for key hasn't been answered. """
+        return key in self.pending
+
+    def submit(self, key, *args):
+        index = self.owner(key)
+        if not self.processes[index].is_alive():
+            # Whatever it was working on is lost, start over.
+            self.restarts += 1
+            self.pending = set([k for k in self.pending if self.owner(k) != index])
+            self.start_shard(index)
+        self.pending.add(key)
+        self.jobs[index].put((key, args))
+
+    def collect(self, timeout):
+        """
+        Yield (key, ok, value) for each answer, until nothing is pending
+        or timeout seconds have passed. value is what the handler's
+        poll() returned, or the error message when ok is False. Late
+        answers to earlier jobs are yielded too.
+        """
+        end = time.time() + timeout
+        while len(self.pending) > 0:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            try:
+                (key, ok, value) = self.results.get(timeout=remaining)
+            except queue.Empty:
+                return
+            self.pending.discard(key)
+            yield (key, ok, value)
+
+    def stop(self, timeout=5.0):
+        for index in range(self.shards):
+            if self.processes[index] is not None and self.processes[index].is_alive():
+                self.jobs[index].put(None)
+        end = time.time() + timeout
+        for p in self.processes:
+            if p is None:
+                continue
+            p.join(max(0, end - time.time()))
+            if p.is_alive():
+                p.terminate()
+        self.processes = [None] * self.shards
+        self.pending = set()
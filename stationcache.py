@@ -0,0 +1,61 @@
+"""
+On disk cache of WeatherFlow station metadata.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import json
+import os
+import time
+
+
+class StationCache(object):
+    """
+    Station metadata (height above ground, elevation, units and devices)
+    keyed by station ID. Entries older than ttl seconds are still
+    returned but are reported as expired so they get refreshed.
+    """
+    def __init__(self, filename, ttl=86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+        return self
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.filename)
+
+    def get(self, station_id):
+        if station_id in self.entries:
+            return self.entries[station_id]['meta']
+        return None
+
+    def expired(self, station_id, now=None):
+        if now is None:
+            now = time.time()
+        if station_id not in self.entries:
+            return True
+        return (now - self.entries[station_id]['fetched']) > self.ttl
+
+    def put(self, station_id, meta, now=None):
+        if now is None:
+            now = time.time()
+        self.entries[station_id] = {'fetched': now, 'meta': meta}
+
+    def prune(self, station_ids):
+        """ Drop entries for stations that are no longer configured. """
+        for sid in list(self.entries):
+            if sid not in station_ids:
+                del self.entries[sid]
@@ -0,0 +1,134 @@
+"""
+Lightning strike index for the WeatherFlow node server.
+
+Counts the strikes reported by the hub or the WebSocket (evt_strike)
+over the last 5, 15, 60 and 180 minutes and keeps track of the nearest
+recent strike.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import collections
+
+BUCKET = 60                 # seconds per bucket
+WINDOWS = (5, 15, 60, 180)  # minutes
+NEAREST = 15                # minutes the nearest strike is taken from
+
+
+class StrikeIndex(object):
+    """
+    Strikes are counted in one minute buckets covering the longest
+    window, so memory use is fixed no matter how many strikes there
+    are. Each bucket holds the number of strikes, their total energy
+    and the closest strike distance.
+
+    A running total for each window is updated as strikes are added
+    and as buckets age out of the window, reading a count is O(1). The
+    nearest strike comes from a monotonic deque of buckets, closest
+    first.
+    """
+    def __init__(self, windows=WINDOWS, nearest=NEAREST, bucket=BUCKET):
+        self.windows = tuple(windows)
+        self.bucket = bucket
+        self.size = max(self.windows)
+        self.nearest_window = nearest
+        self.clear()
+
+    def clear(self):
+        self.current = None      # number of the newest bucket
+        self.counts = [0] * self.size
+        self.energy = [0.0] * self.size
+        self.closest = [None] * self.size
+        self.totals = [0] * len(self.windows)
+        self.energies = [0.0] * len(self.windows)
+        self.nearq = collections.deque()
+
+    def advance(self, now):
+        """
+        Move the newest bucket up to time now, dropping strikes that
+        are now outside their windows. Returns True if a count changed.
+        """
+        n = int(now // self.bucket)
+        if self.current is None:
+            self.current = n
+            return False
+        if n <= self.current:
+            return False
+
+        changed = False
+        if n - self.current >= self.size:
+            changed = sum(self.totals) > 0
+            self.clear()
+        else:
+            for b in range(self.current + 1, n + 1):
+                for (i, w) in enumerate(self.windows):
+                    old = (b - w) % self.size
+                    if self.counts[old] > 0:
+                        self.totals[i] -= self.counts[old]
+                        self.energies[i] -= self.energy[old]
+                        changed = True
+                slot = b % self.size
+                self.counts[slot] = 0
+                self.energy[slot] = 0.0
+                self.closest[slot] = None
+        self.current = n
+
+        first = n - self.nearest_window + 1
+        while self.nearq and self.nearq[0] < first:
+            self.nearq.popleft()
+        return changed
+
+    def add(self, timestamp, distance=None, energy=0.0):
+        """
+        Add a strike. Strikes older than the longest window are
+        ignored. Returns True if it was counted.
+        """
+        b = int(timestamp // self.bucket)
+        if self.current is None or b > self.current:
+            self.advance(timestamp)
+        age = self.current - b
+        if age >= self.size:
+            return False
+
+        slot = b % self.size
+        energy = energy or 0.0
+        self.counts[slot] += 1
+        self.energy[slot] += energy
+        for (i, w) in enumerate(self.windows):
+            if age < w:
+                self.totals[i] += 1
+                self.energies[i] += energy
+
+        if distance is not None and (self.closest[slot] is None or distance < self.closest[slot]):
+            self.closest[slot] = distance
+            if age == 0:
+                q = self.nearq
+                while q and self.closest[q[-1] % self.size] >= distance:
+                    q.pop()
+                q.append(b)
+            elif age < self.nearest_window:
+                # A late strike, rarely happens
+                self.rebuild_nearest()
+        return True
+
+    def rebuild_nearest(self):
+        q = collections.deque()
+        for b in range(self.current - self.nearest_window + 1, self.current + 1):
+            d = self.closest[b % self.size]
+            if d is None:
+                continue
+            while q and self.closest[q[-1] % self.size] >= d:
+                q.pop()
+            q.append(b)
+        self.nearq = q
+
+    def count(self, minutes):
+        return self.totals[self.windows.index(minutes)]
+
+    def total_energy(self, minutes):
+        return self.energies[self.windows.index(minutes)]
+
+    def nearest(self):
+        """ Distance of the closest strike in the nearest window, None if none. """
+        if not self.nearq:
+            return None
+        return self.closest[self.nearq[0] % self.size]
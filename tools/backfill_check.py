@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Run the backfill pipeline against the canned server.
+
+Starts tools/canned_server.py on a free port, streams the canned device
+observations through backfill.fetch_device() and feeds them to a rain
+accumulator and pressure trend, the same way the node server does on
+startup.
+
+    backfill_check.py [--device 1110] [--start 1600000000] [--hours 6]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import urllib3
+import backfill
+import rainstore
+import trend
+import canned_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check backfill against canned responses')
+    parser.add_argument('--device', default='1110')
+    parser.add_argument('--type', default='ST')
+    parser.add_argument('--start', type=int, default=1600000000)
+    parser.add_argument('--hours', type=float, default=6)
+    parser.add_argument('--chunk', type=int, default=3600,
+            help='seconds of data per request')
+    args = parser.parse_args()
+
+    server = canned_server.serve()
+    http = urllib3.HTTPConnectionPool('127.0.0.1', port=server.server_address[1], maxsize=1)
+
+    fields = backfill.RECORD_FIELDS[args.type]
+    rain = rainstore.RainAccumulator()
+    rain.from_dict({'timestamp': args.start}, now=args.start)
+    pressure = trend.PressureTrend()
+
+    end = args.start + int(args.hours * 3600)
+    count = 0
+    for record in backfill.fetch_device(http, args.device, args.start, end,
+            'test', 10, args.chunk):
+        count += 1
+        if 'rain' in fields:
+            rain.add(record[fields['rain']], record[0])
+        if 'pressure' in fields:
+            pressure.add(record[0], record[fields['pressure']])
+
+    server.shutdown()
+    print('records:  %d' % count)
+    print('rain:     %s' % rain.to_dict())
+    print('pressure: %.2f mb over %.0f minutes, trend %d' %
+            (pressure.change(), pressure.span() / 60, pressure.trend()))
+    return 0 if count > 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
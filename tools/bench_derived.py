@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Compare the scalar and vectorized derived value calculations.
+
+    bench_derived.py [--count 500000] [--repeat 3]
+
+Generates a series of synthetic observations and times derived.derive()
+against calling the scalar functions one observation at a time.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import derived
+
+
+def make_series(count):
+    r = random.Random(42)
+    temperature = [r.uniform(-20.0, 40.0) for i in range(count)]
+    humidity = [r.uniform(5.0, 100.0) for i in range(count)]
+    wind = [r.uniform(0.0, 20.0) for i in range(count)]
+    pressure = [r.uniform(950.0, 1040.0) for i in range(count)]
+    return (temperature, humidity, wind, pressure)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark derived value calculations')
+    parser.add_argument('--count', type=int, default=500000,
+            help='number of observations')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--elevation', type=float, default=300.0)
+    args = parser.parse_args()
+
+    series = make_series(args.count)
+
+    scalar = best_of(args.repeat, derived.derive_scalar, *(series + (args.elevation,)))
+    print('scalar:     %8.3f s  %12.0f obs/s' % (scalar, args.count / scalar))
+
+    if derived.numpy is None:
+        print('vectorized: numpy is not installed')
+        return 0
+
+    arrays = tuple(derived.numpy.asarray(x) for x in series)
+    vector = best_of(args.repeat, derived.derive_numpy, *(arrays + (args.elevation,)))
+    print('vectorized: %8.3f s  %12.0f obs/s  (%.1fx)' %
+            (vector, args.count / vector, scalar / vector))
+
+    # Make sure both paths agree
+    a = derived.derive_scalar(*(s[:1000] for s in series), elevation=args.elevation)
+    b = derived.derive_numpy(*(s[:1000] for s in series), elevation=args.elevation)
+    for key in a:
+        worst = max(abs(x - y) for (x, y) in zip(a[key], b[key]))
+        if worst > 0.11:
+            print('MISMATCH %s: %f' % (key, worst))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Benchmark the observation processing pipeline offline.
+
+    bench_pipeline.py [--stations 10] [--observations 120] [--repeat 3]
+                      [--corpus corpus/observations_station.jsonl]
+                      [--min-rate 0]
+
+Runs the node server's controller and nodes against the fake
+polyinterface in tools/fakepoly, feeding each station the recorded
+station observation responses in the corpus. No Polyglot or network is
+needed. Reports the end to end throughput for stations x observations
+and the time spent in each stage:
+
+    decode     json.loads() of the raw response
+    process    Controller.process_station() (obs_data, conversions,
+               deadbands, trend, rain and publishing)
+    setDriver  WeatherNode.setDriver() with a changing value
+    trend      PressureNode.updateTrend()
+
+A capture made with the Capture Directory parameter (rest.jsonl) can be
+used as the corpus. Exits with an error if the throughput is below
+--min-rate observations per second, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, '..'))
+sys.path.insert(0, os.path.join(TOOLS, 'fakepoly'))
+import polyinterface
+import weatherflow
+
+
+def load_corpus(filename):
+    with open(filename, 'rb') as f:
+        return [line.strip() for line in f if line.strip() != b'']
+
+
+def make_controller(count):
+    poly = polyinterface.Interface()
+    c = weatherflow.Controller(poly)
+    ids = ','.join([str(1000 + i) for i in range(count)])
+    c.polyConfig = {'customParams': {'Station': ids, 'History Days': '0'}}
+    c.configured = c.check_params()
+    c.discover()
+    for sid in c.stations:
+        c.stations[sid].ready = True
+    return c
+
+
+def run_pipeline(count, corpus, observations):
+    """
+    Feed every station observations responses from the corpus. Returns
+    (total, decode, process, sent) times in seconds and the number of
+    messages sent to Polyglot.
+    """
+    c = make_controller(count)
+    stations = [c.stations[sid] for sid in sorted(c.stations)]
+    span = 60 * len(corpus)
+    decode = 0.0
+    process = 0.0
+
+    start = time.perf_counter()
+    for i in range(observations):
+        raw = corpus[i % len(corpus)]
+        cycle = i // len(corpus)
+        for station in stations:
+            t = time.perf_counter()
+            data = json.loads(raw)
+            decode += time.perf_counter() - t
+
+            # Repeat the corpus with later timestamps so nothing is
+            # skipped as unchanged.
+            data['obs'][0]['timestamp'] += cycle * span
+
+            t = time.perf_counter()
+            c.process_station(station, data)
+            process += time.perf_counter() - t
+    total = time.perf_counter() - start
+    return (total, decode, process, c.poly.sent)
+
+
+def run_setdriver(count):
+    c = make_controller(1)
+    node = c.nodes['temperature']
+    start = time.perf_counter()
+    for i in range(count):
+        node.setDriver('ST', 20.0 + (i % 100) * 0.1)
+    return time.perf_counter() - start
+
+
+def run_trend(count):
+    c = make_controller(1)
+    node = c.nodes['pressure']
+    start = time.perf_counter()
+    for i in range(count):
+        node.updateTrend(1000.0 + (i % 50) * 0.02, 1600000000 + i * 60)
+    return time.perf_counter() - start
+
+
+def best_of(repeat, func, *args):
+    """ Run func repeat times, return the result of the fastest run. """
+    results = [func(*args) for i in range(repeat)]
+    return min(results, key=lambda r: r[0] if isinstance(r, tuple) else r)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the observation pipeline offline')
+    parser.add_argument('--stations', type=int, default=10)
+    parser.add_argument('--observations', type=int, default=120,
+            help='observations per station')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus',
+            default=os.path.join(TOOLS, 'corpus', 'observations_station.jsonl'))
+    parser.add_argument('--min-rate', type=float, default=0,
+            help='fail if fewer observations per second are processed')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if len(corpus) == 0:
+        print('corpus %s is empty' % args.corpus)
+        return 1
+
+    count = args.stations * args.observations
+    (total, decode, process, sent) = best_of(args.repeat, run_pipeline,
+            args.stations, corpus, args.observations)
+    print('pipeline:  %d stations x %d observations' % (args.stations, args.observations))
+    print('  total    %8.3f s  %12.0f obs/s' % (total, count / total))
+    print('  decode   %8.3f s  %12.1f us/obs' % (decode, 1e6 * decode / count))
+    print('  process  %8.3f s  %12.1f us/obs' % (process, 1e6 * process / count))
+    print('  sent     %8d updates  %10.1f per obs' % (sent, sent / float(count)))
+
+    calls = 100000
+    elapsed = best_of(args.repeat, run_setdriver, calls)
+    print('setDriver: %8.3f s  %12.2f us/call' % (elapsed, 1e6 * elapsed / calls))
+    elapsed = best_of(args.repeat, run_trend, calls)
+    print('trend:     %8.3f s  %12.2f us/call' % (elapsed, 1e6 * elapsed / calls))
+
+    if sent == 0:
+        print('FAIL: nothing was published')
+        return 1
+    if count / total < args.min_rate:
+        print('FAIL: %.0f obs/s is below the minimum of %.0f' % (count / total, args.min_rate))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
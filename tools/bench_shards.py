@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark how the sharded pipeline scales with worker processes.
+
+    bench_shards.py [--stations 200] [--rounds 20] [--max-shards 4]
+                    [--threads 2] [--corpus corpus/observations_station.jsonl]
+
+Polls every station --rounds times, first with all the work in this
+process and then with 1 to --max-shards worker processes (the Shards
+parameter). The workers run weatherflow.StationShard with the recorded
+responses in the corpus standing in for the WeatherFlow servers, so
+what's measured is the decoding, conversion and publishing and not the
+network. Uses the fake polyinterface in tools/fakepoly, no Polyglot is
+needed.
+
+Reports observations per second and the speedup over one worker
+process. The speedup levels off once the main process, which applies
+every update, is busy all the time.
+"""
+import argparse
+import os
+import sys
+import time
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS, '..'))
+sys.path.insert(0, os.path.join(TOOLS, 'fakepoly'))
+import bench_pipeline
+import shard
+import weatherflow
+
+
+class CorpusShard(weatherflow.StationShard):
+    """ StationShard that replays the corpus instead of fetching. """
+    def __init__(self, corpus, controller):
+        super(CorpusShard, self).__init__(weatherflow.SERVER_URL, 10.0,
+                controller.deadbands, controller.republish)
+        self.corpus = corpus
+
+    def setup(self, index):
+        super(CorpusShard, self).setup(index)
+        self.counts = {}
+
+    def fetch(self, station):
+        n = self.counts.get(station.id, 0)
+        self.counts[station.id] = n + 1
+        return (self.corpus[n % len(self.corpus)], None)
+
+
+def run_local(count, corpus, rounds):
+    c = bench_pipeline.make_controller(count)
+    handler = CorpusShard(corpus, c)
+    handler.setup(0)
+    stations = list(c.stations.values())
+    start = time.perf_counter()
+    for i in range(rounds):
+        for station in stations:
+            c.shard_result(station, handler.poll(station.id, station.units))
+    return (time.perf_counter() - start, c.poly.sent)
+
+
+def run_sharded(count, corpus, rounds, shards, threads):
+    c = bench_pipeline.make_controller(count)
+    c.shard_pool = shard.ShardPool(CorpusShard(corpus, c), shards, threads)
+    c.shard_pool.start()
+    try:
+        # Let the workers start up before timing
+        c.query_data()
+        start = time.perf_counter()
+        for i in range(rounds):
+            c.query_data()
+        return (time.perf_counter() - start, c.poly.sent)
+    finally:
+        c.shard_pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sharding across worker processes')
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=20,
+            help='times each station is polled')
+    parser.add_argument('--max-shards', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=2,
+            help='threads in each worker process')
+    parser.add_argument('--corpus',
+            default=os.path.join(TOOLS, 'corpus', 'observations_station.jsonl'))
+    args = parser.parse_args()
+
+    corpus = bench_pipeline.load_corpus(args.corpus)
+    if len(corpus) == 0:
+        print('corpus %s is empty' % args.corpus)
+        return 1
+
+    count = args.stations * args.rounds
+    print('%d stations x %d rounds, %d threads per shard' %
+            (args.stations, args.rounds, args.threads))
+    (elapsed, sent) = run_local(args.stations, corpus, args.rounds)
+    print('  local     %8.3f s  %10.0f obs/s' % (elapsed, count / elapsed))
+
+    base = None
+    for shards in range(1, args.max_shards + 1):
+        (elapsed, sent) = run_sharded(args.stations, corpus, args.rounds,
+                shards, args.threads)
+        rate = count / elapsed
+        if base is None:
+            base = rate
+        print('  shards %2d %8.3f s  %10.0f obs/s  %5.2fx' %
+                (shards, elapsed, rate, rate / base))
+        if sent == 0:
+            print('FAIL: nothing was published')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
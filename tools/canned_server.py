@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Serve canned WeatherFlow REST responses.
+
+A local stand-in for swd.weatherflow.com. The request path (without the
+query string) below /swd/rest/ is mapped to a file in the canned
+directory by replacing / with _, so /swd/rest/observations/device/1110
+is served from observations_device_1110.json. Responses are sent in
+small pieces so clients that stream responses get exercised, gzip
+compressed if the client asks for it.
+
+    canned_server.py [--port 8080] [--dir canned]
+"""
+import argparse
+import gzip
+import os
+import sys
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    sys.exit('Python 3 is required')
+
+PREFIX = '/swd/rest/'
+PIECE = 512
+
+
+class CannedHandler(BaseHTTPRequestHandler):
+    directory = '.'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if not path.startswith(PREFIX):
+            self.send_error(404)
+            return
+
+        name = path[len(PREFIX):].strip('/').replace('/', '_') + '.json'
+        filename = os.path.join(self.directory, name)
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+
+        with open(filename, 'rb') as f:
+            body = f.read()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for i in range(0, len(body), PIECE):
+            self.wfile.write(body[i:i + PIECE])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CannedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=0, directory=None):
+    """
+    Start a canned server in a background thread. Returns the server,
+    server.server_address has the port actually used.
+    """
+    if directory is None:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'canned')
+    handler = type('Handler', (CannedHandler,), {'directory': directory})
+    server = CannedServer(('127.0.0.1', port), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve canned WeatherFlow responses')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--dir', default=None)
+    args = parser.parse_args()
+
+    server = serve(args.port, args.dir)
+    print('Serving canned responses on port %d' % server.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+In-process stand-in for polyinterface.
+
+Just enough of the Polyglot v2 interface to create the node server's
+controller and nodes and run observations through them without a
+Polyglot or ISY. Driver updates are counted (and optionally kept)
+instead of being sent anywhere.
+
+Put this directory first on sys.path before importing weatherflow.
+"""
+import copy
+import logging
+
+logging.basicConfig(level=logging.WARNING)
+LOGGER = logging.getLogger('weatherflow')
+
+
+class Interface(object):
+    def __init__(self, envVar=None):
+        self.sent = 0
+        self.messages = None
+        self.customData = {}
+
+    def start(self):
+        pass
+
+    def onConfig(self, callback):
+        pass
+
+    def onStop(self, callback):
+        pass
+
+    def send(self, message):
+        self.sent += 1
+        if self.messages is not None:
+            self.messages.append(message)
+
+    def installprofile(self):
+        return True
+
+    def saveCustomData(self, data):
+        self.customData = data
+
+
+class Node(object):
+    drivers = []
+
+    def __init__(self, controller, primary, address, name):
+        self.controller = controller
+        self.parent = controller
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.poly = controller.poly if controller is not None else None
+        self._drivers = copy.deepcopy(self.drivers)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                d['value'] = value
+                if uom is not None:
+                    d['uom'] = uom
+                if report:
+                    self.reportDriver(d, report, force)
+                break
+
+    def reportDriver(self, driver, report, force):
+        for d in self._drivers:
+            if d['driver'] == driver['driver']:
+                if str(d['value']) != str(driver['value']) or d['uom'] != driver['uom'] or force:
+                    d['value'] = copy.deepcopy(driver['value'])
+                    d['uom'] = driver['uom']
+                    self.poly.send({'status': {'address': self.address,
+                            'driver': driver['driver'], 'value': str(driver['value']),
+                            'uom': driver['uom']}})
+                break
+
+    def reportDrivers(self):
+        for d in self.drivers:
+            self.reportDriver(d, True, True)
+
+    def reportCmd(self, command, value=None, uom=None):
+        self.poly.send({'command': {'address': self.address, 'cmd': command}})
+
+    def start(self):
+        pass
+
+    def query(self):
+        self.reportDrivers()
+
+
+class Controller(Node):
+    def __init__(self, poly):
+        self.poly = poly
+        self.nodes = {}
+        self.polyConfig = {'customParams': {}}
+        self.notices = {}
+        super(Controller, self).__init__(self, None, None, None)
+        self.poly = poly
+
+    def addNode(self, node):
+        self.nodes[node.address] = node
+        return node
+
+    def delNode(self, address):
+        if address in self.nodes:
+            del self.nodes[address]
+
+    def addCustomParam(self, params):
+        self.polyConfig['customParams'].update(params)
+
+    def addNotice(self, notices):
+        self.notices.update(notices)
+
+    def removeNoticesAll(self):
+        self.notices = {}
+
+    def saveCustomData(self, data):
+        self.poly.saveCustomData(data)
+
+    def runForever(self):
+        pass
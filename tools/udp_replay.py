@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Send recorded WeatherFlow hub UDP broadcasts.
+
+Stands in for a hub on the local network so that the node server's UDP
+listener can be tested without real hardware.  Each line of the input
+file is one JSON datagram, as sent by the hub.
+
+    udp_replay.py [--host 127.0.0.1] [--port 50222] [--delay 1.0]
+                  [--loop] [recording.jsonl]
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded WeatherFlow UDP datagrams')
+    parser.add_argument('file', nargs='?',
+            default=os.path.join(os.path.dirname(__file__), 'udp_sample.jsonl'))
+    parser.add_argument('--host', default='127.0.0.1',
+            help='destination address, use 255.255.255.255 to broadcast')
+    parser.add_argument('--port', type=int, default=50222)
+    parser.add_argument('--delay', type=float, default=1.0,
+            help='seconds between datagrams')
+    parser.add_argument('--loop', action='store_true',
+            help='repeat the recording until interrupted')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        packets = [line.strip() for line in f if line.strip() != b'']
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    try:
+        while True:
+            for packet in packets:
+                s.sendto(packet, (args.host, args.port))
+                time.sleep(args.delay)
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        s.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""
+Simulate the WeatherFlow REST API for load and fault testing.
+
+A stand-in for swd.weatherflow.com serving any number of synthetic
+stations, each with one Tempest (ST) device:
+
+    /swd/rest/stations/<station id>
+    /swd/rest/observations/station/<station id>
+    /swd/rest/observations/device/<device id>?time_start=&time_end=
+    /swd/rest/better_forecast?station_id=<station id>
+    /swd/data   (WebSocket)
+
+With --indoor N, every Nth station also has an indoor AIR with device
+ID station * 10 + 2, and its observations have indoor keys too. The
+WebSocket pushes obs_air messages for the indoor AIR.
+
+Observations follow the clock, a new one every minute, with a daily
+temperature cycle, slowly changing pressure and the occasional shower
+and lightning storm. The forecast is the same synthetic weather, with
+the chance of precipitation following the storms. The values for a station and time are always the
+same so runs are repeatable. Station IDs start at --base, the device ID
+of station N is N * 10 + 1.
+
+The WebSocket accepts listen_start and listen_rapid_start for the
+device IDs and pushes obs_st, rapid_wind and evt_strike messages. The
+push intervals can be shortened to speed up testing.
+
+Responses can be delayed, fail or be cut off part way through to
+exercise the node server's timeouts, retries and circuit breaker, and
+WebSocket connections can be dropped to exercise reconnecting.
+
+    wf_simulator.py [--port 8080] [--stations 1000] [--base 1000]
+                    [--latency 0] [--jitter 0] [--error-rate 0]
+                    [--truncate-rate 0] [--seed 1]
+                    [--push-interval 60] [--rapid-interval 3]
+                    [--drop-after 0] [--indoor 0]
+
+Point the node server at it with the Server URL parameter, for example
+http://127.0.0.1:8080.
+"""
+import argparse
+import gzip
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import derived
+import wfsocket
+
+STATION_PATH = re.compile(r'^/swd/rest/stations/(\d+)$')
+OBS_PATH = re.compile(r'^/swd/rest/observations/station/(\d+)$')
+DEVICE_PATH = re.compile(r'^/swd/rest/observations/device/(\d+)$')
+FORECAST_PATH = '/swd/rest/better_forecast'
+SOCKET_PATH = '/swd/data'
+
+INTERVAL = 60
+OUTDOOR_KEYS = ['air_temperature', 'barometric_pressure', 'station_pressure',
+        'sea_level_pressure', 'relative_humidity', 'precip',
+        'precip_accum_last_1hr', 'precip_accum_local_day',
+        'precip_accum_local_yesterday', 'wind_avg', 'wind_direction',
+        'wind_gust', 'wind_lull', 'solar_radiation', 'uv', 'brightness',
+        'lightning_strike_last_epoch', 'lightning_strike_last_distance',
+        'lightning_strike_count', 'lightning_strike_count_last_1hr',
+        'lightning_strike_count_last_3hr', 'feels_like', 'heat_index',
+        'wind_chill', 'dew_point']
+INDOOR_KEYS = ['air_temperature_indoor', 'barometric_pressure_indoor',
+        'station_pressure_indoor', 'sea_level_pressure_indoor',
+        'relative_humidity_indoor', 'feels_like_indoor', 'dew_point_indoor']
+UNITS = [
+        {'units_temp': 'f', 'units_distance': 'mi', 'units_wind': 'mph',
+            'units_precip': 'in', 'units_pressure': 'inhg'},
+        {'units_temp': 'c', 'units_distance': 'km', 'units_wind': 'mps',
+            'units_precip': 'mm', 'units_pressure': 'mb'},
+        {'units_temp': 'c', 'units_distance': 'mi', 'units_wind': 'mph',
+            'units_precip': 'mm', 'units_pressure': 'mb'},
+        ]
+
+
+class Weather(object):
+    """
+    Synthetic weather for a set of stations. obs_st() returns a record
+    in the same layout as the hub's obs_st broadcasts and the device
+    observation API.
+    """
+    def __init__(self, count, base=1000, indoor=0):
+        self.count = count
+        self.base = base
+        self.indoor = indoor
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def known(self, station_id):
+        return self.base <= station_id < self.base + self.count
+
+    def has_indoor(self, station_id):
+        return self.indoor > 0 and (station_id - self.base) % self.indoor == 0
+
+    def elevation(self, station_id):
+        return float((station_id * 37) % 900)
+
+    def obs_st(self, station_id, timestamp):
+        t = int(timestamp) - int(timestamp) % INTERVAL
+        r = random.Random(station_id * 1000003 + t)
+        phase = (station_id % 24) * 3600
+        day = math.sin(2 * math.pi * (t - phase) / 86400.0)
+        # daylight from 6am to 6pm
+        sun = max(0.0, math.sin(2 * math.pi * ((t - phase) % 86400 - 21600) / 86400.0))
+
+        temp = 10.0 + (station_id % 8) + 7.0 * day + r.uniform(-0.2, 0.2)
+        rh = min(100.0, max(5.0, 65.0 - 20.0 * day + r.uniform(-2, 2)))
+        pressure = 1005.0 - self.elevation(station_id) / 8.3 + \
+                6.0 * math.sin(2 * math.pi * t / (3 * 86400.0) + station_id)
+        avg = abs(3.0 + 2.0 * math.sin(t / 5400.0 + station_id) + r.uniform(-1, 1))
+        lull = max(0.0, avg - r.uniform(0.2, 1.5))
+        gust = avg + r.uniform(0.2, 3.0)
+        direction = int(station_id * 7 + 40 * math.sin(t / 7200.0) + r.uniform(-15, 15)) % 360
+
+        # Showers come and go, storms bring lightning
+        storm = self.storm(station_id, t)
+        rain = 0.0
+        precip_type = 0
+        if storm > 0.85:
+            rain = round(r.uniform(0.0, 0.05) * (storm - 0.85) * 10, 3)
+            precip_type = 1 if rain > 0 else 0
+        strikes = 0
+        distance = 0
+        if storm > 0.95 and r.random() < 0.3:
+            strikes = r.randint(1, 4)
+            distance = r.randint(3, 35)
+
+        return [t, round(lull, 2), round(avg, 2), round(gust, 2), direction, 3,
+                round(pressure, 2), round(temp, 2), round(rh, 1),
+                int(90000 * sun), round(9 * sun, 2), int(800 * sun), rain,
+                precip_type, distance, strikes, 2.6, 1]
+
+    def storm(self, station_id, t):
+        return math.sin(t / 10800.0 + station_id * 1.3)
+
+    def indoor_obs(self, station_id, t):
+        """ Indoor (temperature, humidity). """
+        temp = round(20.0 + 2 * math.sin(2 * math.pi * t / 86400.0), 1)
+        return (temp, 40 + station_id % 15)
+
+    def obs_air(self, station_id, timestamp):
+        """ The indoor AIR's record, in the layout of obs_air messages. """
+        o = self.obs_st(station_id, timestamp)
+        (temp, humidity) = self.indoor_obs(station_id, o[0])
+        return [o[0], o[6], temp, humidity, 0, 0, 3.4, 1]
+
+    def rain_total(self, station_id, start, end):
+        total = 0.0
+        for t in range(int(start) - int(start) % INTERVAL, int(end), INTERVAL):
+            total += self.obs_st(station_id, t)[12]
+        return total
+
+    def daily_rain(self, station_id, timestamp):
+        """
+        Rain so far today (UTC). Kept per station and added to a minute
+        at a time so each poll only computes the new observations.
+        """
+        t = int(timestamp) - int(timestamp) % INTERVAL
+        midnight = t - t % 86400
+        with self.lock:
+            (start, last, total) = self.totals.get(station_id, (midnight, midnight, 0.0))
+            if start != midnight or last > t:
+                (start, last, total) = (midnight, midnight, 0.0)
+            total += self.rain_total(station_id, last, t + INTERVAL)
+            self.totals[station_id] = (start, t + INTERVAL, total)
+        return round(total, 2)
+
+    def station(self, station_id):
+        device_id = station_id * 10 + 1
+        station = {
+            'stations': [{
+                'station_id': station_id,
+                'name': 'Simulated %d' % station_id,
+                'public_name': 'Simulated %d' % station_id,
+                'latitude': 37.0 + (station_id % 100) / 100.0,
+                'longitude': -122.0 - (station_id % 100) / 100.0,
+                'timezone': 'Etc/UTC',
+                'station_meta': {'elevation': self.elevation(station_id)},
+                'devices': [
+                    {'device_id': station_id * 10, 'serial_number': 'HB-%08d' % station_id,
+                        'device_type': 'HB', 'device_meta': {}},
+                    {'device_id': device_id, 'serial_number': 'ST-%08d' % station_id,
+                        'device_type': 'ST', 'device_meta': {'agl': 2.0,
+                            'name': 'ST-%08d' % station_id, 'environment': 'outdoor'}},
+                    ],
+                }],
+            'status': {'status_code': 0, 'status_message': 'SUCCESS'},
+            }
+        if self.has_indoor(station_id):
+            station['stations'][0]['devices'].append(
+                    {'device_id': station_id * 10 + 2, 'serial_number': 'AR-%08d' % station_id,
+                        'device_type': 'AR', 'device_meta': {'agl': 1.0,
+                            'name': 'AR-%08d' % station_id, 'environment': 'indoor'}})
+        return station
+
+    def observation(self, station_id, now):
+        o = self.obs_st(station_id, now)
+        t = o[0]
+        elevation = self.elevation(station_id)
+        storm = 0
+        last_strike = 0
+        last_distance = 0
+        for m in range(0, 3 * 3600, INTERVAL):
+            s = self.obs_st(station_id, t - m)
+            if s[15] > 0:
+                storm += s[15]
+                if last_strike == 0:
+                    (last_strike, last_distance) = (s[0], s[14])
+
+        obs = {
+            'timestamp': t,
+            'air_temperature': o[7],
+            'barometric_pressure': o[6],
+            'station_pressure': o[6],
+            'sea_level_pressure': round(derived.sea_level(o[6], elevation), 1),
+            'relative_humidity': o[8],
+            'precip': o[12],
+            'precip_accum_last_1hr': round(self.rain_total(station_id, t - 3600 + INTERVAL, t + INTERVAL), 2),
+            'precip_accum_local_day': self.daily_rain(station_id, t),
+            'precip_accum_local_yesterday': round((station_id % 7) * 0.8, 2),
+            'wind_avg': o[2],
+            'wind_direction': o[4],
+            'wind_gust': o[3],
+            'wind_lull': o[1],
+            'solar_radiation': o[11],
+            'uv': o[10],
+            'brightness': o[9],
+            'lightning_strike_count': o[15],
+            'lightning_strike_count_last_3hr': storm,
+            'feels_like': derived.apparent_temp(o[7], o[2], o[8]),
+            'heat_index': derived.heatindex(o[7], o[8]),
+            'wind_chill': derived.windchill(o[7], o[2]),
+            'dew_point': derived.dewpoint(o[7], o[8]),
+            }
+        if last_strike != 0:
+            obs['lightning_strike_last_epoch'] = last_strike
+            obs['lightning_strike_last_distance'] = last_distance
+
+        if self.has_indoor(station_id):
+            (temp, humidity) = self.indoor_obs(station_id, t)
+            obs.update({
+                'air_temperature_indoor': temp,
+                'barometric_pressure_indoor': o[6],
+                'station_pressure_indoor': o[6],
+                'sea_level_pressure_indoor': obs['sea_level_pressure'],
+                'relative_humidity_indoor': humidity,
+                'feels_like_indoor': temp,
+                'dew_point_indoor': derived.dewpoint(temp, humidity),
+                })
+
+        units = dict(UNITS[station_id % len(UNITS)])
+        units.update({'units_direction': 'degrees', 'units_other': 'metric'})
+        data = {
+            'station_id': station_id,
+            'station_name': 'Simulated %d' % station_id,
+            'public_name': 'Simulated %d' % station_id,
+            'elevation': elevation,
+            'is_public': True,
+            'status': {'status_code': 0, 'status_message': 'SUCCESS'},
+            'station_units': units,
+            'outdoor_keys': OUTDOOR_KEYS,
+            'obs': [obs],
+            }
+        if self.has_indoor(station_id):
+            data['indoor_keys'] = INDOOR_KEYS
+        return data
+
+    def forecast(self, station_id, now):
+        """
+        10 days and 240 hours, starting with the current UTC day and
+        hour. Metric units, whatever units are asked for.
+        """
+        def chance(t):
+            return int(min(100, max(0, 100 * (self.storm(station_id, t) - 0.5) * 2)))
+
+        hour = int(now) - int(now) % 3600
+        hourly = []
+        for t in range(hour, hour + 240 * 3600, 3600):
+            hourly.append({'time': t, 'air_temperature': self.obs_st(station_id, t)[7],
+                    'precip_probability': chance(t), 'local_hour': (t % 86400) // 3600})
+
+        midnight = int(now) - int(now) % 86400
+        daily = []
+        for day in range(midnight, midnight + 10 * 86400, 86400):
+            temps = [self.obs_st(station_id, t)[7] for t in range(day, day + 86400, 3600)]
+            daily.append({'day_start_local': day, 'air_temp_high': max(temps),
+                    'air_temp_low': min(temps),
+                    'precip_probability': max([chance(t) for t in range(day, day + 86400, 3600)])})
+
+        return {
+            'station': {'station_id': station_id},
+            'current_conditions': {'time': int(now), 'air_temperature': self.obs_st(station_id, now)[7]},
+            'forecast': {'daily': daily, 'hourly': hourly},
+            'units': {'units_temp': 'c', 'units_wind': 'mps', 'units_pressure': 'mb',
+                'units_precip': 'mm', 'units_distance': 'km'},
+            }
+
+    def device(self, device_id, start, end):
+        station_id = device_id // 10
+        start = int(start) + INTERVAL - int(start) % INTERVAL
+        records = [self.obs_st(station_id, t) for t in range(start, int(end) + 1, INTERVAL)]
+        return {
+            'status': {'status_code': 0, 'status_message': 'SUCCESS'},
+            'device_id': device_id,
+            'type': 'obs_st',
+            'source': 'db',
+            'obs': records,
+            }
+
+
+class Faults(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, truncate_rate=0.0,
+            seed=1, drop_after=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.drop_after = drop_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def pick(self):
+        """ Return (delay, error, truncate) for a request. """
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            error = self.random.random() < self.error_rate
+            truncate = self.random.random() < self.truncate_rate
+            status = self.random.choice([500, 502, 503, 429])
+        return (delay, status if error else 0, truncate)
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    weather = None
+    faults = None
+    push_interval = 60.0
+    rapid_interval = 3.0
+
+    def do_GET(self):
+        if self.path.split('?')[0] == SOCKET_PATH and \
+                self.headers.get('Upgrade', '').lower() == 'websocket':
+            self.websocket()
+            return
+
+        (delay, error, truncate) = self.faults.pick()
+        if delay > 0:
+            time.sleep(delay)
+        if error:
+            self.send_json(error, {'status': {'status_code': error,
+                    'status_message': 'SIMULATED ERROR'}})
+            return
+
+        (path, query) = (self.path.split('?') + [''])[:2]
+        params = dict(p.split('=', 1) for p in query.split('&') if '=' in p)
+        now = time.time()
+
+        m = STATION_PATH.match(path)
+        if m is not None and self.weather.known(int(m.group(1))):
+            self.send_json(200, self.weather.station(int(m.group(1))), truncate)
+            return
+
+        m = OBS_PATH.match(path)
+        if m is not None and self.weather.known(int(m.group(1))):
+            data = self.weather.observation(int(m.group(1)), now)
+            etag = '"%d-%d"' % (data['station_id'], data['obs'][0]['timestamp'])
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_json(200, data, truncate, {'ETag': etag})
+            return
+
+        m = DEVICE_PATH.match(path)
+        if m is not None and self.weather.known(int(m.group(1)) // 10):
+            try:
+                start = int(params.get('time_start', now - 3600))
+                end = min(int(params.get('time_end', now)), int(now))
+            except ValueError:
+                self.send_json(400, {'status': {'status_code': 400,
+                        'status_message': 'BAD REQUEST'}})
+                return
+            self.send_json(200, self.weather.device(int(m.group(1)), start, end), truncate)
+            return
+
+        if path == FORECAST_PATH:
+            try:
+                station_id = int(params.get('station_id', ''))
+            except ValueError:
+                station_id = None
+            if station_id is not None and self.weather.known(station_id):
+                self.send_json(200, self.weather.forecast(station_id, now), truncate)
+                return
+
+        self.send_json(404, {'status': {'status_code': 404, 'status_message': 'NOT FOUND'}})
+
+    def send_json(self, status, data, truncate=False, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if headers is not None:
+            for name in headers:
+                self.send_header(name, headers[name])
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if truncate:
+            # Send part of the body and hang up
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', wfsocket.accept_key(key))
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+        ws = wfsocket.WebSocket(self.connection, mask=False)
+        ws.send(json.dumps({'type': 'connection_opened'}))
+        listening = {}     # device ID -> set of 'obs', 'rapid'
+        opened = time.time()
+        next_push = opened + self.push_interval
+        next_rapid = opened + self.rapid_interval
+        try:
+            while True:
+                now = time.time()
+                if self.faults.drop_after > 0 and (now - opened) > self.faults.drop_after:
+                    break
+
+                wait = max(0.01, min(next_push, next_rapid) - now)
+                message = ws.recv(wait)
+                if message is not None:
+                    self.listen(ws, listening, message)
+                    continue
+
+                now = time.time()
+                if now >= next_push:
+                    next_push = now + self.push_interval
+                    self.push(ws, listening, 'obs', now)
+                if now >= next_rapid:
+                    next_rapid = now + self.rapid_interval
+                    self.push(ws, listening, 'rapid', now)
+        except (OSError, wfsocket.WebSocketError):
+            pass
+        finally:
+            ws.close()
+
+    def listen(self, ws, listening, message):
+        try:
+            request = json.loads(message)
+            device_id = int(request['device_id'])
+        except (ValueError, KeyError, TypeError):
+            return
+        kind = {'listen_start': 'obs', 'listen_rapid_start': 'rapid',
+                'listen_stop': 'obs', 'listen_rapid_stop': 'rapid'}.get(request.get('type'))
+        if kind is None or not self.weather.known(device_id // 10):
+            return
+        if request['type'].endswith('_start'):
+            listening.setdefault(device_id, set()).add(kind)
+        else:
+            listening.get(device_id, set()).discard(kind)
+        ws.send(json.dumps({'type': 'ack', 'id': request.get('id')}))
+
+    def push(self, ws, listening, kind, now):
+        for device_id in sorted(listening):
+            if kind not in listening[device_id]:
+                continue
+            station_id = device_id // 10
+            o = self.weather.obs_st(station_id, now)
+            if kind == 'rapid':
+                r = random.Random(device_id * 7919 + int(now * 10))
+                ws.send(json.dumps({'type': 'rapid_wind', 'device_id': device_id,
+                        'ob': [int(now), round(max(0.0, o[2] + r.uniform(-1, 1)), 2),
+                            (o[4] + r.randint(-20, 20)) % 360]}))
+                continue
+            if device_id % 10 == 2:
+                ws.send(json.dumps({'type': 'obs_air', 'device_id': device_id,
+                        'source': 'mqtt', 'obs': [self.weather.obs_air(station_id, now)]}))
+                continue
+            ws.send(json.dumps({'type': 'obs_st', 'device_id': device_id,
+                    'source': 'mqtt', 'obs': [o]}))
+            if o[15] > 0:
+                ws.send(json.dumps({'type': 'evt_strike', 'device_id': device_id,
+                        'evt': [int(now), o[14], 3848]}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimulatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=0, stations=1000, base=1000, faults=None, address='127.0.0.1',
+        push_interval=60.0, rapid_interval=3.0, indoor=0):
+    """
+    Start a simulator in a background thread. Returns the server,
+    server.server_address has the port actually used.
+    """
+    if faults is None:
+        faults = Faults()
+    handler = type('Handler', (SimulatorHandler,), {
+            'weather': Weather(stations, base, indoor), 'faults': faults,
+            'push_interval': push_interval, 'rapid_interval': rapid_interval})
+    server = SimulatorServer((address, port), handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the WeatherFlow REST API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--stations', type=int, default=1000)
+    parser.add_argument('--base', type=int, default=1000, help='first station ID')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='seconds to delay each response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+            help='up to this many more seconds of random delay')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+            help='fraction of requests that fail with a server error')
+    parser.add_argument('--truncate-rate', type=float, default=0.0,
+            help='fraction of responses cut off part way through')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--push-interval', type=float, default=60.0,
+            help='seconds between WebSocket observations')
+    parser.add_argument('--rapid-interval', type=float, default=3.0,
+            help='seconds between WebSocket rapid wind messages')
+    parser.add_argument('--drop-after', type=float, default=0.0,
+            help='drop WebSocket connections after this many seconds')
+    parser.add_argument('--indoor', type=int, default=0,
+            help='give every Nth station an indoor AIR too')
+    args = parser.parse_args()
+
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.truncate_rate,
+            args.seed, args.drop_after)
+    server = serve(args.port, args.stations, args.base, faults, args.address,
+            args.push_interval, args.rapid_interval, args.indoor)
+    print('Simulating stations %d-%d on port %d' % (args.base,
+            args.base + args.stations - 1, server.server_address[1]))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Pressure trend tracking for the WeatherFlow node server.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import array
+
+FALLING = 0
+STEADY = 1
+RISING = 2
+
+
+class PressureTrend(object):
+    """
+    Ring buffer of (timestamp, pressure) samples covering the trend
+    window (3 hours by default).
+
+    Running sums are kept so that the least squares slope of the
+    samples in the window can be updated in constant time as samples
+    are added and expire. The trend is the change in pressure over the
+    time the samples cover, predicted by that slope. It stays steady
+    until the samples cover at least min_span seconds, so a few noisy
+    samples after a cold start don't swing it.
+    """
+    def __init__(self, window=10800, capacity=2048, threshold=1.0, min_span=1800):
+        self.window = window
+        self.min_span = min_span
+        self.capacity = capacity
+        self.threshold = threshold
+        self.times = array.array('d', [0.0] * capacity)
+        self.values = array.array('d', [0.0] * capacity)
+        self.last = 0
+        self.clear()
+
+    def clear(self):
+        self.head = 0   # index of the oldest sample
+        self.count = 0
+        self.base = None
+        self.sum_t = 0.0
+        self.sum_p = 0.0
+        self.sum_tt = 0.0
+        self.sum_tp = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def _drop_oldest(self):
+        t = self.times[self.head]
+        p = self.values[self.head]
+        self.sum_t -= t
+        self.sum_p -= p
+        self.sum_tt -= t * t
+        self.sum_tp -= t * p
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        if self.count == 0:
+            self.clear()
+
+    def _rebase(self):
+        # Times are stored relative to a base time to keep the sums
+        # small. Move the base up to the oldest sample and rebuild the
+        # sums, which also clears any accumulated rounding error.
+        shift = self.times[self.head]
+        self.base += shift
+        self.sum_t = self.sum_p = self.sum_tt = self.sum_tp = 0.0
+        for i in range(self.count):
+            idx = (self.head + i) % self.capacity
+            t = self.times[idx] - shift
+            p = self.values[idx]
+            self.times[idx] = t
+            self.sum_t += t
+            self.sum_p += p
+            self.sum_tt += t * t
+            self.sum_tp += t * p
+
+    def add(self, timestamp, pressure):
+        # Samples have to be added in time order, anything older than
+        # the last sample has already been counted.
+        if timestamp <= self.last:
+            return
+        self.last = timestamp
+
+        if self.base is None:
+            self.base = float(timestamp)
+
+        t = timestamp - self.base
+
+        # Expire samples that are now outside the window
+        while self.count > 0 and self.times[self.head] < t - self.window:
+            self._drop_oldest()
+        if self.count == self.capacity:
+            self._drop_oldest()
+
+        if self.base is None:
+            self.base = float(timestamp)
+            t = 0.0
+        elif self.count > 0 and self.times[self.head] > 2 * self.window:
+            self._rebase()
+            t = timestamp - self.base
+
+        idx = (self.head + self.count) % self.capacity
+        self.times[idx] = t
+        self.values[idx] = pressure
+        self.count += 1
+        self.sum_t += t
+        self.sum_p += pressure
+        self.sum_tt += t * t
+        self.sum_tp += t * pressure
+
+    def slope(self):
+        """ Pressure change per second, or None with too few samples. """
+        if self.count < 2:
+            return None
+        d = (self.count * self.sum_tt) - (self.sum_t * self.sum_t)
+        if d <= 0:
+            return None
+        return ((self.count * self.sum_tp) - (self.sum_t * self.sum_p)) / d
+
+    def span(self):
+        """ Seconds between the oldest and newest samples. """
+        if self.count == 0:
+            return 0.0
+        newest = (self.head + self.count - 1) % self.capacity
+        return self.times[newest] - self.times[self.head]
+
+    def change(self):
+        """ Predicted pressure change over the time the samples cover. """
+        span = self.span()
+        if span < self.min_span:
+            return 0.0
+        s = self.slope()
+        if s is None:
+            return 0.0
+        return s * span
+
+    def trend(self):
+        c = self.change()
+        if c < -self.threshold:
+            return FALLING
+        elif c > self.threshold:
+            return RISING
+        return STEADY
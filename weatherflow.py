@@ -10,49 +10,648 @@ except ImportError:
     import pgc_interface as polyinterface
     CLOUD = True
 import sys
+import os
 import time
-import datetime
-import urllib3
+import logging
 import json
 import socket
-import math
+import random
+import re
+import copy
 import threading
+import concurrent.futures
+import urllib.parse
+import derived
+import forecast
+import trend
+import rainstore
+import backfill
+import history
+import stationcache
+import wfhttp
+import logutil
+import metrics
+import scheduler
+import shard
+import strikes
+import windstats
+import wfsocket
 
 LOGGER = polyinterface.LOGGER
 
+# Node types created for each station. Long names are used for the
+# node addresses when only one station is configured (this keeps the
+# addresses compatible with older versions), short names are combined
+# with the station ID when multiple stations are configured so that
+# the address fits in the 14 characters ISY allows.
+NODE_TYPES = [
+        ('temperature', 'temp'),
+        ('humidity', 'hum'),
+        ('pressure', 'press'),
+        ('wind', 'wind'),
+        ('rain', 'rain'),
+        ('light', 'light'),
+        ('lightning', 'strike'),
+        ]
+# Nodes for the indoor device of a station that has both indoor and
+# outdoor devices, (name, short name, single station address). With only
+# an indoor device, its data goes to the regular nodes.
+INDOOR_NODE_TYPES = [
+        ('temperature', 'itemp', 'indoortemp'),
+        ('humidity', 'ihum', 'indoorhum'),
+        ('pressure', 'ipress', 'indoorpress'),
+        ]
+# Forecast nodes, one for the next hours and one for each day of the
+# Forecast Days parameter.
+MAX_FORECAST_DAYS = 10
+FORECAST_NODE_TYPES = [('hourly', 'fch')] + \
+        [('forecast%d' % d, 'fc%d' % d) for d in range(MAX_FORECAST_DAYS)]
+
+# Local UDP broadcast messages from the hub. For each message type, the
+# list maps an index in the message's observation array to the node and
+# driver that value is published to.  Values are in the same units as
+# the REST API observations.
+UDP_PORT = 50222
+UDP_MAP = {
+        'obs_st': ('obs', [
+            (1, 'wind', 'GV2'),          # lull
+            (2, 'wind', 'ST'),           # average
+            (3, 'wind', 'GV1'),          # gust
+            (4, 'wind', 'GV0'),          # direction
+            (6, 'pressure', 'ST'),       # station pressure
+            (7, 'temperature', 'ST'),
+            (8, 'humidity', 'ST'),
+            (9, 'light', 'GV1'),         # illuminance
+            (10, 'light', 'ST'),         # uv
+            (11, 'light', 'GV0'),        # solar radiation
+            (12, 'rain', 'ST'),          # rain over previous minute
+            (14, 'lightning', 'GV0'),    # average strike distance
+            (15, 'lightning', 'ST'),     # strike count
+            ]),
+        'obs_air': ('obs', [
+            (1, 'pressure', 'ST'),
+            (2, 'temperature', 'ST'),
+            (3, 'humidity', 'ST'),
+            (4, 'lightning', 'ST'),
+            (5, 'lightning', 'GV0'),
+            ]),
+        'obs_sky': ('obs', [
+            (1, 'light', 'GV1'),
+            (2, 'light', 'ST'),
+            (3, 'rain', 'ST'),
+            (4, 'wind', 'GV2'),
+            (5, 'wind', 'ST'),
+            (6, 'wind', 'GV1'),
+            (7, 'wind', 'GV0'),
+            (10, 'light', 'GV0'),
+            ]),
+        'rapid_wind': ('ob', [
+            (1, 'wind', 'ST'),
+            (2, 'wind', 'GV0'),
+            ]),
+        'evt_strike': ('evt', [
+            (1, 'lightning', 'GV0'),
+            ]),
+        'evt_precip': ('evt', []),
+        }
+# Index of the wind speed and direction in the messages that have them
+WIND_FIELDS = {
+        'obs_st': (2, 4),
+        'obs_sky': (5, 7),
+        'rapid_wind': (1, 2),
+        }
+
+# Used to peek at the observation time without decoding the whole response
+OBS_TIMESTAMP = re.compile(rb'"timestamp"\s*:\s*(\d+)')
+
+
+# Unit conversions. Values come from WeatherFlow in metric units and are
+# converted to the user's preferred units before being published.
+def same_units(v):
+    return v
+
+def round_1(v):
+    return round(v, 1)
+
+def c_to_f(v):
+    return round((v * 1.8) + 32, 1)
+
+def mb_to_inhg(v):
+    return round(v * 0.02952998751, 3)
+
+def ms_to_kph(v):
+    return round(v * (18 / 5), 3)
+
+def ms_to_mph(v):
+    return round(round(v * (18 / 5), 3) / 1.609344, 2)
+
+def mm_to_in(v):
+    return round(v * 0.03937, 2)
+
+def km_to_mi(v):
+    return round(v / 1.609344, 1)
+
+def all_units(convert, uom):
+    return {'metric': (convert, uom), 'uk': (convert, uom), 'us': (convert, uom)}
+
+
+def outside_deadband(previous, value, deadband):
+    """
+    Check a new value against the (value, time) last published, None if
+    nothing was. It has to move by more than the deadband.
+    """
+    if previous is None:
+        return True
+
+    last = previous[0]
+    try:
+        return abs(value - last) >= deadband
+    except TypeError:
+        return value != last
+
+
+def republish_due(previous, republish, now=None):
+    """ True if at least republish seconds have passed since previous was published. """
+    if previous is None:
+        return True
+    if now is None:
+        now = time.time()
+    return (now - previous[1]) >= republish
+
+
+def should_publish(previous, value, deadband, republish):
+    return outside_deadband(previous, value, deadband) and republish_due(previous, republish)
+
+# For each kind of value, the conversion function and uom to use for each
+# unit system.
+CONVERSIONS = {
+        'temperature': {
+            'metric': (round_1, 4),
+            'uk': (round_1, 4),
+            'us': (c_to_f, 17)},
+        'pressure': {
+            'metric': (same_units, 117),
+            'uk': (same_units, 117),
+            'us': (mb_to_inhg, 23)},
+        'speed': {
+            'metric': (ms_to_kph, 32),
+            'uk': (ms_to_mph, 48),
+            'us': (ms_to_mph, 48)},
+        'rainrate': {
+            'metric': (same_units, 46),
+            'uk': (same_units, 46),
+            'us': (mm_to_in, 24)},
+        'rain': {
+            'metric': (same_units, 82),
+            'uk': (same_units, 82),
+            'us': (mm_to_in, 105)},
+        'distance': {
+            'metric': (same_units, 83),
+            'uk': (km_to_mi, 116),
+            'us': (km_to_mi, 116)},
+        'density': all_units(same_units, 56),
+        'humidity': all_units(same_units, 22),
+        'trend': all_units(same_units, 25),
+        'direction': all_units(same_units, 76),
+        'uv': all_units(same_units, 71),
+        'radiation': all_units(same_units, 74),
+        'lux': all_units(same_units, 36),
+        'count': all_units(same_units, 56),
+        'percent': all_units(same_units, 51),
+        'minutes': all_units(same_units, 45),
+        }
+
+# Maps REST API observation keys to the node and driver they are
+# published to. Indoor observations use the same keys with an _indoor
+# suffix.
+OBS_MAP = [
+        ('air_temperature', 'temperature', 'ST'),
+        ('barometric_pressure', 'pressure', 'ST'),
+        ('sea_level_pressure', 'pressure', 'GV0'),
+        ('relative_humidity', 'humidity', 'ST'),
+        ('precip', 'rain', 'ST'),
+        ('precip_accum_last_1hr', 'rain', 'GV0'),
+        ('precip_accum_local_day', 'rain', 'GV1'),
+        ('precip_accum_local_yesterday', 'rain', 'GV2'),
+        ('wind_avg', 'wind', 'ST'),
+        ('wind_direction', 'wind', 'GV0'),
+        ('wind_gust', 'wind', 'GV1'),
+        ('wind_lull', 'wind', 'GV2'),
+        ('uv', 'light', 'ST'),
+        ('solar_radiation', 'light', 'GV0'),
+        ('brightness', 'light', 'GV1'),
+        ('lightning_strike_last_3hr', 'lightning', 'ST'),
+        ('lightning_strike_last_distance', 'lightning', 'GV0'),
+        ('feels_like', 'temperature', 'GV0'),
+        ('dew_point', 'temperature', 'GV1'),
+        ('heat_index', 'temperature', 'GV2'),
+        ('wind_chill', 'temperature', 'GV3'),
+        ('wet_bulb_temperature', 'temperature', 'GV4'),
+        ('delta_t', 'temperature', 'GV5'),
+        ('air_density', 'temperature', 'GV6'),
+        ]
+# Observation key suffix and the field listing the keys present, for
+# the outdoor and indoor devices.
+KEY_SETS = [('', 'outdoor_keys'), ('_indoor', 'indoor_keys')]
+# Keys of the values that feed the pressure trend, rain totals and wind
+# statistics, for each key set.
+STATE_KEYS = dict([(suffix, ('barometric_pressure' + suffix, 'precip' + suffix,
+        'wind_avg' + suffix, 'wind_direction' + suffix)) for (suffix, field) in KEY_SETS])
+
+# The node drivers saved in the local observation history, in the order
+# they are stored.
+HISTORY_FIELDS = []
+for (key, name, driver) in OBS_MAP:
+    if (name, driver) not in HISTORY_FIELDS:
+        HISTORY_FIELDS.append((name, driver))
+HISTORY_SLOTS = dict([(f, i) for (i, f) in enumerate(HISTORY_FIELDS)])
+HISTORY_DIR = 'history'
+STATION_CACHE = os.path.join('cache', 'stations.json')
+STATION_TTL = 86400
+SERVER_URL = 'https://swd.weatherflow.com'
+SOCKET_URL = 'wss://ws.weatherflow.com/swd/data'
+SOCKET_STALE = 180         # reconnect if nothing arrives for this long
+SOCKET_BACKOFF_MAX = 300
+SHUTDOWN_TIMEOUT = 10.0    # longest we'll wait for threads when stopping
+DEADLINE_GRACE = 1.0       # time past the deadline before giving up on a fetch
+POLL_TICK = 0.25           # how often a poll checks the fetch deadlines
+FORECAST_TICK = 60         # seconds between forecast node updates
+# Observation values that mean it's raining or there's lightning. The
+# station is checked more often while they are non-zero.
+ACTIVE_KEYS = ['precip', 'lightning_strike_count', 'lightning_strike_count_last_1hr']
+ACTIVE_KEYS += [key + '_indoor' for key in ACTIVE_KEYS]
+DEVICE_TIMEOUT = 86400     # forget a device we haven't heard from for this long
+
+# Performance metrics, served by the optional metrics endpoint
+POLL_TIME = metrics.REGISTRY.histogram('weatherflow_poll_seconds',
+        'Time to query and process all stations')
+HTTP_LATENCY = metrics.REGISTRY.histogram('weatherflow_http_request_seconds',
+        'Time to get a station observation from the WeatherFlow servers')
+DECODE_TIME = metrics.REGISTRY.histogram('weatherflow_json_decode_seconds',
+        'Time to decode a station observation')
+OBS_TIME = metrics.REGISTRY.histogram('weatherflow_obs_data_seconds',
+        'Time to process an observation', ('source',))
+PUBLISHES = metrics.REGISTRY.counter('weatherflow_driver_updates_total',
+        'Driver updates sent to the ISY', ('node',))
+
+
+class Station(object):
+    """
+    Per-station state. Holds the station metadata we get from
+    WeatherFlow and maps the generic node names (temperature, wind, ...)
+    to the node addresses used for this station.
+    """
+    def __init__(self, station_id, multi=False):
+        self.id = station_id
+        self.multi = multi
+        self.agl = 0.0
+        self.elevation = 0.0
+        self.units = 'metric'
+        self.hub_timestamp = 0
+        self.serials = []
+        self.devices = []
+        # Used to skip observations we've already processed
+        self.last_obs = 0
+        self.etag = None
+        self.last_modified = None
+        self.skipped = 0
+        # When to fetch the next observation
+        self.cadence = scheduler.Cadence()
+        # Set while a fetch is queued or running, and when it started
+        self.fetching = False
+        self.fetch_started = None
+        # OBS_MAP compiled for this station's nodes and units
+        self.obs_map = {}
+        self.obs_keys = {}
+        # Latest value of each HISTORY_FIELDS entry and the history file
+        self.values = [float('nan')] * len(HISTORY_FIELDS)
+        self.history = None
+        # Set once the metadata refresh and backfill have finished
+        self.ready = False
+        # Set when the station has both indoor and outdoor devices and
+        # the indoor device has its own nodes. Only the outdoor values
+        # are kept in the history.
+        self.indoor = False
+        self.indoor_values = [float('nan')] * len(HISTORY_FIELDS)
+        # Device IDs and serial numbers of the indoor devices, from the
+        # metadata. Their UDP and WebSocket messages go to the indoor
+        # nodes.
+        self.indoor_devices = []
+        # When each key set was last in an observation
+        self.seen = {}
+        self.addresses = {}
+        for (name, short) in NODE_TYPES:
+            if multi:
+                self.addresses[name] = '{}_{}'.format(station_id, short)[:14]
+            else:
+                self.addresses[name] = name
+        self.indoor_addresses = {}
+        for (name, short, single) in INDOOR_NODE_TYPES:
+            if multi:
+                self.indoor_addresses[name] = '{}_{}'.format(station_id, short)[:14]
+            else:
+                self.indoor_addresses[name] = single
+        self.forecast_addresses = {}
+        for (name, short) in FORECAST_NODE_TYPES:
+            if multi:
+                self.forecast_addresses[name] = '{}_{}'.format(station_id, short)[:14]
+            else:
+                self.forecast_addresses[name] = name
+
+    def to_meta(self):
+        return {
+                'agl': self.agl,
+                'elevation': self.elevation,
+                'units': self.units,
+                'serials': self.serials,
+                'devices': self.devices,
+                'indoor': self.indoor,
+                'indoor_devices': self.indoor_devices,
+                }
+
+    def from_meta(self, meta):
+        self.agl = meta['agl']
+        self.elevation = meta['elevation']
+        self.units = meta['units']
+        self.serials = list(meta['serials'])
+        self.devices = [tuple(d) for d in meta['devices']]
+        self.indoor = self.indoor or meta.get('indoor', False)
+        self.indoor_devices = list(meta.get('indoor_devices', []))
+
+    def address(self, name, indoor=False):
+        if indoor:
+            return self.indoor_addresses.get(name)
+        return self.addresses[name]
+
+    def all_addresses(self):
+        return list(self.addresses.values()) + \
+                list(self.indoor_addresses.values()) + \
+                list(self.forecast_addresses.values())
+
+    def mixed(self):
+        """ True if the metadata lists both indoor and outdoor sensor devices. """
+        sensors = [d for (d, t) in self.devices if t in ('ST', 'AR', 'SK')]
+        indoor = [d for d in sensors if d in self.indoor_devices]
+        return 0 < len(indoor) < len(sensors)
+
+    def indoor_message(self, data):
+        """ True if a UDP or WebSocket message is for the indoor nodes. """
+        if not self.indoor:
+            return False
+        return data.get('device_id') in self.indoor_devices or \
+                data.get('serial_number') in self.indoor_devices
+
+    def last_seen(self, now):
+        """
+        When we last heard from the station. With indoor and outdoor
+        devices, when we last heard from the one that's been quiet
+        longest.
+        """
+        seen = [t for t in self.seen.values() if (now - t) < DEVICE_TIMEOUT]
+        return min([self.hub_timestamp] + seen)
+
+    def label(self, name):
+        if self.multi:
+            return '{} {}'.format(name, self.id)
+        return name
+
+
+def get_observation(http, station, deadline, capture):
+    """
+    Get a station's latest observation response.
+
+    Returns None when the station has no new observation since the
+    last one we processed.  If the server supports conditional
+    requests, an unchanged observation isn't even downloaded.
+    Otherwise we peek at the observation timestamp before the response
+    is decoded.
+
+    A new observation is returned as (data, validators). The caller
+    saves the validators (ETag and Last-Modified) with
+    save_validators() once the observation has been processed, so an
+    observation that's dropped is fetched again.
+    """
+    path_str = '/swd/rest/observations/station/'
+    path_str += station.id
+    path_str += '?api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
+
+    headers = {}
+    if station.etag is not None:
+        headers['If-None-Match'] = station.etag
+    if station.last_modified is not None:
+        headers['If-Modified-Since'] = station.last_modified
+
+    c = http.request('GET', path_str, headers=headers, deadline=deadline)
+    try:
+        if c.status == 304:
+            return None
+
+        validators = (c.headers.get('ETag'), c.headers.get('Last-Modified'))
+        capture.write('rest', c.data)
+
+        m = OBS_TIMESTAMP.search(c.data)
+        if m is not None and station.last_obs != 0 and int(m.group(1)) == station.last_obs:
+            # Already processed this one
+            save_validators(station, validators)
+            return None
+        return (c.data, validators)
+    finally:
+        c.close()
+
+
+def save_validators(station, validators):
+    if validators is not None:
+        (station.etag, station.last_modified) = validators
+
+
+class StationShard(object):
+    """
+    Runs in a shard worker process (see shard.py). Fetches, decodes and
+    converts the observations of the stations the worker owns and
+    returns only what the main process needs:
+
+        (latency, None) when there's no new observation, otherwise
+        (latency, (timestamp, active, suffixes, values, updates, missing))
+
+    suffixes are the KEY_SETS in the observation, empty when there's no
+    observation data. values is a list of (suffix, HISTORY_FIELDS slot,
+    value) in WeatherFlow's units, updates the (suffix, node name,
+    driver, value, uom) to publish after conversion and deadbands,
+    missing the observation keys that weren't in the data.
+    """
+    def __init__(self, server_url, deadline, deadbands, republish, capture=None):
+        self.server_url = server_url
+        self.deadline = deadline
+        self.deadbands = deadbands
+        self.republish = republish
+        self.capture_dir = capture
+
+    def setup(self, index):
+        url = urllib.parse.urlsplit(self.server_url)
+        self.http = wfhttp.WeatherFlowClient(url.hostname, maxsize=2,
+                secure=(url.scheme == 'https'), port=url.port)
+        self.capture = logutil.Capture(self.capture_dir)
+        self.source = 'rest-%d' % index
+        self.stations = {}
+        self.published = {}
+        self.held = {}
+        self.tables = {}
+
+    def fetch(self, station):
+        return get_observation(self.http, station, self.deadline, self.capture)
+
+    def table(self, units):
+        """
+        OBS_MAP for both key sets, with each driver's conversion, uom
+        and deadband, and the keys of each set.
+        """
+        if units not in self.tables:
+            table = {}
+            keys = {}
+            for (suffix, field) in KEY_SETS:
+                keys[suffix] = []
+                for (obs_key, name, driver) in OBS_MAP:
+                    cls = NODE_CLASSES[name]
+                    (convert, uom) = CONVERSIONS[cls.conversions[driver]][units]
+                    deadband = self.deadbands.get((cls.id, driver), cls.deadbands.get(driver, 0))
+                    table[obs_key + suffix] = (suffix, name, driver, convert, uom,
+                            HISTORY_SLOTS[(name, driver)], deadband)
+                    keys[suffix].append(obs_key + suffix)
+            self.tables[units] = (table, keys)
+        return self.tables[units]
+
+    def poll(self, station_id, units):
+        station = self.stations.get(station_id)
+        if station is None:
+            station = Station(station_id)
+            self.stations[station_id] = station
+        if station.units != units:
+            # Republish everything in the new units
+            station.units = units
+            self.published[station_id] = {}
+            self.held[station_id] = {}
+        published = self.published.setdefault(station_id, {})
+        # Changes held back by the republish interval
+        held = self.held.setdefault(station_id, {})
+
+        start = time.time()
+        response = self.fetch(station)
+        latency = time.time() - start
+        if response is None:
+            return (latency, None)
+
+        (raw, validators) = response
+        data = json.loads(raw)
+        save_validators(station, validators)
+        timestamp = Controller.obs_timestamp(data)
+        if timestamp != 0 and timestamp == station.last_obs:
+            return (latency, None)
+        station.last_obs = timestamp
+        active = Controller.active_weather(data)
+
+        suffixes = []
+        if len(data.get('obs') or []) > 0:
+            suffixes = [suffix for (suffix, field) in KEY_SETS if len(data.get(field) or []) > 0]
+        if len(suffixes) == 0:
+            return (latency, (timestamp, active, suffixes, [], [], []))
+
+        obs = data['obs'][0]
+        (table, keys) = self.table(units)
+        values = []
+        updates = []
+        found = 0
+        now = time.time()
+        for key in obs:
+            entry = table.get(key)
+            if entry is None:
+                continue
+            found += 1
+            (suffix, name, driver, convert, uom, slot, deadband) = entry
+            value = obs[key]
+            if value is None:
+                continue
+            values.append((suffix, slot, value))
+            previous = published.get((suffix, name, driver))
+            if not outside_deadband(previous, value, deadband) or \
+                    (previous is not None and previous[0] == value and
+                     not republish_due(previous, self.republish, now)):
+                held.pop((suffix, name, driver), None)
+            elif not republish_due(previous, self.republish, now):
+                held[(suffix, name, driver)] = (value, convert, uom)
+            else:
+                held.pop((suffix, name, driver), None)
+                published[(suffix, name, driver)] = (value, now)
+                updates.append((suffix, name, driver, convert(value), uom))
+        for (key, (value, convert, uom)) in list(held.items()):
+            if republish_due(published.get(key), self.republish, now):
+                del held[key]
+                published[key] = (value, now)
+                updates.append(key + (convert(value), uom))
+
+        missing = []
+        if found < sum([len(keys[suffix]) for suffix in suffixes]):
+            for suffix in suffixes:
+                missing.extend([key for key in keys[suffix] if key not in obs])
+        return (latency, (timestamp, active, suffixes, values, updates, missing))
+
+
 class Controller(polyinterface.Controller):
     def __init__(self, polyglot):
         super(Controller, self).__init__(polyglot)
         self.name = 'WeatherFlow'
         self.address = 'hub'
         self.primary = self.address
-        self.stopping = False
-        self.stopped = True
+        # Set when the node server is stopping, the background threads
+        # wait on it instead of sleeping.
+        self.stop_event = threading.Event()
+        self.stop_lock = threading.Lock()
+        self.stopped = False
+        self.threads = []
         self.myConfig = {
                 'Station': '<Station ID>'
                 }
-        self.rain_data = {
-                'hourly': 0,
-                'hour' : 0,
-                'daily': 0,
-                'day': 0,
-                'weekly': 0,
-                'week': 0,
-                'monthly': 0,
-                'month': 0,
-                'yearly': 0,
-                'year': 0,
-                'yesterday': 0,
-                }
+        self.rain_store = rainstore.RainStore()
         self.hb = 0
         self.hub_timestamp = 0
         self.station = ''
+        self.stations = {}
         self.default = "<station ID>"
         self.agl = 0.0
         self.elevation = 0.0
         self.configured = False
         self.started = False
         self.http = None 
+        self.pool = None
+        self.workers = 4
+        self.pool_size = 5
+        self.server_url = SERVER_URL
+        self.deadline = 20.0
+        self.source = 'cloud'
+        self.udp_port = UDP_PORT
+        self.udp_thread = None
+        self.serials = {}
+        self.device_ids = {}
+        self.socket_thread = None
+        self.socket_connected = False
+        self.poll_lock = threading.Lock()
+        self.deadbands = {}
+        self.republish = 0
+        self.batch = threading.local()
+        self.history_days = 7
+        self.cache = stationcache.StationCache(STATION_CACHE, STATION_TTL)
+        self.server_status = wfhttp.CLOSED
+        self.limiter = logutil.LogLimiter(LOGGER)
+        self.capture = logutil.Capture()
+        self.metrics_port = 0
+        self.metrics_server = None
+        self.publishes = 0
+        self.shards = 0
+        self.shard_pool = None
+        self.shard_restarts = 0
+        # Fetches that missed their deadline but are still running
+        self.abandoned = set()
+        self.forecast_days = 0
+        self.forecasts = forecast.ForecastCache()
         self.poly.onConfig(self.process_config)
         self.poly.onStop(self.my_stop)
 
@@ -67,6 +666,12 @@ class Controller(polyinterface.Controller):
                 if self.myConfig['Station'] != config['customParams']['Station']:
                     self.myConfig['Station'] = config['customParams']['Station']
                     self.station = config['customParams']['Station']
+                    # Wait for a poll in progress, it uses the stations
+                    with self.poll_lock:
+                        old = self.stations
+                        self.set_stations(self.station)
+                        self.cache.prune(self.stations)
+                        self.apply_stations(old)
                     changed = True
                     LOGGER.info('station exist and is changed')
 
@@ -80,37 +685,182 @@ class Controller(polyinterface.Controller):
                     self.configured = False
                 self.addNotice(notices)
 
+    def set_stations(self, station_param):
+        """
+        The Station parameter can hold a single station ID or a comma
+        separated list of station IDs.  Build the per-station state for
+        each, keeping any state we already have for stations that are
+        still in the list.
+        """
+        ids = [sid.strip() for sid in station_param.split(',') if sid.strip() != '']
+        multi = len(ids) > 1
+        stations = {}
+        for sid in ids:
+            if sid in self.stations and self.stations[sid].multi == multi:
+                stations[sid] = self.stations[sid]
+            else:
+                stations[sid] = Station(sid, multi)
+        self.stations = stations
+
+    def apply_stations(self, old):
+        """
+        After a change to the Station parameter, set up the stations
+        that were added the same way start() does and clean up after
+        the ones that were removed. Going between one and more than one
+        station changes the node addresses, so that replaces them all.
+        """
+        added = [st for st in self.stations.values() if old.get(st.id) is not st]
+        removed = [st for st in old.values() if self.stations.get(st.id) is not st]
+
+        keep = set()
+        for station in self.stations.values():
+            keep.update(station.all_addresses())
+        for station in removed:
+            LOGGER.info('Removing station %s', station.id)
+            if station.history is not None:
+                station.history.close()
+                station.history = None
+            for address in station.all_addresses():
+                if address in self.nodes and address not in keep:
+                    self.delNode(address)
+        self.serials = dict([(k, st) for (k, st) in self.serials.items() if st not in removed])
+        self.device_ids = dict([(k, st) for (k, st) in self.device_ids.items() if st not in removed])
+        self.rain_store.prune(self.stations)
+
+        if len(added) == 0:
+            return
+        self.resize_pool()
+        now = int(time.time())
+        for station in added:
+            LOGGER.info('Adding station %s', station.id)
+            self.load_station(station)
+            station.hub_timestamp = now
+            self.add_station_nodes(station)
+            self.open_station_history(station)
+        self.start_refresh(True, added)
+
     def query_wf(self):
         """
         We need to call this after we get the customParams because
         we need the station number. 
+
+        Station metadata comes from the cache so nodes can be created
+        without waiting on the network. Stations that aren't cached
+        start out with the configured units until refresh_stations()
+        gets their metadata.
         """
-        if self.station == "":
+        if len(self.stations) == 0:
             LOGGER.info('no station defined, skipping lookup.')
             return
 
+        for sid in self.stations:
+            self.load_station(self.stations[sid])
+
+    def load_station(self, station):
+        meta = self.cache.get(station.id)
+        if meta is not None:
+            station.from_meta(meta)
+            for serial in station.serials:
+                self.serials[serial] = station
+            for (device_id, device_type) in station.devices:
+                self.device_ids[device_id] = station
+        else:
+            station.units = self.units
+
+    def start_thread(self, target, *args):
+        """ Start a background thread that shutdown() waits for. """
+        self.threads = [t for t in self.threads if t.is_alive()]
+        t = threading.Thread(target=target, args=args)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+        return t
+
+    def start_refresh(self, backfill, stations=None):
+        self.start_thread(self.refresh_stations, backfill, stations)
+
+    def refresh_stations(self, backfill=True, stations=None):
+        """
+        Runs in the background. Refresh any station metadata that is
+        missing or expired, then backfill missed observations. Does all
+        the stations unless a list of stations is given.
+        """
+        if stations is None:
+            stations = list(self.stations.values())
+        for station in stations:
+            sid = station.id
+            if self.stop_event.is_set():
+                station.ready = True
+                continue
+            try:
+                # Metadata cached by older versions doesn't say which
+                # devices are indoor.
+                meta = self.cache.get(sid)
+                if self.cache.expired(sid) or meta is None or 'indoor_devices' not in meta:
+                    units = station.units
+                    if self.query_station_info(station):
+                        if station.mixed() and not station.indoor:
+                            self.add_indoor(station)
+                        self.cache.put(sid, station.to_meta())
+                        if station.units != units:
+                            self.set_station_units(station)
+                if backfill:
+                    self.backfill_station(station)
+            except Exception as e:
+                LOGGER.error('Refresh failed for station %s: %s', sid, str(e))
+            finally:
+                station.ready = True
+
+        try:
+            self.cache.prune(self.stations)
+            self.cache.save()
+        except Exception as e:
+            LOGGER.error('Failed to save station cache: %s', str(e))
+
+    def set_station_units(self, station):
+        LOGGER.info('Station %s units changed to %s', station.id, station.units)
+        for address in station.all_addresses():
+            if address in self.nodes:
+                self.nodes[address].SetUnits(station.units)
+                self.nodes[address].published = {}
+                self.nodes[address].pending = {}
+        self.compile_obs_map(station)
+
+    def query_station_info(self, station):
         path_str = '/swd/rest/stations/'
-        path_str += self.station
+        path_str += station.id
         path_str += '?api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
 
         try:
-            #http = urllib3.HTTPConnectionPool('swd.weatherflow.com', maxsize=1)
-
             # Get station meta data. We really want AIR height above ground
-            c = self.http.request('GET', path_str)
-            awdata = json.loads(c.data.decode('utf-8'))
+            c = self.http.request('GET', path_str, deadline=self.deadline)
+            awdata = json.loads(c.data)
+            station.serials = []
+            station.devices = []
+            station.indoor_devices = []
             for device in awdata['stations'][0]['devices']:
                 if device['device_type'] == 'AR':
-                    self.agl = float(device['device_meta']['agl'])
+                    station.agl = float(device['device_meta']['agl'])
+                indoor = (device.get('device_meta') or {}).get('environment') == 'indoor'
+                if 'device_id' in device:
+                    station.devices.append((device['device_id'], device['device_type']))
+                    self.device_ids[device['device_id']] = station
+                    if indoor:
+                        station.indoor_devices.append(device['device_id'])
+                if 'serial_number' in device:
+                    station.serials.append(device['serial_number'])
+                    self.serials[device['serial_number']] = station
+                    if indoor:
+                        station.indoor_devices.append(device['serial_number'])
             c.close()
 
             # Get station observations. Pull Elevation and user unit prefs.
             path_str = '/swd/rest/observations/station/'
-            path_str += self.station
+            path_str += station.id
             path_str += '?api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
-            c = self.http.request('GET', path_str)
+            c = self.http.request('GET', path_str, deadline=self.deadline)
 
-            awdata = json.loads(c.data.decode('utf-8'))
+            awdata = json.loads(c.data)
 
             # TODO: check user preference for units and set accordingly
             # Check distance & temp
@@ -122,27 +872,27 @@ class Controller(polyinterface.Controller):
 
             if temp_unit == 'f' and dist_unit == 'mi':
                 LOGGER.info('WF says units are US')
-                self.units = 'us'
+                station.units = 'us'
             elif temp_unit == 'c' and dist_unit == 'mi':
                 LOGGER.info('WF says units are UK')
-                self.units = 'uk'
+                station.units = 'uk'
             else:
                 LOGGER.info('WF says units are metric')
-                self.units = 'metric'
+                station.units = 'metric'
 
-            self.elevation = float(awdata['elevation'])
+            station.elevation = float(awdata['elevation'])
 
             # obs is array of dictionaries. Array index 0 is what we want
             # to get current daily and yesterday daily rainfall values
 
             if 'obs' in awdata:
                 if 'precip_accum_local_day' in awdata['obs'][0]:
-                    LOGGER.info('daily rainfall = %f' %
+                    LOGGER.info('daily rainfall = %f',
                         awdata['obs'][0]['precip_accum_local_day'])
                 else:
                     LOGGER.info('Missing local day rainfall acummulation.')
                 if 'precip_accum_local_yesterday' in awdata['obs'][0]:
-                    LOGGER.info('yesterday rainfall = %f' %
+                    LOGGER.info('yesterday rainfall = %f',
                         awdata['obs'][0]['precip_accum_local_yesterday'])
                 else:
                     LOGGER.info('Missing local yesterday rainfall acummulation.')
@@ -152,27 +902,60 @@ class Controller(polyinterface.Controller):
             c.close()
 
         except Exception as e:
-            LOGGER.error('Bad: %s' % str(e))
+            LOGGER.error('Bad: %s', str(e))
+            return False
+
+        return True
 
 
     def start(self):
         LOGGER.info('Starting WeatherFlow Node Server')
-        self.http = urllib3.HTTPConnectionPool('swd.weatherflow.com', maxsize=1)
+        self.stop_event.clear()
+        self.stopped = False
         self.configured = self.check_params()
+        self.start_pool()
+        if self.shards > 0:
+            self.start_shards()
+        self.cache.load()
         self.discover()
         self.hub_timestamp = int(time.time())
+        for sid in self.stations:
+            self.stations[sid].hub_timestamp = self.hub_timestamp
+        self.open_history()
+        self.start_metrics()
+        self.start_refresh(True)
+        if self.forecast_days > 0:
+            self.start_thread(self.forecast_worker)
         self.started = True
 
+        if self.source == 'udp':
+            self.udp_thread = self.start_thread(self.udp_listener)
+        elif self.source == 'websocket':
+            self.socket_thread = self.start_thread(self.socket_listener)
+
         #for node in self.nodes:
         #       LOGGER.info (self.nodes[node].name + ' is at index ' + node)
         LOGGER.info('WeatherFlow Node Server Started.')
 
     def shortPoll(self):
-        pass
+        # Poll WF servers for the stations that should have a new
+        # observation by now. When listening for the local hub
+        # broadcasts or on the WebSocket, the data arrives on its own.
+        # If the WebSocket is down, poll until it's back.
+        if self.stop_event.is_set():
+            return
+        if self.source == 'cloud' or (self.source == 'websocket' and not self.socket_connected):
+            self.poll_due()
+        self.expire_strikes()
+        self.publish_pending()
 
     def longPoll(self):
-        # Poll WF servers for current observation data
-        self.query_data()
+        if self.stop_event.is_set():
+            return
+        self.save_rain()
+        self.set_server_status()
+        self.log_traffic()
+        self.set_metrics()
         self.heartbeat()
         self.set_hub_timestamp()
 
@@ -191,69 +974,202 @@ class Controller(polyinterface.Controller):
                 - Precipitation (rate, hourly, daily, weekly, monthly, yearly)
                 - Light (UV, solar radiation, lux)
                 - Lightning (strikes, distance)
+                - Forecast (hourly and daily, with the Forecast Days parameter)
         """
 
         self.query_wf()
 
-        node = TemperatureNode(self, self.address, 'temperature', 'Temperatures')
-        node.SetUnits(self.units)
+        for sid in self.stations:
+            self.add_station_nodes(self.stations[sid])
+
+        if not self.started:
+            # Restore the saved rain totals
+            if 'customData' in self.polyConfig:
+                self.rain_store.load(self.polyConfig['customData'], len(self.stations) > 1)
+        else:
+            # Re-discover, pick up any new station metadata
+            self.start_refresh(False)
+
+    def add_station_nodes(self, station):
+        node = TemperatureNode(self, self.address, station.address('temperature'), station.label('Temperatures'))
+        node.SetUnits(station.units)
         self.addNode(node)
 
-        node = HumidityNode(self, self.address, 'humidity', 'Humidity')
-        node.SetUnits(self.units)
+        node = HumidityNode(self, self.address, station.address('humidity'), station.label('Humidity'))
+        node.SetUnits(station.units)
         self.addNode(node)
-        node = PressureNode(self, self.address, 'pressure', 'Barometric Pressure')
-        node.SetUnits(self.units)
+        node = PressureNode(self, self.address, station.address('pressure'), station.label('Barometric Pressure'))
+        node.SetUnits(station.units)
         self.addNode(node)
-        node = WindNode(self, self.address, 'wind', 'Wind')
-        node.SetUnits(self.units)
+        node = WindNode(self, self.address, station.address('wind'), station.label('Wind'))
+        node.SetUnits(station.units)
         self.addNode(node)
-        node = PrecipitationNode(self, self.address, 'rain', 'Precipitation')
-        node.SetUnits(self.units)
+        node = PrecipitationNode(self, self.address, station.address('rain'), station.label('Precipitation'))
+        node.SetUnits(station.units)
         self.addNode(node)
-        node = LightNode(self, self.address, 'light', 'Illumination')
-        node.SetUnits(self.units)
+        node = LightNode(self, self.address, station.address('light'), station.label('Illumination'))
+        node.SetUnits(station.units)
         self.addNode(node)
-        node = LightningNode(self, self.address, 'lightning', 'Lightning')
-        node.SetUnits(self.units)
+        node = LightningNode(self, self.address, station.address('lightning'), station.label('Lightning'))
+        node.SetUnits(station.units)
         self.addNode(node)
+        if station.indoor:
+            self.add_indoor_nodes(station)
+        if self.forecast_days > 0:
+            self.add_forecast_nodes(station)
 
-        
-        if 'customData' in self.polyConfig:
-            try:
-                self.rain_data['hourly'] = self.polyConfig['customData']['hourly']
-                self.rain_data['daily'] = self.polyConfig['customData']['daily']
-                self.rain_data['weekly'] = self.polyConfig['customData']['weekly']
-                self.rain_data['monthly'] = self.polyConfig['customData']['monthly']
-                self.rain_data['yearly'] = self.polyConfig['customData']['yearly']
-                self.rain_data['hour'] = self.polyConfig['customData']['hour']
-                self.rain_data['day'] = self.polyConfig['customData']['day']
-                self.rain_data['month'] = self.polyConfig['customData']['month']
-                self.rain_data['year'] = self.polyConfig['customData']['year']
-                self.rain_data['yesterday'] = self.polyConfig['customData']['yesterday']
-            except: 
-                self.rain_data['hourly'] = 0
-                self.rain_data['daily'] = 0
-                self.rain_data['weekly'] = 0
-                self.rain_data['monthly'] = 0
-                self.rain_data['yearly'] = 0
-                self.rain_data['yesterday'] = 0
-                self.rain_data['hour'] = datetime.datetime.now().hour
-                self.rain_data['day'] = datetime.datetime.now().day
-                self.rain_data['week'] = datetime.datetime.now().isocalendar()[1]
-                self.rain_data['month'] = datetime.datetime.now().month
-                self.rain_data['year'] = datetime.datetime.now().year
-                # TODO: Can we query the current accumulation data from
-                # weatherflow servers???
-
-            self.nodes['rain'].InitializeRain(self.rain_data)
-
-            # Might be able to get some information from API using station
-            # number:
-            # swd.weatherflow.com/swd/rest/observations/station/<num>?apikey=
+        self.compile_obs_map(station)
+
+        self.nodes[station.address('rain')].rain = self.rain_store.get(station.id)
+
+    def add_indoor_nodes(self, station):
+        node = TemperatureNode(self, self.address, station.address('temperature', True), station.label('Indoor Temperatures'))
+        node.SetUnits(station.units)
+        self.addNode(node)
+        node = HumidityNode(self, self.address, station.address('humidity', True), station.label('Indoor Humidity'))
+        node.SetUnits(station.units)
+        self.addNode(node)
+        node = PressureNode(self, self.address, station.address('pressure', True), station.label('Indoor Pressure'))
+        node.SetUnits(station.units)
+        self.addNode(node)
+
+    def add_forecast_nodes(self, station):
+        a = station.forecast_addresses
+        node = HourlyForecastNode(self, self.address, a['hourly'], station.label('Hourly Forecast'))
+        node.SetUnits(station.units)
+        self.addNode(node)
+        for d in range(self.forecast_days):
+            if d == 0:
+                name = 'Forecast Today'
+            elif d == 1:
+                name = 'Forecast Tomorrow'
+            else:
+                name = 'Forecast Day %d' % (d + 1)
+            node = ForecastNode(self, self.address, a['forecast%d' % d], station.label(name))
+            node.SetUnits(station.units)
+            self.addNode(node)
+
+    def open_history(self):
+        """
+        Open each station's observation history and restore the last
+        values and pressure trend from it.
+        """
+        for sid in self.stations:
+            self.open_station_history(self.stations[sid])
+
+    def open_station_history(self, station):
+        if self.history_days <= 0:
+            return
+        try:
+            station.history = history.History(
+                    os.path.join(HISTORY_DIR, '%s.dat' % station.id),
+                    HISTORY_FIELDS, retention=self.history_days * 86400)
+            station.history.open()
+            self.restore_history(station)
+        except Exception as e:
+            LOGGER.error('Failed to open history for station %s: %s', station.id, str(e))
+            station.history = None
+
+    def restore_history(self, station):
+        last = station.history.last_record()
+        if last is None:
+            return
+
+        (timestamp, values) = last
+        LOGGER.info('Restoring station %s from observation at %s',
+                station.id, time.ctime(timestamp))
+        station.values[:] = values
+        station.hub_timestamp = int(timestamp)
+        station.last_obs = int(timestamp)
+
+        self.begin_batch()
+        try:
+            for (i, (name, driver)) in enumerate(HISTORY_FIELDS):
+                address = station.address(name)
+                if address in self.nodes and history.known(values[i]):
+                    self.nodes[address].setDriver(driver, values[i])
+
+            # Rebuild the pressure trend from the last 3 hours
+            address = station.address('pressure')
+            if address in self.nodes:
+                node = self.nodes[address]
+                slot = HISTORY_SLOTS[('pressure', 'ST')]
+                for (t, v) in station.history.records(timestamp - node.trend.window):
+                    if history.known(v[slot]):
+                        node.trend.add(t, v[slot])
+                node.setDriver('GV1', node.trend.trend())
+
+            # and the wind statistics from the last 10 minutes
+            address = station.address('wind')
+            if address in self.nodes:
+                node = self.nodes[address]
+                speed = HISTORY_SLOTS[('wind', 'ST')]
+                direction = HISTORY_SLOTS[('wind', 'GV0')]
+                for (t, v) in station.history.records(timestamp - node.stats.long.window):
+                    if history.known(v[speed]) and history.known(v[direction]):
+                        node.stats.add(t, v[speed], v[direction])
+                if len(node.stats.long) > 0:
+                    node.publishStats()
+        finally:
+            self.flush_batch()
+
+    def record_history(self, station, timestamp):
+        if station.history is None or timestamp is None:
+            return
+        try:
+            station.history.append(timestamp, station.values)
+        except Exception as e:
+            LOGGER.error('Failed to save history for station %s: %s', station.id, str(e))
+
+    def close_history(self):
+        for sid in self.stations:
+            if self.stations[sid].history is not None:
+                self.stations[sid].history.close()
+
+    def backfill_station(self, station):
+        rain = self.rain_store.get(station.id)
+        now = time.time()
+        start = rain.timestamp
+        if start == 0 or (now - start) < backfill.MIN_GAP:
+            return
+        if (now - start) > backfill.MAX_GAP:
+            LOGGER.info('Station %s gap is too long, only backfilling %d hours',
+                    station.id, backfill.MAX_GAP / 3600)
+            start = now - backfill.MAX_GAP
+
+        pressure = self.nodes.get(station.address('pressure'))
+        count = 0
+        for (device_id, device_type) in station.devices:
+            if device_type not in backfill.RECORD_FIELDS:
+                continue
+            fields = backfill.RECORD_FIELDS[device_type]
+            records = backfill.fetch_device(self.http, device_id, start, now,
+                    '6c8c96f9-e561-43dd-b173-5198d8797e0a')
+            for record in records:
+                count += 1
+                if 'rain' in fields and record[fields['rain']] is not None:
+                    rain.add(record[fields['rain']], record[0])
+                if 'pressure' in fields and record[fields['pressure']] is not None:
+                    if pressure is not None:
+                        pressure.trend.add(record[0], record[fields['pressure']])
+
+        LOGGER.info('Backfilled %d observations for station %s', count, station.id)
+        if count > 0:
+            address = station.address('rain')
+            if address in self.nodes:
+                self.nodes[address].publish_totals(self.source == 'udp')
+            if pressure is not None:
+                pressure.setDriver('GV1', pressure.trend.trend())
+
+    def save_rain(self, force=False):
+        # Save the rain totals so they survive a restart. This only
+        # writes if something changed and it's been a while since the
+        # last save.
+        if self.rain_store.checkpoint(self.saveCustomData, len(self.stations) > 1, force):
+            LOGGER.debug('Saved rain accumulations')
 
     def heartbeat(self):
-        LOGGER.debug('heartbeat hb={}'.format(self.hb))
+        LOGGER.debug('heartbeat hb=%d', self.hb)
         if self.hb == 0:
             self.reportCmd("DON",2)
             self.hb = 1
@@ -262,26 +1178,146 @@ class Controller(polyinterface.Controller):
             self.hb = 0
 
     def set_hub_timestamp(self):
+        # Report the station we've heard from least recently.
+        if len(self.stations) > 0:
+            now = time.time()
+            self.hub_timestamp = min([self.stations[sid].last_seen(now) for sid in self.stations])
         s = int(time.time() - self.hub_timestamp)
-        LOGGER.debug("set_hub_timestamp: {}".format(s))
+        LOGGER.debug('set_hub_timestamp: %d', s)
         self.setDriver('GV4', s, report=True, force=True)
 
+    def set_server_status(self):
+        # Report the state of the circuit breaker protecting the
+        # WeatherFlow server requests.
+        state = self.http.breaker.state
+        if state != self.server_status:
+            LOGGER.info('WeatherFlow server circuit breaker is %s', self.http.breaker.name())
+            self.server_status = state
+        self.setDriver('GV5', state, report=True, force=False)
+
+    def log_traffic(self):
+        # Report how much data the requests since the last poll used.
+        (requests, wire, body, latency) = self.http.counters.snapshot()
+        if requests > 0:
+            LOGGER.info('HTTP: %d requests, %d bytes received (%d uncompressed), %.0f ms average',
+                    requests, wire, body, 1000 * latency / requests)
+
+    def start_metrics(self):
+        if self.metrics_port == 0:
+            return
+        try:
+            self.metrics_server = metrics.MetricsServer(self.metrics_port)
+            self.metrics_server.start()
+            LOGGER.info('Serving metrics on port %d', self.metrics_port)
+        except Exception as e:
+            LOGGER.error('Failed to start metrics server: %s', str(e))
+            self.metrics_server = None
+
+    def start_pool(self):
+        """ The worker threads and the connections they share. """
+        url = urllib.parse.urlsplit(self.server_url)
+        self.http = wfhttp.WeatherFlowClient(url.hostname,
+                maxsize=self.pool_size, secure=(url.scheme == 'https'),
+                port=url.port, stop=self.stop_event)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def resize_pool(self):
+        """
+        Grow the worker pool if the Workers default (one per station)
+        is now larger. It isn't shrunk, fewer stations just leave some
+        workers idle.
+        """
+        (workers, pool_size) = (self.workers, self.pool_size)
+        self.check_workers()
+        if self.workers <= workers:
+            (self.workers, self.pool_size) = (workers, pool_size)
+            return
+
+        LOGGER.info('Resizing the worker pool to %d', self.workers)
+        (http, pool) = (self.http, self.pool)
+        self.start_pool()
+        # Fetches still running on the old pool finish in the background
+        pool.shutdown(wait=False)
+        http.close()
+
+    def start_shards(self):
+        handler = StationShard(self.server_url, self.deadline, self.deadbands,
+                self.republish, self.capture.directory)
+        self.shard_pool = shard.ShardPool(handler, self.shards, self.workers)
+        self.shard_pool.start()
+        LOGGER.info('Started %d station worker processes', self.shards)
+
+    def set_metrics(self):
+        # Report the last poll time, the average request time and the
+        # number of driver updates since the last long poll.
+        (count, total) = POLL_TIME.window()
+        if count > 0:
+            self.setDriver('GV6', int(1000 * total / count), report=True, force=False)
+        (count, total) = HTTP_LATENCY.window()
+        if count > 0:
+            self.setDriver('GV7', int(1000 * total / count), report=True, force=False)
+        publishes = PUBLISHES.total()
+        self.setDriver('GV8', publishes - self.publishes, report=True, force=False)
+        self.publishes = publishes
+
     def delete(self):
-        self.stopping = True
+        self.stop_event.set()
         LOGGER.info('Removing WeatherFlow node server.')
 
     def my_stop(self):
-        self.stopping = True
-        # Is there something we should do here to really stop?
-        while not self.stopped:
-            self.stopping = True
-
-        LOGGER.info('WeatherFlow node server UDP thread finished.')
+        self.shutdown()
 
     def stop(self):
-        self.stopping = True
-        self.http.close()
-        LOGGER.debug('Stopping WeatherFlow node server.')
+        self.shutdown()
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """
+        Stop the background threads and save our state. The threads
+        are signalled through stop_event and have until timeout to
+        finish what they're doing, a poll in progress is allowed to
+        complete. Whatever is still running after that is abandoned
+        (they're daemon threads) and the final checkpoint is written
+        anyway. Only the first call does anything.
+        """
+        with self.stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+
+        start = time.time()
+        end = start + timeout
+        LOGGER.info('Stopping WeatherFlow node server.')
+        self.stop_event.set()
+
+        # Let a poll that's in progress finish
+        if self.poll_lock.acquire(timeout=max(0, end - time.time())):
+            self.poll_lock.release()
+        else:
+            LOGGER.error('Gave up waiting for the poll in progress')
+
+        for t in self.threads:
+            t.join(max(0, end - time.time()))
+            if t.is_alive():
+                LOGGER.error('Thread %s did not stop in time', t.name)
+        self.threads = []
+
+        if self.shard_pool is not None:
+            self.shard_pool.stop(max(1.0, end - time.time()))
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        # Final checkpoint
+        try:
+            self.save_rain(force=True)
+        except Exception as e:
+            LOGGER.error('Failed to save rain accumulations: %s', str(e))
+        self.close_history()
+        self.capture.close()
+        if self.http is not None:
+            self.http.close()
+        LOGGER.info('WeatherFlow node server stopped in %.1f seconds.', time.time() - start)
 
     def check_units(self):
         if 'Units' in self.polyConfig['customParams']:
@@ -296,6 +1332,158 @@ class Controller(polyinterface.Controller):
 
         return units
 
+    def check_source(self):
+        # Optional, where the observation data comes from. Either
+        # polling the WeatherFlow servers (cloud), the WeatherFlow
+        # servers' WebSocket (websocket) or the hub's local broadcasts
+        # (udp).
+        params = self.polyConfig['customParams']
+        if 'Source' in params:
+            source = params['Source'].lower()
+            if source not in ('cloud', 'websocket', 'udp'):
+                LOGGER.error('Invalid Source parameter, using cloud')
+                source = 'cloud'
+            if source == 'udp' and CLOUD:
+                LOGGER.error('Local UDP data is not available in the cloud')
+                source = 'cloud'
+            self.source = source
+
+        try:
+            if 'UDP Port' in params:
+                self.udp_port = int(params['UDP Port'])
+        except ValueError:
+            LOGGER.error('Invalid UDP Port parameter, using %d', UDP_PORT)
+            self.udp_port = UDP_PORT
+
+    def check_publishing(self):
+        # Optional, per driver deadbands as a comma separated list of
+        # node.driver=value (I.E. pressure.ST=0.5, light.GV1=200) and the
+        # minimum number of seconds between updates of a driver.
+        params = self.polyConfig['customParams']
+        self.deadbands = {}
+        if 'Deadbands' in params:
+            for item in params['Deadbands'].split(','):
+                try:
+                    (key, value) = item.split('=')
+                    (node, driver) = key.strip().split('.')
+                    self.deadbands[(node, driver.upper())] = float(value)
+                except ValueError:
+                    LOGGER.error('Invalid deadband %s, ignoring', item)
+
+        try:
+            if 'Republish Interval' in params:
+                self.republish = float(params['Republish Interval'])
+        except ValueError:
+            LOGGER.error('Invalid Republish Interval parameter, using 0')
+            self.republish = 0
+
+    def check_server(self):
+        # Optional, the WeatherFlow server to use. Only needed to test
+        # against a local stand-in like tools/wf_simulator.py.
+        params = self.polyConfig['customParams']
+        self.server_url = SERVER_URL
+        if 'Server URL' in params and params['Server URL'].strip() != '':
+            url = urllib.parse.urlsplit(params['Server URL'].strip())
+            if url.scheme in ('http', 'https') and url.hostname:
+                self.server_url = params['Server URL'].strip()
+                LOGGER.info('Using WeatherFlow server %s', self.server_url)
+            else:
+                LOGGER.error('Invalid Server URL parameter, using %s', SERVER_URL)
+
+    def check_capture(self):
+        # Optional, a directory to save the raw observation data in for
+        # debugging. Nothing is saved unless this is set.
+        params = self.polyConfig['customParams']
+        if 'Capture Directory' in params and params['Capture Directory'].strip() != '':
+            self.capture = logutil.Capture(params['Capture Directory'].strip())
+            LOGGER.info('Saving raw observation data in %s', self.capture.directory)
+        else:
+            self.capture = logutil.Capture()
+
+    def check_metrics(self):
+        # Optional, port to serve performance metrics on in the
+        # Prometheus text format. 0 (the default) turns this off.
+        params = self.polyConfig['customParams']
+        try:
+            if 'Metrics Port' in params:
+                self.metrics_port = int(params['Metrics Port'])
+        except ValueError:
+            LOGGER.error('Invalid Metrics Port parameter, metrics are off')
+            self.metrics_port = 0
+        if CLOUD:
+            self.metrics_port = 0
+
+    def check_history(self):
+        # Optional, number of days of observations to keep locally. 0
+        # turns off the local history.
+        params = self.polyConfig['customParams']
+        try:
+            if 'History Days' in params:
+                self.history_days = float(params['History Days'])
+        except ValueError:
+            LOGGER.error('Invalid History Days parameter, using 7')
+            self.history_days = 7
+
+    def check_workers(self):
+        # Optional, number of stations to query in parallel and the
+        # number of seconds we'll wait on any one station.
+        params = self.polyConfig['customParams']
+        try:
+            if 'Workers' in params:
+                self.workers = max(1, int(params['Workers']))
+            else:
+                self.workers = max(1, min(len(self.stations), 8))
+        except ValueError:
+            LOGGER.error('Invalid Workers parameter, using 4')
+            self.workers = 4
+
+        try:
+            if 'Deadline' in params:
+                self.deadline = float(params['Deadline'])
+        except ValueError:
+            LOGGER.error('Invalid Deadline parameter, using 20 seconds')
+            self.deadline = 20.0
+
+        # One extra connection for the background metadata refresh
+        try:
+            if 'Pool Size' in params:
+                self.pool_size = max(1, int(params['Pool Size']))
+            else:
+                self.pool_size = self.workers + 1
+        except ValueError:
+            LOGGER.error('Invalid Pool Size parameter, using %d', self.workers + 1)
+            self.pool_size = self.workers + 1
+
+        # Worker processes for large numbers of stations, 0 keeps all
+        # the work in this process.
+        try:
+            if 'Shards' in params:
+                self.shards = max(0, int(params['Shards']))
+        except ValueError:
+            LOGGER.error('Invalid Shards parameter, using 0')
+            self.shards = 0
+
+    def check_forecast(self):
+        # Optional, the number of days of forecast nodes (0, the
+        # default, turns the forecast off) and the minutes between
+        # forecast requests.
+        params = self.polyConfig['customParams']
+        try:
+            if 'Forecast Days' in params:
+                self.forecast_days = min(MAX_FORECAST_DAYS, max(0, int(params['Forecast Days'])))
+        except ValueError:
+            LOGGER.error('Invalid Forecast Days parameter, the forecast is off')
+            self.forecast_days = 0
+
+        interval = forecast.INTERVAL
+        try:
+            if 'Forecast Interval' in params:
+                interval = max(10.0, float(params['Forecast Interval'])) * 60
+        except ValueError:
+            LOGGER.error('Invalid Forecast Interval parameter, using %d minutes',
+                    forecast.INTERVAL // 60)
+        self.forecasts = forecast.ForecastCache(interval)
+
     def check_params(self):
         self.removeNoticesAll()
         default_units = "metric"
@@ -307,6 +1495,7 @@ class Controller(polyinterface.Controller):
             if self.polyConfig['customParams']['Station'] != self.default:
                 self.station = self.polyConfig['customParams']['Station']
                 self.myConfig['Station'] = self.station
+                self.set_stations(self.station)
             else:
                 st = False
                 notices['Station'] = 'Station parameter must be set'
@@ -315,6 +1504,15 @@ class Controller(polyinterface.Controller):
             notices['Station'] = 'Station parameter must be set'
         
 
+        self.check_workers()
+        self.check_server()
+        self.check_source()
+        self.check_publishing()
+        self.check_history()
+        self.check_capture()
+        self.check_metrics()
+        self.check_forecast()
+
         # Make sure they are in the params
         self.addCustomParam(self.myConfig)
         self.addNotice(notices)
@@ -332,89 +1530,704 @@ class Controller(polyinterface.Controller):
         st = self.poly.installprofile()
         return st
 
-    def query_data(self):
+    def poll_due(self):
+        """
+        Query the stations whose next observation is due. Each
+        station's cadence decides when that is. A poll that is still
+        running when the next one starts is left to finish.
+        """
+        if not self.poll_lock.acquire(False):
+            return
+        try:
+            now = time.time()
+            # A station still waiting on an earlier fetch is left alone
+            due = [self.stations[sid] for sid in self.stations
+                    if self.stations[sid].cadence.due(now) and not self.stations[sid].fetching]
+            if len(due) > 0:
+                with POLL_TIME.time():
+                    self.query_data(due)
+        finally:
+            self.poll_lock.release()
+
+    def query_data(self, stations=None):
+        """
+        Query the stations (all configured stations by default).  The
+        requests are made in parallel and each station's data is
+        processed as soon as it arrives so that a slow station doesn't
+        hold up the others.
+
+        Each station's deadline starts when its request does, a station
+        waiting for a worker doesn't lose any of its time. A request
+        that overruns is given up on and left to finish in the
+        background, the station isn't polled again until it does. If
+        every worker is stuck like that, the stations still waiting are
+        skipped this time.
+        """
         if not self.configured:
             LOGGER.debug('Skip query, no station configured.')
             return
 
-        LOGGER.info('Query WeatherFlow server for observation data')
-        path_str = '/swd/rest/observations/station/'
-        path_str += self.station
-        path_str += '?api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
+        if stations is None:
+            stations = list(self.stations.values())
 
-        try:
-            #http = urllib3.HTTPConnectionPool('swd.weatherflow.com', maxsize=1)
-
-            # Get station observation data
-            LOGGER.info(' -  ' + path_str)
-            c = self.http.request('GET', path_str)
-            data = json.loads(c.data.decode('utf-8'))
-        except:
-            close(c)
-            LOGGER.error('Server Query failed')
+        if self.shard_pool is not None:
+            self.query_shards(stations)
+            return
+
+        LOGGER.debug('Query WeatherFlow server for observation data')
+        futures = {}
+        for station in stations:
+            station.fetching = True
+            station.fetch_started = None
+            f = self.pool.submit(self.fetch_station, station)
+            f.add_done_callback(lambda f, station=station: setattr(station, 'fetching', False))
+            futures[f] = station
+
+        pending = set(futures)
+        while len(pending) > 0:
+            if self.stop_event.is_set():
+                # Stopping, only wait for the requests in progress
+                for f in pending:
+                    f.cancel()
+            (done, pending) = concurrent.futures.wait(pending, timeout=POLL_TICK,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                if f.cancelled():
+                    continue
+                station = futures[f]
+                try:
+                    (data, validators) = f.result()
+                except Exception as e:
+                    LOGGER.error('Server Query failed for station %s: %s', station.id, str(e))
+                    station.cadence.missed()
+                    continue
+                self.process_station(station, data, validators)
+
+            now = time.time()
+            for f in list(pending):
+                started = futures[f].fetch_started
+                if started is not None and (now - started) > self.deadline + DEADLINE_GRACE:
+                    LOGGER.error('Station %s missed the %.0f second deadline',
+                            futures[f].id, self.deadline)
+                    futures[f].cadence.missed()
+                    pending.discard(f)
+                    self.abandoned.add(f)
+
+            self.abandoned = set([f for f in self.abandoned if not f.done()])
+            if len(pending) > 0 and len(self.abandoned) >= self.workers:
+                for f in list(pending):
+                    if f.cancel():
+                        LOGGER.error('Station %s skipped, all workers are busy', futures[f].id)
+                        futures[f].cadence.missed()
+                        pending.discard(f)
+
+    def fetch_station(self, station):
+        """
+        Get station observation data. This runs on a worker thread.
+        Returns (data, validators), data is None when there's no new
+        observation.
+        """
+        LOGGER.debug('Fetching observation for station %s', station.id)
+        station.fetch_started = time.time()
+        with HTTP_LATENCY.time():
+            response = get_observation(self.http, station, self.deadline, self.capture)
+        if response is None:
+            return (None, None)
+
+        (raw, validators) = response
+        with DECODE_TIME.time():
+            return (json.loads(raw), validators)
+
+    def query_shards(self, stations):
+        """
+        Have the shard worker processes query the stations. A station
+        that is still waiting on an earlier query is left alone.
+        """
+        LOGGER.debug('Query WeatherFlow server for observation data (sharded)')
+        for station in stations:
+            if not self.shard_pool.busy(station.id):
+                self.shard_pool.submit(station.id, station.units)
+        if self.shard_pool.restarts != self.shard_restarts:
+            LOGGER.error('Restarted %d station worker processes',
+                    self.shard_pool.restarts - self.shard_restarts)
+            self.shard_restarts = self.shard_pool.restarts
+
+        for (sid, ok, result) in self.shard_pool.collect(self.deadline):
+            if self.stop_event.is_set():
+                break
+            station = self.stations.get(sid)
+            if station is None:
+                continue
+            if not ok:
+                LOGGER.error('Server Query failed for station %s: %s', sid, result)
+                station.cadence.missed()
+                continue
+            self.shard_result(station, result)
+
+        if self.stop_event.is_set():
+            return
+        for station in stations:
+            if self.shard_pool.busy(station.id):
+                LOGGER.error('Station %s missed the %.0f second deadline',
+                        station.id, self.deadline)
+                station.cadence.missed()
+
+    def shard_result(self, station, result):
+        """ Publish an observation converted by a StationShard. """
+        (latency, record) = result
+        HTTP_LATENCY.observe(latency)
+        if record is None:
+            self.skip_station(station)
             return
+        (timestamp, active, suffixes, values, updates, missing) = record
+        if timestamp != 0 and timestamp == station.last_obs:
+            self.skip_station(station)
+            return
+        self.new_observation(station, timestamp, active)
 
-        LOGGER.info(data)
+        if len(suffixes) == 0:
+            self.limiter.log(logging.INFO, ('no data', station.id),
+                    'No observation data available for station %s.', station.id)
+            return
 
-        # What we get back can contain indoor_keys, outdoor_keys or both
-        # if we have outdoor_keys, use those. If we only have indoor_keys
-        # lets switch over and use those.
+        self.device_sets(station, suffixes)
+        for key in missing:
+            if key in station.obs_map:
+                self.limiter.log(logging.INFO, ('missing', station.id, key),
+                        'Station %s key, %s is missing from data', station.id, key)
 
-        if 'outdoor_keys' in data and len(data['outdoor_keys']) > 0:
-            LOGGER.info('Found outdoor keys!')
-            self.obs_data(data, '')
-        elif 'indoor_keys' in data and len(data['indoor_keys']) > 0:
-            LOGGER.info('Found indoor keys!')
-            self.obs_data(data, '_indoor')
+        self.begin_batch()
+        try:
+            with OBS_TIME.time(('shard',)):
+                for (suffix, slot, value) in values:
+                    if suffix != '' and station.indoor:
+                        station.indoor_values[slot] = value
+                    else:
+                        station.values[slot] = value
+                for (suffix, name, driver, value, uom) in updates:
+                    address = station.address(name, suffix != '' and station.indoor)
+                    if address in self.nodes:
+                        self.publish(self.nodes[address], driver, value, uom)
+                self.record_history(station, timestamp if timestamp != 0 else None)
+
+                raw = dict([((suffix, slot), value) for (suffix, slot, value) in values])
+                for suffix in suffixes:
+                    self.update_state(station, suffix != '' and station.indoor,
+                            raw.get((suffix, HISTORY_SLOTS[('pressure', 'ST')])),
+                            raw.get((suffix, HISTORY_SLOTS[('rain', 'ST')])),
+                            raw.get((suffix, HISTORY_SLOTS[('wind', 'ST')])),
+                            raw.get((suffix, HISTORY_SLOTS[('wind', 'GV0')])),
+                            timestamp if timestamp != 0 else None)
+        finally:
+            self.flush_batch()
+
+    def skip_station(self, station):
+        station.skipped += 1
+        station.cadence.missed()
+        LOGGER.debug('Station %s observation unchanged, skipped %d polls',
+                station.id, station.skipped)
+
+    def new_observation(self, station, timestamp, active):
+        if timestamp != 0:
+            station.cadence.observed(timestamp, active=active)
         else:
-            LOGGER.info('No observation data available for station.')
+            station.cadence.missed()
+        station.last_obs = timestamp
 
-        c.close()
+    def process_station(self, station, data, validators=None):
+        timestamp = 0
+        if data is not None:
+            timestamp = self.obs_timestamp(data)
 
-    def mySetDriver(self, node, driver, key, data):
-        if key in data['obs'][0]:
-            self.nodes[node].setDriver(driver, data['obs'][0][key])
+        if data is None or (timestamp != 0 and timestamp == station.last_obs):
+            self.skip_station(station)
+            return
+
+        self.new_observation(station, timestamp, self.active_weather(data))
+        LOGGER.debug('Station %s observation: %s', station.id, data)
+
+        # What we get back can contain indoor_keys, outdoor_keys or both.
+        # Both are published, the indoor data to its own nodes when
+        # there's outdoor data too.
+        suffixes = [suffix for (suffix, field) in KEY_SETS if len(data.get(field) or []) > 0]
+
+        self.begin_batch()
+        try:
+            if len(suffixes) > 0:
+                with OBS_TIME.time(('rest',)):
+                    self.obs_data(station, data, suffixes)
+            else:
+                self.limiter.log(logging.INFO, ('no data', station.id),
+                        'No observation data available for station %s.', station.id)
+        finally:
+            self.flush_batch()
+        save_validators(station, validators)
+
+    def begin_batch(self):
+        """
+        Start collecting driver updates. Updates are held until
+        flush_batch() so each poll's changes go out together and a
+        driver set more than once is only sent once.
+        """
+        self.batch.pending = {}
+
+    def flush_batch(self):
+        pending = getattr(self.batch, 'pending', None)
+        self.batch.pending = None
+        if pending is None:
+            return
+
+        for key in pending:
+            (node, driver, value, uom, force) = pending[key]
+            node.publishDriver(driver, value, uom, force)
+        LOGGER.debug('Published %d driver updates', len(pending))
+
+    def publish(self, node, driver, value, uom, force=False):
+        pending = getattr(self.batch, 'pending', None)
+        if pending is None:
+            node.publishDriver(driver, value, uom, force)
         else:
-            LOGGER.info('key, ' + key + ' is missing from data')
+            pending[(node.address, driver)] = (node, driver, value, uom, force)
+
+    @staticmethod
+    def active_weather(data):
+        try:
+            obs = data['obs'][0]
+        except (KeyError, IndexError, TypeError):
+            return False
+        for key in ACTIVE_KEYS:
+            if obs.get(key):
+                return True
+        return False
+
+    @staticmethod
+    def obs_timestamp(data):
+        try:
+            return int(data['obs'][0]['timestamp'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return 0
 
-    def obs_data(self, data, suffix):
+    def compile_obs_map(self, station):
+        """
+        Build the table used to publish a station's observations. It
+        maps each observation key, outdoor and indoor, to (node, driver,
+        convert, uom, indoor, slot). Indoor keys go to the indoor nodes
+        if the station has them. This only needs to change when the
+        nodes or their units change.
+        """
+        obs_map = {}
+        obs_keys = {}
+        for (suffix, field) in KEY_SETS:
+            indoor = (suffix != '' and station.indoor)
+            keys = []
+            for (key, name, driver) in OBS_MAP:
+                address = station.address(name, indoor)
+                if address not in self.nodes:
+                    continue
+                node = self.nodes[address]
+                (convert, uom) = node.converters[driver]
+                slot = HISTORY_SLOTS[(name, driver)]
+                obs_map[key + suffix] = (node, driver, convert, uom, indoor, slot)
+                keys.append(key + suffix)
+            obs_keys[suffix] = keys
+        # Replace the tables whole, they can be in use on another thread
+        station.obs_keys = obs_keys
+        station.obs_map = obs_map
+
+    def device_sets(self, station, suffixes):
+        """
+        Note which devices (key sets) are in the observation. The first
+        time a station has both, the indoor device gets its own nodes.
+        """
+        now = int(time.time())
+        station.hub_timestamp = now
+        for suffix in suffixes:
+            station.seen[suffix] = now
+        if len(suffixes) > 1 and not station.indoor:
+            self.add_indoor(station)
+
+    def add_indoor(self, station):
+        LOGGER.info('Station %s has indoor and outdoor devices, adding indoor nodes',
+                station.id)
+        station.indoor = True
+        self.add_indoor_nodes(station)
+        self.compile_obs_map(station)
+
+    def obs_data(self, station, data, suffixes):
 
         if len(data['obs']) == 0:
-            LOGGER.info('missing observation data')
+            self.limiter.log(logging.INFO, ('no obs', station.id),
+                    'Station %s is missing observation data', station.id)
             return
 
-        self.hub_timestamp = int(time.time())
+        self.device_sets(station, suffixes)
+
+        # One pass over the observation for both the outdoor and indoor
+        # keys.
+        obs = data['obs'][0]
+        table = station.obs_map
+        found = 0
+        for key in obs:
+            entry = table.get(key)
+            if entry is None:
+                continue
+            found += 1
+            (node, driver, convert, uom, indoor, slot) = entry
+            value = obs[key]
+            if value is None:
+                continue
+            node.update(driver, value, convert, uom)
+            if indoor:
+                station.indoor_values[slot] = value
+            else:
+                station.values[slot] = value
+
+        if found < sum([len(station.obs_keys[suffix]) for suffix in suffixes]):
+            for suffix in suffixes:
+                for key in station.obs_keys[suffix]:
+                    if key not in obs:
+                        self.limiter.log(logging.INFO, ('missing', station.id, key),
+                                'Station %s key, %s is missing from data', station.id, key)
+        self.record_history(station, obs.get('timestamp'))
+
+        for suffix in suffixes:
+            (pressure, rain, speed, direction) = STATE_KEYS[suffix]
+            self.update_state(station, suffix != '' and station.indoor,
+                    obs.get(pressure), obs.get(rain), obs.get(speed), obs.get(direction),
+                    obs.get('timestamp'))
+
+    def update_state(self, station, indoor, pressure, rain, speed, direction, timestamp):
+        # Feed the pressure trend, rain totals and wind statistics.
+        if pressure is not None:
+            self.update_trend(station, pressure, timestamp, indoor)
+        if rain is not None:
+            self.update_rain(station, rain, timestamp, indoor=indoor)
+        if speed is not None and direction is not None:
+            self.update_wind(station, speed, direction, timestamp, indoor)
+
+    def update_rain(self, station, amount, timestamp=None, local=False, indoor=False):
+        if not station.ready:
+            return
+        address = station.address('rain', indoor)
+        if address in self.nodes:
+            self.nodes[address].accumulate(amount, timestamp, local)
+
+    def update_trend(self, station, pressure, timestamp=None, indoor=False):
+        # Wait for the backfill, older samples are ignored once a newer
+        # one has been added.
+        if not station.ready:
+            return
+        address = station.address('pressure', indoor)
+        if address in self.nodes:
+            node = self.nodes[address]
+            node.setDriver('GV1', node.updateTrend(pressure, timestamp))
+
+    def update_wind(self, station, speed, direction, timestamp=None, indoor=False):
+        address = station.address('wind', indoor)
+        if address in self.nodes:
+            self.nodes[address].updateStats(speed, direction, timestamp)
+
+    def add_strike(self, station, timestamp, distance, energy):
+        address = station.address('lightning')
+        if address in self.nodes:
+            self.nodes[address].addStrike(timestamp, distance, energy)
+
+    def publish_pending(self):
+        # Changes held back by the Republish Interval go out once it has
+        # passed, even if no new value arrives.
+        if self.republish <= 0:
+            return
+        self.begin_batch()
+        try:
+            for node in list(self.nodes.values()):
+                if isinstance(node, WeatherNode) and len(node.pending) > 0:
+                    node.publishPending()
+        finally:
+            self.flush_batch()
+
+    def expire_strikes(self):
+        # Strikes age out of the count windows even when there are no
+        # new ones.
+        now = time.time()
+        for sid in self.stations:
+            address = self.stations[sid].address('lightning')
+            if address in self.nodes and self.nodes[address].strikes.advance(now):
+                self.nodes[address].publishStrikes()
+
+    def forecast_worker(self):
+        """
+        Runs in the background. Fetches each station's forecast when
+        it's due and updates the forecast nodes from the cache. It has
+        its own connection, so a slow forecast request never holds up
+        the observation polls.
+        """
+        url = urllib.parse.urlsplit(self.server_url)
+        http = wfhttp.WeatherFlowClient(url.hostname, maxsize=1,
+                secure=(url.scheme == 'https'), port=url.port, stop=self.stop_event)
+        try:
+            while not self.stop_event.is_set():
+                self.forecasts.prune(self.stations)
+                for sid in list(self.stations):
+                    station = self.stations.get(sid)
+                    if station is None or self.stop_event.is_set():
+                        continue
+                    if self.forecasts.due(sid):
+                        self.fetch_forecast(http, station)
+                    self.publish_forecast(station, time.time())
+                self.stop_event.wait(FORECAST_TICK)
+        finally:
+            http.close()
+
+    def fetch_forecast(self, http, station):
+        path_str = '/swd/rest/better_forecast?station_id='
+        path_str += station.id
+        path_str += '&units_temp=c&units_wind=mps&units_pressure=mb&units_precip=mm&units_distance=km'
+        path_str += '&api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
+
+        try:
+            c = http.request('GET', path_str, deadline=self.deadline)
+            try:
+                if c.status != 200:
+                    raise wfhttp.RequestError('HTTP %d' % c.status)
+                fc = forecast.parse(json.loads(c.data))
+            finally:
+                c.close()
+            if len(fc.daily) == 0 and len(fc.hourly) == 0:
+                raise ValueError('no forecast data')
+            self.forecasts.put(station.id, fc)
+            LOGGER.debug('Got forecast for station %s', station.id)
+        except Exception as e:
+            # Keep using the forecast we have until it expires
+            self.forecasts.failed(station.id)
+            self.limiter.log(logging.ERROR, ('forecast', station.id),
+                    'Forecast request failed for station %s: %s', station.id, str(e))
+
+    def publish_forecast(self, station, now):
+        if self.forecasts.expire(station.id, now):
+            LOGGER.warning('Forecast for station %s has expired', station.id)
+        fc = self.forecasts.get(station.id, now)
+        age = self.forecasts.age(station.id, now)
+        a = station.forecast_addresses
+
+        self.begin_batch()
+        try:
+            if fc is not None:
+                node = self.nodes.get(a['hourly'])
+                if node is not None:
+                    node.updateForecast(fc.hours(now))
+                for (d, day) in enumerate(fc.days(now, self.forecast_days)):
+                    node = self.nodes.get(a['forecast%d' % d])
+                    if node is not None:
+                        node.updateForecast(day)
+            if age is not None:
+                for address in a.values():
+                    node = self.nodes.get(address)
+                    if node is not None:
+                        node.setAge(age)
+        finally:
+            self.flush_batch()
+
+    def udp_listener(self):
+        """
+        Listen for the hub's local broadcasts and publish the values
+        as they arrive.  Datagrams are received into a single buffer
+        that is reused for every packet.
+        """
+        LOGGER.info('Starting UDP listener on port %d', self.udp_port)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.settimeout(1.0)
+
+        buf = bytearray(4096)
+        try:
+            s.bind(('0.0.0.0', self.udp_port))
+            while not self.stop_event.is_set():
+                try:
+                    n = s.recv_into(buf)
+                except socket.timeout:
+                    continue
+
+                self.capture.write('udp', buf[:n])
+                try:
+                    data = json.loads(buf[:n].decode('utf-8'))
+                except ValueError:
+                    LOGGER.error('Ignoring malformed UDP packet')
+                    continue
+
+                with OBS_TIME.time(('udp',)):
+                    self.udp_data(data)
+        except Exception as e:
+            LOGGER.error('UDP listener failed: %s', str(e))
+        finally:
+            s.close()
+            LOGGER.info('UDP listener stopped.')
+
+    def udp_data(self, data):
+        if 'type' not in data or data['type'] not in UDP_MAP:
+            return
+
+        # Find the station this device belongs to.
+        station = None
+        if 'serial_number' in data and data['serial_number'] in self.serials:
+            station = self.serials[data['serial_number']]
+        elif 'hub_sn' in data and data['hub_sn'] in self.serials:
+            station = self.serials[data['hub_sn']]
+        elif len(self.stations) == 1:
+            station = list(self.stations.values())[0]
+        if station is None:
+            LOGGER.debug('No station for device %s', data.get('serial_number'))
+            return
 
-        # Right now we expect both air and sky data in the obs. What if we
-        # only get one of them?
-        # do I need to create a function to set a driver and pass
-        # def mySetDriver(node, driver, key, data):
-        #    if key in data['obs'][0]:
-        #        self.nodes[node].setDriver(driver, data['obs'][0][key])
-        self.mySetDriver('temperature', 'ST', 'air_temperature' + suffix, data)
-        self.mySetDriver('pressure', 'ST', 'barometric_pressure' + suffix, data)
-        self.mySetDriver('pressure', 'GV0', 'sea_level_pressure' + suffix, data)
-        self.mySetDriver('humidity', 'ST', 'relative_humidity' + suffix, data)
-        self.mySetDriver('rain', 'ST', 'precip' + suffix, data)
-        self.mySetDriver('rain', 'GV0', 'precip_accum_last_1hr' + suffix, data)
-        self.mySetDriver('rain', 'GV1', 'precip_accum_local_day' + suffix, data)
-        self.mySetDriver('rain', 'GV2', 'precip_accum_local_yesterday' + suffix, data)
-        self.mySetDriver('wind', 'ST', 'wind_avg' + suffix, data)
-        self.mySetDriver('wind', 'GV0', 'wind_direction' + suffix, data)
-        self.mySetDriver('wind', 'GV1', 'wind_gust' + suffix, data)
-        self.mySetDriver('wind', 'GV2', 'wind_lull' + suffix, data)
-        self.mySetDriver('light', 'ST', 'uv' + suffix, data)
-        self.mySetDriver('light', 'GV0', 'solar_radiation' + suffix, data)
-        self.mySetDriver('light', 'GV1', 'brightness' + suffix, data)
-        self.mySetDriver('lightning', 'ST', 'lightning_strike_last_3hr' + suffix, data)
-        self.mySetDriver('lightning', 'GV0', 'lightning_strike_last_distance' + suffix, data)
-        self.mySetDriver('temperature', 'GV0', 'feels_like' + suffix, data)
-        self.mySetDriver('temperature', 'GV1', 'dew_point' + suffix, data)
-        self.mySetDriver('temperature', 'GV2', 'heat_index' + suffix, data)
-        self.mySetDriver('temperature', 'GV3', 'wind_chill' + suffix, data)
-        self.mySetDriver('temperature', 'GV4', 'wet_bulb_temperature' + suffix, data)
-        self.mySetDriver('temperature', 'GV5', 'delta_t' + suffix, data)
-        self.mySetDriver('temperature', 'GV6', 'air_density' + suffix, data)
+        self.device_data(station, data)
+
+    def device_data(self, station, data):
+        """
+        Publish a device message. The hub's broadcasts and the
+        WebSocket messages have the same format. Messages from the
+        indoor device of a station with indoor nodes go to those.
+        """
+        (field, mapping) = UDP_MAP[data['type']]
+        if field not in data:
+            return
+
+        # obs is a list of observation arrays, ob and evt are a single array
+        records = data[field]
+        if field != 'obs':
+            records = [records]
+
+        now = int(time.time())
+        station.hub_timestamp = now
+        indoor = station.indoor_message(data)
+        if indoor:
+            station.seen['_indoor'] = now
+            (a, values) = (station.indoor_addresses, station.indoor_values)
+        else:
+            station.seen[''] = now
+            (a, values) = (station.addresses, station.values)
+        wind = WIND_FIELDS.get(data['type'])
+        self.begin_batch()
+        try:
+            for record in records:
+                for (idx, node, driver) in mapping:
+                    if a.get(node) not in self.nodes:
+                        continue
+                    if idx < len(record) and record[idx] is not None:
+                        self.nodes[a[node]].setDriver(driver, record[idx])
+                        values[HISTORY_SLOTS[(node, driver)]] = record[idx]
+                        if node == 'pressure' and driver == 'ST':
+                            slp = self.nodes[a[node]].toSeaLevel(record[idx], station.elevation)
+                            self.nodes[a[node]].setDriver('GV0', slp)
+                            values[HISTORY_SLOTS[('pressure', 'GV0')]] = slp
+                            self.update_trend(station, record[idx], record[0], indoor)
+                        if node == 'rain' and driver == 'ST':
+                            self.update_rain(station, record[idx], record[0], True, indoor)
+                if indoor:
+                    # Only the outdoor values are kept in the history
+                    continue
+                if wind is not None and len(record) > wind[1] and \
+                        record[wind[0]] is not None and record[wind[1]] is not None:
+                    self.update_wind(station, record[wind[0]], record[wind[1]], record[0])
+                if data['type'] == 'evt_strike' and len(record) > 2:
+                    self.add_strike(station, record[0], record[1], record[2])
+                self.record_history(station, record[0])
+        finally:
+            self.flush_batch()
+
+        if data['type'] == 'evt_precip':
+            LOGGER.info('Rain started at station %s', station.id)
+
+    def socket_url(self):
+        if self.server_url == SERVER_URL:
+            url = SOCKET_URL
+        else:
+            u = urllib.parse.urlsplit(self.server_url)
+            url = '%s://%s/swd/data' % ('wss' if u.scheme == 'https' else 'ws', u.netloc)
+        return url + '?api_key=6c8c96f9-e561-43dd-b173-5198d8797e0a'
+
+    def socket_listener(self):
+        """
+        Get observations pushed over the WeatherFlow WebSocket. If the
+        connection fails or goes quiet, reconnect with a growing random
+        delay. While it's down, socket_connected is False and
+        shortPoll() polls the REST API for the stations that are due.
+        """
+        attempt = 0
+        while not self.stop_event.is_set():
+            ws = None
+            try:
+                ws = wfsocket.connect(self.socket_url(), timeout=self.deadline)
+                self.socket_session(ws)
+            except (OSError, ValueError, wfsocket.WebSocketError) as e:
+                if not self.stop_event.is_set():
+                    LOGGER.error('WebSocket connection failed: %s', str(e))
+            finally:
+                if self.socket_connected:
+                    LOGGER.info('WebSocket disconnected, polling until it reconnects')
+                    attempt = 0
+                self.socket_connected = False
+                if ws is not None:
+                    ws.close()
+
+            delay = random.uniform(1, max(1, min(SOCKET_BACKOFF_MAX, 2 ** attempt)))
+            attempt += 1
+            self.stop_event.wait(delay)
+
+        LOGGER.info('WebSocket listener stopped.')
+
+    def socket_session(self, ws):
+        listening = set()
+        last_data = time.time()
+        while not self.stop_event.is_set():
+            self.socket_listen(ws, listening)
+
+            message = ws.recv(1.0)
+            if message is None:
+                if (time.time() - last_data) > SOCKET_STALE:
+                    raise wfsocket.WebSocketError('no data for %d seconds' % SOCKET_STALE)
+                continue
+
+            self.capture.write('websocket', message.encode('utf-8'))
+            try:
+                data = json.loads(message)
+            except ValueError:
+                LOGGER.error('Ignoring malformed WebSocket message')
+                continue
+
+            kind = data.get('type')
+            if kind in UDP_MAP:
+                station = self.device_ids.get(data.get('device_id'))
+                if station is None:
+                    LOGGER.debug('No station for device %s', data.get('device_id'))
+                    continue
+                last_data = time.time()
+                with OBS_TIME.time(('websocket',)):
+                    self.device_data(station, data)
+            elif kind == 'connection_opened':
+                LOGGER.info('WebSocket connected')
+                self.socket_connected = True
+            elif kind == 'ack':
+                pass
+            else:
+                LOGGER.debug('WebSocket message %s', message)
+
+    def socket_listen(self, ws, listening):
+        # Start listening to any devices we haven't yet. Devices can
+        # show up after we connect, once the station metadata is
+        # fetched.
+        if not self.socket_connected:
+            return
+        for sid in self.stations:
+            for (device_id, device_type) in self.stations[sid].devices:
+                if device_id in listening or device_type not in ('ST', 'AR', 'SK'):
+                    continue
+                ws.send(json.dumps({'type': 'listen_start',
+                        'device_id': device_id, 'id': 'obs-%d' % device_id}))
+                if device_type != 'AR':
+                    ws.send(json.dumps({'type': 'listen_rapid_start',
+                            'device_id': device_id, 'id': 'rapid-%d' % device_id}))
+                listening.add(device_id)
 
     def SetUnits(self, u):
         self.units = u
@@ -423,7 +2236,6 @@ class Controller(polyinterface.Controller):
     id = 'WeatherFlow'
     name = 'WeatherFlow'
     address = 'hub'
-    stopping = False
     hint = [1, 11, 0, 0]
     units = 'metric'
     commands = {
@@ -434,11 +2246,93 @@ class Controller(polyinterface.Controller):
     # Hub status information here: battery and rssi values.
     drivers = [
             {'driver': 'ST', 'value': 1, 'uom': 2},
-            {'driver': 'GV4', 'value': 0, 'uom': 57}   # Hub seconds since seen
+            {'driver': 'GV4', 'value': 0, 'uom': 57},  # Hub seconds since seen
+            {'driver': 'GV5', 'value': 0, 'uom': 25},  # Server circuit breaker
+            {'driver': 'GV6', 'value': 0, 'uom': 42},  # Poll time
+            {'driver': 'GV7', 'value': 0, 'uom': 42},  # Request time
+            {'driver': 'GV8', 'value': 0, 'uom': 56},  # Driver updates
             ]
 
 
-class TemperatureNode(polyinterface.Node):
+class WeatherNode(polyinterface.Node):
+    """
+    Common base for the weather nodes. The drivers table is a class
+    attribute, give each node its own copy so that nodes for different
+    stations don't share values.
+    """
+    units = 'metric'
+    # Maps each driver to an entry in CONVERSIONS
+    conversions = {}
+    # Changes smaller than this (in the units WeatherFlow reports) are
+    # not published. Can be overridden with the Deadbands parameter.
+    deadbands = {}
+
+    def __init__(self, controller, primary, address, name):
+        super(WeatherNode, self).__init__(controller, primary, address, name)
+        self.drivers = copy.deepcopy(self.drivers)
+        self.published = {}
+        # Changes held back by the republish interval, published once
+        # it has passed.
+        self.pending = {}
+        self.SetUnits(self.units)
+
+    def SetUnits(self, u):
+        """
+        Look up the conversion function and uom for each driver once
+        so that publishing a value doesn't have to check the units.
+        """
+        self.units = u
+        self.uoms = {}
+        self.converters = {}
+        for driver in self.conversions:
+            (convert, uom) = CONVERSIONS[self.conversions[driver]][u]
+            self.converters[driver] = (convert, uom)
+            self.uoms[driver] = uom
+
+    def changed(self, driver, value):
+        """
+        Check the new value against the last value we published for the
+        driver. It has to move by more than the deadband.
+        """
+        deadband = self.controller.deadbands.get((self.id, driver),
+                self.deadbands.get(driver, 0))
+        return outside_deadband(self.published.get(driver), value, deadband)
+
+    def update(self, driver, value, convert, uom, force=False):
+        if not force:
+            if not self.changed(driver, value):
+                # Back within the deadband, nothing left to send
+                self.pending.pop(driver, None)
+                return
+            previous = self.published.get(driver)
+            if not republish_due(previous, self.controller.republish):
+                if previous is not None and previous[0] == value:
+                    # Back to what was published, the held change is moot
+                    self.pending.pop(driver, None)
+                else:
+                    self.pending[driver] = (value, convert, uom)
+                return
+
+        self.pending.pop(driver, None)
+        self.published[driver] = (value, time.time())
+        self.controller.publish(self, driver, convert(value), uom, force)
+
+    def publishPending(self):
+        """ Publish the held back changes whose republish interval has passed. """
+        for (driver, (value, convert, uom)) in list(self.pending.items()):
+            if republish_due(self.published.get(driver), self.controller.republish):
+                self.update(driver, value, convert, uom)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        (convert, u) = self.converters.get(driver, (same_units, uom))
+        self.update(driver, value, convert, u, force)
+
+    def publishDriver(self, driver, value, uom, force=False):
+        PUBLISHES.inc((self.address,))
+        super(WeatherNode, self).setDriver(driver, value, report=True, force=force, uom=uom)
+
+
+class TemperatureNode(WeatherNode):
     id = 'temperature'
     hint = [1,11,1,0]
     units = 'us'
@@ -452,114 +2346,49 @@ class TemperatureNode(polyinterface.Node):
             {'driver': 'GV5', 'value': 0, 'uom': 17}, # delta T
             {'driver': 'GV6', 'value': 0, 'uom': 56}  # density
             ]
-    uoms = {
-            'ST': 17,
-            'GV0': 17,
-            'GV1': 17,
-            'GV2': 17,
-            'GV3': 17,
-            'GV4': 17,
-            'GV5': 17,
-            'GV6': 56
+    deadbands = {
+            'ST': 0.05,
+            'GV0': 0.05,
+            'GV1': 0.05,
+            'GV2': 0.05,
+            'GV3': 0.05,
+            'GV4': 0.05,
+            'GV5': 0.05,
+            'GV6': 0.0005
+            }
+    conversions = {
+            'ST': 'temperature',
+            'GV0': 'temperature',
+            'GV1': 'temperature',
+            'GV2': 'temperature',
+            'GV3': 'temperature',
+            'GV4': 'temperature',
+            'GV5': 'temperature',
+            'GV6': 'density'
             }
     
-    def SetUnits(self, u):
-        self.units = u
-        if (u == 'metric'):  # C
-            self.uoms['ST'] = 4
-            self.uoms['GV0'] = 4
-            self.uoms['GV1'] = 4
-            self.uoms['GV2'] = 4
-            self.uoms['GV3'] = 4
-            self.uoms['GV4'] = 4
-            self.uoms['GV5'] = 4
-        elif (u == 'uk'):  # C
-            self.uoms['ST'] = 4
-            self.uoms['GV0'] = 4
-            self.uoms['GV1'] = 4
-            self.uoms['GV2'] = 4
-            self.uoms['GV3'] = 4
-            self.uoms['GV4'] = 4
-            self.uoms['GV5'] = 4
-        elif (u == 'us'):   # F
-            self.uoms['ST'] = 17
-            self.uoms['GV0'] = 17
-            self.uoms['GV1'] = 17
-            self.uoms['GV2'] = 17
-            self.uoms['GV3'] = 17
-            self.uoms['GV4'] = 17
-            self.uoms['GV5'] = 17
-
     def Dewpoint(self, t, h):
-        b = (17.625 * t) / (243.04 + t)
-        rh = h / 100.0
-
-        if rh <= 0:
-            return 0
-
-        c = math.log(rh)
-        dewpt = (243.04 * (c + b)) / (17.625 - c - b)
-        return round(dewpt, 1)
+        return derived.dewpoint(t, h)
 
     def ApparentTemp(self, t, ws, h):
-        wv = h / 100.0 * 6.105 * math.exp(17.27 * t / (237.7 + t))
-        at =  t + (0.33 * wv) - (0.70 * ws) - 4.0
-        return round(at, 1)
+        return derived.apparent_temp(t, ws, h)
 
     def Windchill(self, t, ws):
-        # really need temp in F and speed in MPH
-        tf = (t * 1.8) + 32
-        mph = ws / 0.44704
-
-        wc = 35.74 + (0.6215 * tf) - (35.75 * math.pow(mph, 0.16)) + (0.4275 * tf * math.pow(mph, 0.16))
-
-        if (tf <= 50.0) and (mph >= 5.0):
-            return round((wc - 32) / 1.8, 1)
-        else:
-            return t
+        return derived.windchill(t, ws)
 
     def Heatindex(self, t, h):
-        tf = (t * 1.8) + 32
-        c1 = -42.379
-        c2 = 2.04901523
-        c3 = 10.1433127
-        c4 = -0.22475541
-        c5 = -6.83783 * math.pow(10, -3)
-        c6 = -5.481717 * math.pow(10, -2)
-        c7 = 1.22874 * math.pow(10, -3)
-        c8 = 8.5282 * math.pow(10, -4)
-        c9 = -1.99 * math.pow(10, -6)
-
-        hi = (c1 + (c2 * tf) + (c3 * h) + (c4 * tf * h) + (c5 * tf *tf) + (c6 * h * h) + (c7 * tf * tf * h) + (c8 * tf * h * h) + (c9 * tf * tf * h * h))
-
-        if (tf < 80.0) or (h < 40.0):
-            return t
-        else:
-            return round((hi - 32) / 1.8, 1)
-
-    def setDriver(self, driver, value):
-        if (driver != "GV6"):
-            if (self.units == "us"):
-                value = (value * 1.8) + 32  # convert to F
-            value = round(value, 1)
+        return derived.heatindex(t, h)
 
-        super(TemperatureNode, self).setDriver(driver, value, report=True, force=False, uom=self.uoms[driver])
 
-
-
-class HumidityNode(polyinterface.Node):
+class HumidityNode(WeatherNode):
     id = 'humidity'
     hint = [1,11,2,0]
     units = 'metric'
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 22}]
+    conversions = {'ST': 'humidity'}
 
-    def SetUnits(self, u):
-        self.units = u
-
-    def setDriver(self, driver, value):
-        super(HumidityNode, self).setDriver(driver, value, report=True, force=False)
 
-class PressureNode(polyinterface.Node):
+class PressureNode(WeatherNode):
     id = 'pressure'
     hint = [1,11,3,0]
     units = 'metric'
@@ -568,85 +2397,37 @@ class PressureNode(polyinterface.Node):
             {'driver': 'GV0', 'value': 0, 'uom': 117}, # rel (sealevel) press
             {'driver': 'GV1', 'value': 0, 'uom': 25}  # trend
             ]
-    uoms = {
-            'ST': 117,
-            'GV0': 117,
-            'GV1': 25
+    deadbands = {
+            'ST': 0.1,
+            'GV0': 0.1
+            }
+    conversions = {
+            'ST': 'pressure',
+            'GV0': 'pressure',
+            'GV1': 'trend'
             }
-    mytrend = []
 
+    def __init__(self, controller, primary, address, name):
+        super(PressureNode, self).__init__(controller, primary, address, name)
+        self.trend = trend.PressureTrend()
 
-    def SetUnits(self, u):
-        # can we dynmically set the drivers here also?
-        # what about the ID, can we dynamically change that to change
-        # the node def?
-        self.units = u
-        if (u == 'metric'):  # millibar
-            self.uoms['ST'] = 117
-            self.uoms['GV0'] = 117
-        elif (u == 'uk'):  # millibar
-            self.uoms['ST'] = 117
-            self.uoms['GV0'] = 117
-        elif (u == 'us'):   # inHg
-            self.uoms['ST'] = 23
-            self.uoms['GV0'] = 23
 
     # convert station pressure in millibars to sealevel pressure
     def toSeaLevel(self, station, elevation):
-        i = 287.05  # gas constant for dry air
-        a = 9.80665 # gravity
-        r = 0.0065  # standard atmosphere lapse rate
-        s = 1013.35 # pressure at sealevel
-        n = 288.15  # sea level temperature
-
-        l = a / (i * r)
+        return derived.sea_level(station, elevation)
 
-        c = i * r / a
+    # track pressures and calculate trend
+    def updateTrend(self, current, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.trend.add(timestamp, current)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('TREND %s %.3f over %.0f minutes', self.address,
+                    self.trend.change(), self.trend.span() / 60)
+        return self.trend.trend()
 
-        u = math.pow(1 + math.pow(s / station, c) * (r * elevation / n), l)
 
-        return (round((station * u), 3))
-
-    # track pressures in a queue and calculate trend
-    def updateTrend(self, current):
-        t = 1  # Steady
-        past = 0
-
-        if len(self.mytrend) > 1:
-            LOGGER.info('LAST entry = %f' % self.mytrend[-1])
-        if len(self.mytrend) == 180:
-            # This should be poping the last entry on the list (or the 
-            # oldest item added to the list).
-            past = self.mytrend.pop()
-
-        if self.mytrend != []:
-            # mytrend[0] seems to be the last entry inserted, not
-            # the first.  So how do we get the last item from the
-            # end of the array -- mytrend[-1]
-            past = self.mytrend[-1]
-
-        # calculate trend
-        LOGGER.info('TREND %f to %f' % (past, current))
-        if ((past - current) > 1):
-            t = 0 # Falling
-        elif ((past - current) < -1):
-            t = 2 # Rising
-
-        # inserts the value at index 0 and bumps all existing entries
-        # up by one index
-        self.mytrend.insert(0, current)
-
-        return t
-
-    # We want to override the SetDriver method so that we can properly
-    # convert the units based on the user preference.
-    def setDriver(self, driver, value):
-        if (self.units == 'us' and driver != 'GV1' ):
-            value = round(value * 0.02952998751, 3)
-        super(PressureNode, self).setDriver(driver, value, report=True, force=False, uom=self.uoms[driver])
-
-
-class WindNode(polyinterface.Node):
+class WindNode(WeatherNode):
     id = 'wind'
     hint = [1,11,4,0]
     units = 'metric'
@@ -654,40 +2435,66 @@ class WindNode(polyinterface.Node):
             {'driver': 'ST', 'value': 0, 'uom': 32},  # speed
             {'driver': 'GV0', 'value': 0, 'uom': 76}, # direction
             {'driver': 'GV1', 'value': 0, 'uom': 32}, # gust
-            {'driver': 'GV2', 'value': 0, 'uom': 32}  # lull
+            {'driver': 'GV2', 'value': 0, 'uom': 32}, # lull
+            {'driver': 'GV3', 'value': 0, 'uom': 32}, # 2 minute average
+            {'driver': 'GV4', 'value': 0, 'uom': 32}, # 2 minute gust
+            {'driver': 'GV5', 'value': 0, 'uom': 32}, # 2 minute lull
+            {'driver': 'GV6', 'value': 0, 'uom': 76}, # 2 minute direction
+            {'driver': 'GV7', 'value': 0, 'uom': 32}, # 10 minute average
+            {'driver': 'GV8', 'value': 0, 'uom': 32}, # 10 minute gust
+            {'driver': 'GV9', 'value': 0, 'uom': 32}, # 10 minute lull
+            {'driver': 'GV10', 'value': 0, 'uom': 76} # 10 minute direction
             ]
-    uoms = {
-            'ST': 32,
-            'GV0': 76,
-            'GV1': 32,
-            'GV2': 32
+    deadbands = {
+            'ST': 0.1,
+            'GV1': 0.1,
+            'GV2': 0.1,
+            'GV3': 0.1,
+            'GV4': 0.1,
+            'GV5': 0.1,
+            'GV6': 1,
+            'GV7': 0.1,
+            'GV8': 0.1,
+            'GV9': 0.1,
+            'GV10': 1
+            }
+    conversions = {
+            'ST': 'speed',
+            'GV0': 'direction',
+            'GV1': 'speed',
+            'GV2': 'speed',
+            'GV3': 'speed',
+            'GV4': 'speed',
+            'GV5': 'speed',
+            'GV6': 'direction',
+            'GV7': 'speed',
+            'GV8': 'speed',
+            'GV9': 'speed',
+            'GV10': 'direction'
             }
 
-    def SetUnits(self, u):
-        self.units = u
-        if (u == 'metric'):
-            self.uoms['ST'] = 32
-            self.uoms['GV1'] = '32'
-            self.uoms['GV2'] = '32'
-        elif (u == 'uk'): 
-            self.uoms['ST'] = 48
-            self.uoms['GV1'] = '48'
-            self.uoms['GV2'] = '48'
-        elif (u == 'us'): 
-            self.uoms['ST'] = 48
-            self.uoms['GV1'] = '48'
-            self.uoms['GV2'] = '48'
-
-    def setDriver(self, driver, value):
-        if (driver == 'ST' or driver == 'GV1' or driver == 'GV3'):
-            # value is in m/s, first convert to kph
-            value = round(value * (18 / 5), 3);
-
-            if (self.units != 'metric'):
-                value = round(value / 1.609344, 2)
-        super(WindNode, self).setDriver(driver, value, report=True, force=False, uom=self.uoms[driver])
-
-class PrecipitationNode(polyinterface.Node):
+    def __init__(self, controller, primary, address, name):
+        super(WindNode, self).__init__(controller, primary, address, name)
+        self.stats = windstats.WindStats()
+
+    # add a wind sample and publish the rolling statistics
+    def updateStats(self, speed, direction, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        if self.stats.add(timestamp, speed, direction):
+            self.publishStats()
+
+    def publishStats(self):
+        for (window, drivers) in ((self.stats.short, ('GV3', 'GV4', 'GV5', 'GV6')),
+                (self.stats.long, ('GV7', 'GV8', 'GV9', 'GV10'))):
+            self.setDriver(drivers[0], round(window.average(), 2))
+            self.setDriver(drivers[1], window.gust())
+            self.setDriver(drivers[2], window.lull())
+            d = window.direction()
+            if d is not None:
+                self.setDriver(drivers[3], int(round(d)) % 360)
+
+class PrecipitationNode(WeatherNode):
     id = 'precipitation'
     hint = [1,11,5,0]
     units = 'metric'
@@ -695,158 +2502,49 @@ class PrecipitationNode(polyinterface.Node):
             {'driver': 'ST', 'value': 0, 'uom': 46},  # rate
             {'driver': 'GV0', 'value': 0, 'uom': 82}, # hourly
             {'driver': 'GV1', 'value': 0, 'uom': 82}, # daily
-            {'driver': 'GV2', 'value': 0, 'uom': 82}  # yesterday
+            {'driver': 'GV2', 'value': 0, 'uom': 82}, # yesterday
+            {'driver': 'GV3', 'value': 0, 'uom': 82}, # weekly
+            {'driver': 'GV4', 'value': 0, 'uom': 82}, # monthly
+            {'driver': 'GV5', 'value': 0, 'uom': 82}  # yearly
             ]
-    uoms = {
-            'ST': 46,
-            'GV0': 82,
-            'GV1': 82,
-            'GV2': 82
+    conversions = {
+            'ST': 'rainrate',
+            'GV0': 'rain',
+            'GV1': 'rain',
+            'GV2': 'rain',
+            'GV3': 'rain',
+            'GV4': 'rain',
+            'GV5': 'rain'
             }
-    hourly_rain = 0
-    daily_rain = 0
-    weekly_rain = 0
-    monthly_rain = 0
-    yearly_rain = 0
-    yesterday_rain = 0
-
-    prev_hour = 0
-    prev_day = 0
-    prev_week = 0
-    prev_month = 0
-    prev_year = 0
-
-    def InitializeRain(self, acc):
-        self.daily_rain = acc['daily']
-        self.hourly_rain = acc['hourly']
-        self.weekly_rain = acc['weekly']
-        self.monthly_rain = acc['monthly']
-        self.yearly_rain = acc['yearly']
-        self.yesterday_rain = acc['yesterday']
-
-        self.prev_hour = acc['hour']
-        self.prev_day = acc['day']
-        self.prev_week = acc['week']
-        self.prev_month = acc['month']
-        self.prev_year = acc['year']
-
-        now = datetime.datetime.now()
-
-        # Need to compare saved date with current date and clear out 
-        # any accumlations that are old.
-
-        current_hour = now.hour
-        if self.prev_hour != now.hour:
-            LOGGER.info('Clearing old hourly data')
-            self.prev_hour = now.hour
-            self.hourly_rain = 0
-
-        if self.prev_day != now.day:
-            LOGGER.info('Clearing old daily, hourly data')
-            self.yesterday_rain = self.daily_rain
-            self.prev_day = now.day
-            self.hourly_rain = 0
-            self.daily_rain = 0
-
-        if self.prev_week != now.isocalendar()[1]:
-            LOGGER.info('Clearing old weekly, daily, hourly data')
-            self.prev_week = now.isocalendar()[1]
-            self.hourly_rain = 0
-            self.daily_rain = 0
-            self.weekly_rain = 0
-
-        if self.prev_month != now.month:
-            LOGGER.info('Clearing old monthly, daily, hourly data')
-            self.prev_month = now.month
-            self.hourly_rain = 0
-            self.daily_rain = 0
-            self.weekly_rain = 0
-            self.monthly_rain = 0
-
-        if self.prev_year != now.year:
-            LOGGER.info('Clearing old yearly, monthly, daily, hourly data')
-            self.prev_year = now.year
-            self.hourly_rain = 0
-            self.daily_rain = 0
-            self.weekly_rain = 0
-            self.monthly_rain = 0
-            self.yearly_rain = 0
 
+    def __init__(self, controller, primary, address, name):
+        super(PrecipitationNode, self).__init__(controller, primary, address, name)
+        self.rain = rainstore.RainAccumulator()
 
-    def SetUnits(self, u):
-        self.units = u
-        if (u == 'metric'):
-            self.uoms['ST'] = 46
-            self.uoms['GV0'] = 82
-            self.uoms['GV1'] = 82
-            self.uoms['GV2'] = 82
-        elif (u == 'uk'): 
-            self.uoms['ST'] = 46
-            self.uoms['GV0'] = 82
-            self.uoms['GV1'] = 82
-            self.uoms['GV2'] = 82
-        elif (u == 'us'): 
-            self.uoms['ST'] = 24
-            self.uoms['GV0'] = 105
-            self.uoms['GV1'] = 105
-            self.uoms['GV2'] = 105
-
-    def hourly_accumulation(self, r):
-        current_hour = datetime.datetime.now().hour
-        if (current_hour != self.prev_hour):
-            self.prev_hour = current_hour
-            self.hourly_rain = 0
-
-        self.hourly_rain += r
-        return self.hourly_rain
-
-    def daily_accumulation(self, r):
-        current_day = datetime.datetime.now().day
-        if (current_day != self.prev_day):
-            self.yesterday_rain = self.daily_rain
-            self.prev_day = current_day
-            self.daily_rain = 0
-
-        self.daily_rain += r
-        return self.daily_rain
-
-    def yesterday_accumulation(self):
-        return self.yesterday_rain
-
-    def weekly_accumulation(self, r):
-        (y, w, d) = datetime.datetime.now().isocalendar()
-        if w != self.prev_week:
-            self.prev_week = w
-            self.weekly_rain = 0
-
-        self.weekly_rain += r
-        return self.weekly_rain
-
-    def monthly_accumulation(self, r):
-        current_month = datetime.datetime.now().month
-        if (current_month != self.prev_month):
-            self.prev_month = current_month
-            self.monthly_rain = 0
-
-        self.monthly_rain += r
-        return self.monthly_rain
-
-    def yearly_accumulation(self, r):
-        current_year = datetime.datetime.now().year
-        if (current_year != self.prev_year):
-            self.prev_year = current_year
-            self.yearly_rain = 0
-
-        self.yearly_rain += r
-        return self.yearly_rain
+    def accumulate(self, r, timestamp=None, local=False):
+        """
+        Add rain amount r to the totals and publish them.
+        """
+        if r is None:
+            return
+        self.rain.add(r, timestamp)
+        self.publish_totals(local)
+
+    def publish_totals(self, local=False):
+        """
+        The hourly, daily and yesterday values come from the WeatherFlow
+        servers when we poll, with local data we publish our own.
+        """
+        if local:
+            self.setDriver('GV0', self.rain.hourly)
+            self.setDriver('GV1', self.rain.daily)
+            self.setDriver('GV2', self.rain.yesterday)
+        self.setDriver('GV3', self.rain.weekly)
+        self.setDriver('GV4', self.rain.monthly)
+        self.setDriver('GV5', self.rain.yearly)
 
-        
-    def setDriver(self, driver, value):
-        if (self.units == 'us'):
-            value = round(value * 0.03937, 2)
-        super(PrecipitationNode, self).setDriver(driver, value, report=True, force=False, uom=self.uoms[driver])
 
-class LightNode(polyinterface.Node):
+class LightNode(WeatherNode):
     id = 'light'
     units = 'metric'
     hint = [1,11,6,0]
@@ -855,48 +2553,136 @@ class LightNode(polyinterface.Node):
             {'driver': 'GV0', 'value': 0, 'uom': 74},  # solar radiation
             {'driver': 'GV1', 'value': 0, 'uom': 36},  # Lux
             ]
-    uoms = {
-            'ST': 71,
-            'GV0': 74,
-            'GV1': 36
+    deadbands = {
+            'ST': 0.1,
+            'GV0': 5,
+            'GV1': 100
+            }
+    conversions = {
+            'ST': 'uv',
+            'GV0': 'radiation',
+            'GV1': 'lux'
             }
 
-    def SetUnits(self, u):
-        self.units = u
-
-    def setDriver(self, driver, value):
-        super(LightNode, self).setDriver(driver, value, report=True, force=False)
-
-class LightningNode(polyinterface.Node):
+class LightningNode(WeatherNode):
     id = 'lightning'
     hint = [1,11,7,0]
     units = 'metric'
     drivers = [
-            {'driver': 'ST', 'value': 0, 'uom': 25},  # Strikes
+            {'driver': 'ST', 'value': 0, 'uom': 56},  # Strikes
             {'driver': 'GV0', 'value': 0, 'uom': 83},  # Distance
+            {'driver': 'GV1', 'value': 0, 'uom': 56},  # Strikes, last 5 minutes
+            {'driver': 'GV2', 'value': 0, 'uom': 56},  # Strikes, last 15 minutes
+            {'driver': 'GV3', 'value': 0, 'uom': 56},  # Strikes, last hour
+            {'driver': 'GV4', 'value': 0, 'uom': 56},  # Strikes, last 3 hours
+            {'driver': 'GV5', 'value': 0, 'uom': 83},  # Nearest, last 15 minutes
             ]
-    uoms = {
-            'ST': 25,
-            'GV0': 83
+    conversions = {
+            'ST': 'count',
+            'GV0': 'distance',
+            'GV1': 'count',
+            'GV2': 'count',
+            'GV3': 'count',
+            'GV4': 'count',
+            'GV5': 'distance'
             }
 
-    def SetUnits(self, u):
-        self.units = u
-        if (u == 'metric'):
-            self.uoms['ST'] = 83
-            self.uoms['GV0'] = 25
-        elif (u == 'uk'): 
-            self.uoms['ST'] = 116
-            self.uoms['GV0'] = 25
-        elif (u == 'us'): 
-            self.uoms['ST'] = 116
-            self.uoms['GV0'] = 25
-
-    def setDriver(self, driver, value):
-        if (driver == 'GV0'):
-            if (self.units != 'metric'):
-                value = round(value / 1.609344, 1)
-        super(LightningNode, self).setDriver(driver, value, report=True, force=False, uom=self.uoms[driver])
+    def __init__(self, controller, primary, address, name):
+        super(LightningNode, self).__init__(controller, primary, address, name)
+        self.strikes = strikes.StrikeIndex()
+
+    # add a strike event and publish the counts
+    def addStrike(self, timestamp, distance, energy=0.0):
+        if self.strikes.add(timestamp, distance, energy):
+            self.publishStrikes()
+
+    def publishStrikes(self):
+        for (driver, minutes) in (('GV1', 5), ('GV2', 15), ('GV3', 60), ('GV4', 180)):
+            self.setDriver(driver, self.strikes.count(minutes))
+        # With no recent strike, leave the last nearest distance rather
+        # than report a strike overhead.
+        nearest = self.strikes.nearest()
+        if nearest is not None:
+            self.setDriver('GV5', nearest)
+
+
+class ForecastNode(WeatherNode):
+    id = 'forecast'
+    hint = [1,11,1,0]
+    units = 'metric'
+    drivers = [
+            {'driver': 'ST', 'value': 0, 'uom': 4},  # High temperature
+            {'driver': 'GV0', 'value': 0, 'uom': 4},  # Low temperature
+            {'driver': 'GV1', 'value': 0, 'uom': 51},  # Precipitation probability
+            {'driver': 'GV2', 'value': 0, 'uom': 45},  # Forecast age
+            ]
+    deadbands = {
+            'GV2': 5
+            }
+    conversions = {
+            'ST': 'temperature',
+            'GV0': 'temperature',
+            'GV1': 'percent',
+            'GV2': 'minutes'
+            }
+
+    # day is (start, high, low, precipitation probability)
+    def updateForecast(self, day):
+        for (driver, value) in zip(('ST', 'GV0', 'GV1'), day[1:]):
+            if value is not None:
+                self.setDriver(driver, value)
+
+    def setAge(self, seconds):
+        self.setDriver('GV2', int(seconds // 60))
+
+
+class HourlyForecastNode(WeatherNode):
+    id = 'hourly'
+    hint = [1,11,1,0]
+    units = 'metric'
+    drivers = [
+            {'driver': 'ST', 'value': 0, 'uom': 4},  # Temperature, this hour
+            {'driver': 'GV0', 'value': 0, 'uom': 51},  # Precipitation probability, this hour
+            {'driver': 'GV1', 'value': 0, 'uom': 4},  # High, next 12 hours
+            {'driver': 'GV2', 'value': 0, 'uom': 4},  # Low, next 12 hours
+            {'driver': 'GV3', 'value': 0, 'uom': 51},  # Precipitation probability, next 12 hours
+            {'driver': 'GV4', 'value': 0, 'uom': 45},  # Forecast age
+            ]
+    deadbands = {
+            'GV4': 5
+            }
+    conversions = {
+            'ST': 'temperature',
+            'GV0': 'percent',
+            'GV1': 'temperature',
+            'GV2': 'temperature',
+            'GV3': 'percent',
+            'GV4': 'minutes'
+            }
+
+    # hours is a list of (time, temperature, precipitation probability)
+    def updateForecast(self, hours):
+        if len(hours) == 0:
+            return
+        values = list(hours[0][1:]) + list(forecast.summarize(hours))
+        for (driver, value) in zip(('ST', 'GV0', 'GV1', 'GV2', 'GV3'), values):
+            if value is not None:
+                self.setDriver(driver, value)
+
+    def setAge(self, seconds):
+        self.setDriver('GV4', int(seconds // 60))
+
+
+# Node class for each of the NODE_TYPES
+NODE_CLASSES = {
+        'temperature': TemperatureNode,
+        'humidity': HumidityNode,
+        'pressure': PressureNode,
+        'wind': WindNode,
+        'rain': PrecipitationNode,
+        'light': LightNode,
+        'lightning': LightningNode,
+        }
 
 
 if __name__ == "__main__":
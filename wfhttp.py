@@ -0,0 +1,263 @@
+"""
+HTTP client for the WeatherFlow servers.
+
+Wraps a pool of persistent HTTPS connections with connect and read
+timeouts, retries with jittered exponential backoff and a circuit breaker
+that fails requests immediately while the server is unreachable.
+Responses are requested gzip compressed and the client counts the bytes
+received and the request latency.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import random
+import threading
+import time
+import urllib3
+import urllib3.util.ssl_
+
+# Circuit breaker states, these are also the values of the controller's
+# server status driver.
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+STATE_NAMES = {CLOSED: 'closed', HALF_OPEN: 'half-open', OPEN: 'open'}
+
+
+class RequestError(Exception):
+    pass
+
+
+class CircuitOpenError(RequestError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive failed requests. While open,
+    requests fail immediately. After cooldown seconds one trial request
+    is let through (half open); if it works the breaker closes,
+    otherwise it opens again.
+    """
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if (time.time() - self.opened) < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                self.trial = False
+            # Half open, only one request at a time
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened = time.time()
+
+    def name(self):
+        return STATE_NAMES[self.state]
+
+
+# One breaker per server, shared by all the clients in the process that
+# talk to it, so failures seen by one client fail the others fast too.
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def shared_breaker(host, port=None, threshold=5, cooldown=60):
+    """
+    The circuit breaker for host and port, created with threshold and
+    cooldown by the first client to ask for it.
+    """
+    with breakers_lock:
+        breaker = breakers.get((host, port))
+        if breaker is None:
+            breaker = CircuitBreaker(threshold, cooldown)
+            breakers[(host, port)] = breaker
+        return breaker
+
+
+class Counters(object):
+    """
+    Totals for the requests made. wire_bytes is what was actually
+    received, body_bytes the size after decompression.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.latency = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, wire, body, latency):
+        with self.lock:
+            self.requests += 1
+            self.wire_bytes += wire
+            self.body_bytes += body
+            self.latency += latency
+
+    def snapshot(self):
+        """ Return the totals and reset them. """
+        with self.lock:
+            totals = (self.requests, self.wire_bytes, self.body_bytes, self.latency)
+            self.requests = 0
+            self.wire_bytes = 0
+            self.body_bytes = 0
+            self.latency = 0.0
+        return totals
+
+
+class WeatherFlowClient(object):
+    """
+    request() has the same signature as urllib3's so the client can be
+    used anywhere a connection pool is expected.
+
+    Connections are kept open between polls, up to maxsize of them, so a
+    request normally skips the TCP and TLS handshakes. All connections
+    share one SSL context.
+
+    Clients for the same host and port share one circuit breaker.
+
+    stop is an optional threading.Event. Once it's set, a request waiting
+    to retry gives up instead of sleeping out the backoff.
+    """
+    def __init__(self, host, maxsize=1, connect_timeout=5.0, read_timeout=15.0,
+            retries=2, backoff=1.0, backoff_max=10.0, threshold=5, cooldown=60,
+            secure=True, port=None, stop=None):
+        self.host = host
+        self.stop = stop
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = shared_breaker(host, port, threshold, cooldown)
+        self.counters = Counters()
+        self.headers = urllib3.make_headers(keep_alive=True, accept_encoding='gzip')
+        if secure:
+            self.pool = urllib3.HTTPSConnectionPool(host, port=port,
+                    maxsize=maxsize, block=True, retries=False,
+                    timeout=self.timeout, cert_reqs='CERT_REQUIRED',
+                    ssl_context=urllib3.util.ssl_.create_urllib3_context())
+        else:
+            self.pool = urllib3.HTTPConnectionPool(host, port=port,
+                    maxsize=maxsize, block=True, retries=False,
+                    timeout=self.timeout)
+
+    def delay(self, attempt):
+        # Full jitter, a random delay up to the exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff * (2 ** attempt)))
+
+    @staticmethod
+    def limit(timeout, remaining):
+        """ timeout with the connect and read timeouts capped at remaining. """
+        def cap(value):
+            if isinstance(value, (int, float)):
+                return min(value, remaining)
+            return remaining
+
+        if isinstance(timeout, urllib3.Timeout):
+            return urllib3.Timeout(connect=cap(timeout.connect_timeout),
+                    read=cap(timeout.read_timeout))
+        return urllib3.Timeout(connect=cap(timeout), read=cap(timeout))
+
+    @staticmethod
+    def pool_wait(timeout):
+        """ Seconds to wait for a free connection without a deadline. """
+        if isinstance(timeout, urllib3.Timeout):
+            timeout = timeout.connect_timeout
+        if isinstance(timeout, (int, float)):
+            return timeout
+        return 5.0
+
+    def request(self, method, path, headers=None, preload_content=True,
+            timeout=None, deadline=None):
+        """
+        Make a request, retrying connection errors, timeouts and server
+        errors. deadline limits the total time spent, including retries,
+        waiting for a free connection and each attempt's connect and read
+        timeouts. Raises
+        CircuitOpenError without making a request when the server has
+        been failing.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError('%s is unavailable, circuit breaker is open' % self.host)
+
+        if timeout is None:
+            timeout = self.timeout
+        send = dict(self.headers)
+        if headers is not None:
+            send.update(headers)
+
+        start = time.time()
+        attempt = 0
+        while True:
+            error = None
+            attempt_timeout = timeout
+            # Wait for a free connection no longer than a connect would
+            # take, or than what's left of the deadline.
+            pool_timeout = self.pool_wait(timeout)
+            if deadline is not None:
+                remaining = max(0.1, deadline - (time.time() - start))
+                attempt_timeout = self.limit(timeout, remaining)
+                pool_timeout = min(pool_timeout, remaining)
+            try:
+                t = time.time()
+                c = self.pool.request(method, path, headers=send,
+                        preload_content=preload_content, timeout=attempt_timeout,
+                        pool_timeout=pool_timeout)
+                if c.status < 500 and c.status != 429:
+                    self.breaker.success()
+                    self.count(c, preload_content, time.time() - t)
+                    return c
+                error = 'HTTP %d' % c.status
+                if preload_content:
+                    c.close()
+                else:
+                    c.release_conn()
+            except urllib3.exceptions.HTTPError as e:
+                error = str(e)
+
+            wait = self.delay(attempt)
+            attempt += 1
+            if attempt > self.retries or (deadline is not None and
+                    (time.time() - start + wait) > deadline):
+                self.breaker.failure()
+                raise RequestError('%s%s failed: %s' % (self.host, path.split('?')[0], error))
+            if self.stop is None:
+                time.sleep(wait)
+            elif self.stop.wait(wait):
+                raise RequestError('%s%s failed: %s, stopping' % (self.host, path.split('?')[0], error))
+
+    def count(self, c, preloaded, latency):
+        # A streamed response hasn't been read yet, only the time to the
+        # response headers is known.
+        if preloaded:
+            self.counters.add(c.tell(), len(c.data), latency)
+        else:
+            self.counters.add(0, 0, latency)
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,235 @@
+"""
+Minimal WebSocket (RFC 6455) support for the WeatherFlow node server.
+
+Only what the WeatherFlow data socket needs: text messages, ping/pong
+and close, no extensions. connect() opens a client connection, the
+WebSocket class is also used by the test server in tools to talk to
+the client.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import base64
+import hashlib
+import os
+import socket
+import ssl
+import struct
+import urllib.parse
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+MAX_MESSAGE = 1 << 20
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class WebSocketClosed(WebSocketError):
+    pass
+
+
+def accept_key(key):
+    """ The Sec-WebSocket-Accept value for a Sec-WebSocket-Key. """
+    if isinstance(key, str):
+        key = key.encode('ascii')
+    return base64.b64encode(hashlib.sha1(key + GUID).digest()).decode('ascii')
+
+
+def encode_frame(opcode, payload, mask):
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack('!H', length))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack('!Q', length))
+
+    if not mask:
+        return bytes(header) + payload
+
+    key = os.urandom(4)
+    masked = bytearray(payload)
+    for i in range(length):
+        masked[i] ^= key[i & 3]
+    return bytes(header) + key + bytes(masked)
+
+
+class WebSocket(object):
+    """
+    A connected WebSocket. Clients mask the frames they send, servers
+    don't. Received data is buffered so a timeout part way through a
+    frame doesn't lose anything.
+    """
+    def __init__(self, sock, mask=True, data=b''):
+        self.sock = sock
+        self.mask = mask
+        self.buf = bytearray(data)
+        self.fragments = None
+        self.closed = False
+
+    def send(self, text):
+        self.send_frame(TEXT, text.encode('utf-8'))
+
+    def send_frame(self, opcode, payload):
+        self.sock.sendall(encode_frame(opcode, payload, self.mask))
+
+    def parse_frame(self):
+        """ Remove and return (fin, opcode, payload) from the buffer, None if incomplete. """
+        buf = self.buf
+        if len(buf) < 2:
+            return None
+        fin = buf[0] & 0x80
+        opcode = buf[0] & 0x0F
+        masked = buf[1] & 0x80
+        length = buf[1] & 0x7F
+        pos = 2
+        if length == 126:
+            if len(buf) < 4:
+                return None
+            length = struct.unpack_from('!H', buf, 2)[0]
+            pos = 4
+        elif length == 127:
+            if len(buf) < 10:
+                return None
+            length = struct.unpack_from('!Q', buf, 2)[0]
+            pos = 10
+        if length > MAX_MESSAGE:
+            raise WebSocketError('frame of %d bytes is too large' % length)
+
+        key = None
+        if masked:
+            if len(buf) < pos + 4:
+                return None
+            key = buf[pos:pos + 4]
+            pos += 4
+        if len(buf) < pos + length:
+            return None
+
+        payload = bytearray(buf[pos:pos + length])
+        del buf[:pos + length]
+        if key is not None:
+            for i in range(length):
+                payload[i] ^= key[i & 3]
+        return (fin, opcode, bytes(payload))
+
+    def recv(self, timeout=None):
+        """
+        Return the next text message, or None if nothing arrived within
+        timeout seconds. Pings are answered here. Raises WebSocketClosed
+        when the other end closes the connection.
+        """
+        self.sock.settimeout(timeout)
+        while True:
+            frame = self.parse_frame()
+            if frame is None:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.timeout:
+                    return None
+                if not data:
+                    self.closed = True
+                    raise WebSocketClosed('connection closed')
+                self.buf.extend(data)
+                continue
+
+            (fin, opcode, payload) = frame
+            if opcode == PING:
+                self.send_frame(PONG, payload)
+            elif opcode == PONG:
+                pass
+            elif opcode == CLOSE:
+                if not self.closed:
+                    self.closed = True
+                    try:
+                        self.send_frame(CLOSE, payload[:2])
+                    except OSError:
+                        pass
+                raise WebSocketClosed('closed by peer')
+            elif opcode in (TEXT, BINARY, CONTINUATION):
+                if opcode != CONTINUATION:
+                    self.fragments = bytearray()
+                if self.fragments is None:
+                    raise WebSocketError('unexpected continuation frame')
+                self.fragments.extend(payload)
+                if len(self.fragments) > MAX_MESSAGE:
+                    raise WebSocketError('message is too large')
+                if fin:
+                    message = bytes(self.fragments)
+                    self.fragments = None
+                    return message.decode('utf-8')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.send_frame(CLOSE, struct.pack('!H', 1000))
+            except OSError:
+                pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def connect(url, timeout=10.0):
+    """ Open a client connection to a ws:// or wss:// URL. """
+    u = urllib.parse.urlsplit(url)
+    secure = (u.scheme == 'wss')
+    port = u.port or (443 if secure else 80)
+    path = u.path or '/'
+    if u.query:
+        path += '?' + u.query
+
+    sock = socket.create_connection((u.hostname, port), timeout)
+    try:
+        if secure:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=u.hostname)
+
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = ('GET %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Upgrade: websocket\r\n'
+                'Connection: Upgrade\r\n'
+                'Sec-WebSocket-Key: %s\r\n'
+                'Sec-WebSocket-Version: 13\r\n\r\n') % (path, u.netloc, key)
+        sock.sendall(request.encode('ascii'))
+
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise WebSocketError('connection closed during handshake')
+            response += data
+            if len(response) > 16384:
+                raise WebSocketError('handshake response is too large')
+
+        (head, rest) = response.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        status = lines[0].split(' ')
+        if len(status) < 2 or status[1] != '101':
+            raise WebSocketError('handshake failed: %s' % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                (name, value) = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        if headers.get('sec-websocket-accept') != accept_key(key):
+            raise WebSocketError('handshake failed: bad accept key')
+
+        return WebSocket(sock, mask=True, data=rest)
+    except Exception:
+        sock.close()
+        raise
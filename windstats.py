@@ -0,0 +1,129 @@
+"""
+Rolling wind statistics for the WeatherFlow node server.
+
+Copyright (c) 2018 Robert Paauwe
+"""
+import array
+import collections
+import math
+
+
+class WindWindow(object):
+    """
+    Ring buffer of (timestamp, speed, direction) samples covering the
+    last window seconds.
+
+    Adding a sample is constant time (amortized). A running sum of the
+    speeds gives the average. The direction is the vector mean, from
+    running sums of the speed weighted sine and cosine of each sample's
+    direction. Gust and lull are the maximum and minimum speed, kept at
+    the front of two monotonic deques of sample numbers.
+    """
+    def __init__(self, window, capacity=512):
+        self.window = window
+        self.capacity = capacity
+        self.times = array.array('d', [0.0] * capacity)
+        self.speeds = array.array('d', [0.0] * capacity)
+        self.sins = array.array('d', [0.0] * capacity)
+        self.coss = array.array('d', [0.0] * capacity)
+        self.maxq = collections.deque()
+        self.minq = collections.deque()
+        self.first = 0   # number of the oldest sample
+        self.next = 0    # number of the next sample
+        self.drops = 0
+        self.sum_speed = 0.0
+        self.sum_sin = 0.0
+        self.sum_cos = 0.0
+
+    def __len__(self):
+        return self.next - self.first
+
+    def _drop_oldest(self):
+        i = self.first % self.capacity
+        self.sum_speed -= self.speeds[i]
+        self.sum_sin -= self.sins[i]
+        self.sum_cos -= self.coss[i]
+        if self.maxq and self.maxq[0] == self.first:
+            self.maxq.popleft()
+        if self.minq and self.minq[0] == self.first:
+            self.minq.popleft()
+        self.first += 1
+
+        # Rebuild the sums now and then so rounding errors from
+        # subtracting expired samples don't accumulate.
+        self.drops += 1
+        if self.drops >= self.capacity:
+            self.drops = 0
+            self.sum_speed = self.sum_sin = self.sum_cos = 0.0
+            for n in range(self.first, self.next):
+                j = n % self.capacity
+                self.sum_speed += self.speeds[j]
+                self.sum_sin += self.sins[j]
+                self.sum_cos += self.coss[j]
+
+    def add(self, timestamp, speed, direction):
+        while len(self) > 0 and self.times[self.first % self.capacity] <= timestamp - self.window:
+            self._drop_oldest()
+        if len(self) == self.capacity:
+            self._drop_oldest()
+
+        r = math.radians(direction)
+        n = self.next
+        i = n % self.capacity
+        self.times[i] = timestamp
+        self.speeds[i] = speed
+        self.sins[i] = speed * math.sin(r)
+        self.coss[i] = speed * math.cos(r)
+        self.next += 1
+        self.sum_speed += speed
+        self.sum_sin += self.sins[i]
+        self.sum_cos += self.coss[i]
+
+        while self.maxq and self.speeds[self.maxq[-1] % self.capacity] <= speed:
+            self.maxq.pop()
+        self.maxq.append(n)
+        while self.minq and self.speeds[self.minq[-1] % self.capacity] >= speed:
+            self.minq.pop()
+        self.minq.append(n)
+
+    def average(self):
+        if len(self) == 0:
+            return None
+        return self.sum_speed / len(self)
+
+    def gust(self):
+        if len(self) == 0:
+            return None
+        return self.speeds[self.maxq[0] % self.capacity]
+
+    def lull(self):
+        if len(self) == 0:
+            return None
+        return self.speeds[self.minq[0] % self.capacity]
+
+    def direction(self):
+        """ Vector mean direction in degrees, None when calm. """
+        if abs(self.sum_sin) < 1e-9 and abs(self.sum_cos) < 1e-9:
+            return None
+        return math.degrees(math.atan2(self.sum_sin, self.sum_cos)) % 360
+
+
+class WindStats(object):
+    """
+    2 and 10 minute wind statistics. Samples have to be added in time
+    order, anything older than the last sample is ignored so the 1
+    minute observations don't get mixed in with the 3 second rapid
+    wind samples covering the same time.
+    """
+    def __init__(self, short=120, long=600, capacity=512):
+        self.short = WindWindow(short, capacity)
+        self.long = WindWindow(long, capacity)
+        self.last = 0
+
+    def add(self, timestamp, speed, direction):
+        if timestamp <= self.last:
+            return False
+        self.last = timestamp
+        self.short.add(timestamp, speed, direction)
+        self.long.add(timestamp, speed, direction)
+        return True